@@ -0,0 +1,112 @@
+"""Concurrent invoice creates vs. dashboard reads, before and after connection pooling.
+
+"before" uses the old connect-per-call sqlite3 connections in rollback-journal
+mode; "after" uses main.db() (pooled, WAL, busy_timeout). Each run gets a
+fresh database. Run from the backend directory:
+
+    python benchmarks/bench_db_contention.py [writers] [readers] [invoices_per_writer]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+WORK_DIR = tempfile.mkdtemp(prefix="bench-db-")
+os.chdir(WORK_DIR)
+
+import main  # noqa: E402
+from fastapi import Request, Response  # noqa: E402
+
+pooled_db = main.db
+
+def legacy_db():
+    """The connection factory main.db() used to be."""
+    return sqlite3.connect(main.DB)
+
+def seed(clients=50, invoices=2000):
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO templates (name, template_dir, html_filename, css_filename, fields) VALUES ('bench', 'bench', 'i.html', 'i.css', '[]')")
+        for i in range(clients):
+            c.execute("INSERT INTO clients (name, address, cap, city, nation, email) VALUES (?, 'Street 1', '8000', 'Zurich', 'CH', 'c@example.com')", (f"Client {i}",))
+            client_id = c.lastrowid
+            c.execute("INSERT INTO recurring_fees (client_id, amount, currency, frequency, start_date, description) VALUES (?, 100, 'CHF', 'monthly', '2024-01-01', 'Hosting')", (client_id,))
+        for i in range(invoices):
+            c.execute("INSERT INTO invoices (invoice_number, client_id, template_id, data, status, total_amount, paid_date) VALUES (?, ?, 1, '{}', ?, ?, ?)",
+                      (f"SEED{i:06d}", i % clients + 1, ("draft", "sent", "paid")[i % 3], 100.0 + i, "2026-01-15" if i % 3 == 2 else None))
+            c.execute("INSERT INTO expenses (date, description, amount, category, expense_type, paid_by) VALUES ('2026-01-10', 'Expense', 10, 'office', 'shared', 1)")
+        conn.commit()
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def run(label, connection_factory, journal_mode, writers, readers, invoices_per_writer):
+    main.close_db_pool()
+    main.DB = os.path.join(WORK_DIR, f"{label}.sqlite")
+    main.DB_JOURNAL_MODE = journal_mode
+    main.db = connection_factory
+    main.init_db()
+    seed()
+
+    write_latencies, read_latencies, errors = [], [], []
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def writer(n):
+        for i in range(invoices_per_writer):
+            start = time.perf_counter()
+            try:
+                created = main.generate_invoice_from_recurring(n % 50 + 1)
+                main.update_invoice_status(created["invoice_id"], {"status": "paid"})
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                write_latencies.append(time.perf_counter() - start)
+
+    def reader():
+        while not done.is_set():
+            start = time.perf_counter()
+            try:
+                # No If-None-Match, so every read runs its query
+                request = Request({"type": "http", "headers": []})
+                main.get_dashboard_stats(request, Response())
+                main.get_dashboard_outstanding(request, Response())
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                read_latencies.append(time.perf_counter() - start)
+
+    reader_threads = [threading.Thread(target=reader) for _ in range(readers)]
+    writer_threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    start = time.perf_counter()
+    for t in reader_threads + writer_threads:
+        t.start()
+    for t in writer_threads:
+        t.join()
+    done.set()
+    for t in reader_threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"{label}:")
+    print(f"  writes  {len(write_latencies) / elapsed:8.1f}/s  p50 {percentile(write_latencies, 50) * 1000:7.1f} ms  p95 {percentile(write_latencies, 95) * 1000:7.1f} ms")
+    print(f"  reads   {len(read_latencies) / elapsed:8.1f}/s  p50 {percentile(read_latencies, 50) * 1000:7.1f} ms  p95 {percentile(read_latencies, 95) * 1000:7.1f} ms")
+    print(f"  errors  {len(errors)}" + (f" (e.g. {errors[0]})" if errors else ""))
+
+if __name__ == "__main__":
+    writers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    invoices_per_writer = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    run("before", legacy_db, "DELETE", writers, readers, invoices_per_writer)
+    run("after", pooled_db, "WAL", writers, readers, invoices_per_writer)
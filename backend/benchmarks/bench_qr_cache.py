@@ -0,0 +1,76 @@
+"""Compare QR-bill generation with and without the SVG cache.
+
+Run from the backend directory:
+
+    python benchmarks/bench_qr_cache.py [iterations]
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(tempfile.mkdtemp(prefix="bench-qr-"))
+
+import main  # noqa: E402
+
+BANK_DETAILS = {
+    "iban": "CH5800791123000889012",
+    "creditor_name": "My Company AG",
+    "creditor_street": "My Street 1",
+    "creditor_postalcode": "8000",
+    "creditor_city": "Zurich",
+    "creditor_country": "CH",
+}
+DEBTOR = {"name": "Sample Client AG", "street": "Musterstrasse 123", "pcode": "8000", "city": "Zurich", "country": "CH"}
+
+def uncached_svg(amount):
+    """The pre-cache code path: build the bill and serialize it on every call."""
+    bill = main.QRBill(
+        account=BANK_DETAILS["iban"],
+        creditor={
+            "name": BANK_DETAILS["creditor_name"],
+            "street": BANK_DETAILS["creditor_street"],
+            "pcode": BANK_DETAILS["creditor_postalcode"],
+            "city": BANK_DETAILS["creditor_city"],
+            "country": BANK_DETAILS["creditor_country"],
+        },
+        amount=str(amount),
+        debtor=DEBTOR,
+    )
+    buffer = io.StringIO()
+    bill.as_svg(buffer)
+    return buffer.getvalue().encode("utf-8")
+
+def cached_svg(amount):
+    """The render path: get_qr_bill_svg() on the validated QRBill arguments."""
+    return main.get_qr_bill_svg(main.build_qr_bill_args(amount, DEBTOR, BANK_DETAILS))[1]
+
+def disk_cached_svg(amount):
+    """A fresh worker process: the SVG is on disk but not yet in memory."""
+    main.qr_cache.discard(lambda key: True)
+    return cached_svg(amount)
+
+def bench(label, fn, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed * 1000 / iterations:8.3f} ms/bill")
+    return elapsed
+
+def run():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    uncached = bench("no cache", lambda i: uncached_svg(100), iterations)
+    bench("cache miss", lambda i: cached_svg(100 + i), iterations)
+    cached_svg(100)
+    bench("disk cache hit", lambda i: disk_cached_svg(100), iterations)
+    cached = bench("memory cache hit", lambda i: cached_svg(100), iterations)
+
+    print(f"speedup on unchanged bills: {uncached / cached:.1f}x")
+
+if __name__ == "__main__":
+    run()
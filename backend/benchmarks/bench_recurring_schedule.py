@@ -0,0 +1,83 @@
+"""Payment event generation for many backdated recurring fees, before and after the schedule engine.
+
+"before" replays the old month-by-month walk (a SELECT COUNT(*) and an INSERT
+per occurrence); "after" uses main.fee_schedule() and one executemany with
+INSERT OR IGNORE per fee. Each run gets a fresh database. Run from the backend
+directory:
+
+    python benchmarks/bench_recurring_schedule.py [fees] [years_back]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+from dateutil.relativedelta import relativedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+WORK_DIR = tempfile.mkdtemp(prefix="bench-schedule-")
+os.chdir(WORK_DIR)
+
+import main  # noqa: E402
+
+FREQUENCIES = ["monthly", "quarterly", "semi-annual", "yearly"]
+
+def legacy_generate(c, fee):
+    """The walk add_recurring_fee used to do, for monthly and yearly steps."""
+    step = relativedelta(years=1) if fee["frequency"] == "yearly" else relativedelta(months=main.RECURRING_FREQUENCY_MONTHS[fee["frequency"]])
+    next_date = datetime.fromisoformat(fee["start_date"])
+    current_date = datetime.now()
+    while next_date <= current_date:
+        due_date_str = next_date.strftime("%Y-%m-%d")
+        c.execute("SELECT COUNT(*) FROM payment_events WHERE recurring_fee_id=? AND due_date=?", (fee["id"], due_date_str))
+        if c.fetchone()[0] == 0:
+            c.execute(
+                "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (fee["client_id"], fee["id"], fee["amount"], "CHF", due_date_str, fee["description"], "not_sent")
+            )
+        next_date = next_date + step
+    c.execute(
+        "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (fee["client_id"], fee["id"], fee["amount"], "CHF", next_date.strftime("%Y-%m-%d"), fee["description"], "not_sent")
+    )
+
+def engine_generate(c, fee):
+    dates = main.fee_schedule(fee, date.today())
+    main.insert_fee_occurrences(c, main.fee_occurrence_rows(fee, dates, "not_sent"))
+
+def run(label, generate, fees, years_back):
+    main.close_db_pool()
+    main.DB = os.path.join(WORK_DIR, f"{label}.sqlite")
+    main.init_db()
+    start_date = (date.today() - relativedelta(years=years_back)).replace(day=28).isoformat()
+
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO clients (name) VALUES ('Bench client')")
+        client_id = c.lastrowid
+        fee_rows = []
+        for i in range(fees):
+            fee = {"client_id": client_id, "amount": 100, "frequency": FREQUENCIES[i % len(FREQUENCIES)],
+                   "start_date": start_date, "description": f"Fee {i}"}
+            c.execute("INSERT INTO recurring_fees (client_id, amount, frequency, start_date, description) VALUES (?, ?, ?, ?, ?)",
+                      (client_id, fee["amount"], fee["frequency"], fee["start_date"], fee["description"]))
+            fee_rows.append({**fee, "id": c.lastrowid})
+
+    started = time.perf_counter()
+    with main.db() as conn:
+        c = conn.cursor()
+        for fee in fee_rows:
+            generate(c, fee)
+    elapsed = time.perf_counter() - started
+
+    with main.db() as conn:
+        events = conn.execute("SELECT COUNT(*) FROM payment_events").fetchone()[0]
+    print(f"{label:7s} {fees} fees, {events} events: {elapsed * 1000:9.1f} ms  ({elapsed / fees * 1e6:7.1f} us/fee)")
+
+if __name__ == "__main__":
+    fees = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    years_back = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    run("before", legacy_generate, fees, years_back)
+    run("after", engine_generate, fees, years_back)
@@ -0,0 +1,248 @@
+"""Time each stage of the invoice render pipeline for small, large and huge invoices.
+
+A temporary working directory gets a fresh db.sqlite and a seeded template;
+each stage is then timed on its own:
+
+    format      format_swiss_amount / to_swiss_date over every item
+    jinja       rendering the (already compiled) template
+    qr_bill     building a QR-bill SVG on a cache miss
+    write_pdf   WeasyPrint layout and PDF output of the rendered HTML
+    end_to_end  main.render_invoice() for a stored invoice
+
+Results are written as JSON; pass a previous result as --baseline to flag
+stages whose median got slower by more than --threshold. Run from the backend
+directory:
+
+    python benchmarks/bench_render_pipeline.py --output baseline.json
+    python benchmarks/bench_render_pipeline.py --baseline baseline.json [--threshold 0.2]
+
+The exit status is 1 when a regression was flagged.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+# --output and --baseline are relative to where the script was started
+INVOCATION_DIR = os.getcwd()
+WORK_DIR = tempfile.mkdtemp(prefix="bench-render-")
+os.chdir(WORK_DIR)
+
+import main  # noqa: E402
+
+SIZES = {"small": 3, "large": 500, "huge": 5000}
+# Default repetitions per size; --repeat overrides all of them
+REPEATS = {"small": 20, "large": 5, "huge": 2}
+STAGES = ["format", "jinja", "qr_bill", "write_pdf", "end_to_end"]
+# Medians this close (in ms) are never reported as regressions, whatever the ratio
+NOISE_FLOOR_MS = 0.05
+
+TEMPLATE_HTML = """<html>
+<head><link rel="stylesheet" href="style.css"></head>
+<body>
+  <h1>Invoice {{ invoice_number }}</h1>
+  <p>{{ customer.name }}<br>{{ customer.address }}<br>{{ customer.cap }} {{ customer.city }}</p>
+  <p>Date: {{ date }}</p>
+  <table>
+    <tr><th>Date</th><th>Description</th><th>Qty</th><th>Price</th><th>Total</th></tr>
+    {% for item in items %}
+    <tr><td>{{ item.date }}</td><td>{{ item.desc }}</td><td>{{ item.qty }}</td><td>{{ item.price }}</td><td>{{ item.total }}</td></tr>
+    {% endfor %}
+  </table>
+  <p>Subtotal: {{ subtotal }}</p>
+  <p>Total: {{ net_total }}</p>
+  <p>{{ notes }}</p>
+  <img src="{{ qr_image }}">
+</body>
+</html>
+"""
+TEMPLATE_CSS = """
+@page { size: A4; margin: 2cm; }
+body { font-family: sans-serif; font-size: 10pt; }
+table { width: 100%; border-collapse: collapse; }
+td, th { border-bottom: 1px solid #ccc; padding: 2px 4px; }
+"""
+
+def make_items(count):
+    start = date(2026, 1, 1)
+    return [
+        {
+            "desc": f"Consulting work package {i}",
+            "qty": 1 + i % 5,
+            "price": 95 + (i % 17) * 12.5,
+            "date": (start + timedelta(days=i % 365)).isoformat(),
+        }
+        for i in range(count)
+    ]
+
+def seed():
+    """Create the template on disk and in the database, plus a client. Returns (template_id, client_id)."""
+    main.init_db()
+    template_dir = os.path.join(main.TEMPLATE_DIR, "bench")
+    os.makedirs(template_dir, exist_ok=True)
+    with open(os.path.join(template_dir, "invoice.html"), "w", encoding="utf-8") as f:
+        f.write(TEMPLATE_HTML)
+    with open(os.path.join(template_dir, "style.css"), "w", encoding="utf-8") as f:
+        f.write(TEMPLATE_CSS)
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO templates (name, template_dir, html_filename, css_filename, fields) VALUES (?, ?, ?, ?, ?)",
+                  ("Bench", "bench", "invoice.html", "style.css", "[]"))
+        template_id = c.lastrowid
+        c.execute("INSERT INTO clients (name, address, cap, city, nation, email) VALUES (?, ?, ?, ?, ?, ?)",
+                  ("Bench Client AG", "Musterstrasse 123", "8000", "Zurich", "CH", "bench@example.ch"))
+        client_id = c.lastrowid
+    return template_id, client_id
+
+def store_invoice(template_id, client_id, items):
+    data = {"items": items, "date": "2026-03-01", "notes": "Payable within 30 days"}
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO invoices (invoice_number, client_id, template_id, data, status) VALUES (?, ?, ?, ?, 'draft')",
+                  (main.invoice_numbers.allocate(c, template_id), client_id, template_id, json.dumps(data)))
+        return c.lastrowid
+
+def format_items(items):
+    """The per-item formatting render_invoice does, on a copy of the items."""
+    formatted = []
+    for item in items:
+        total = float(item["price"]) * float(item["qty"])
+        formatted.append({
+            **item,
+            "price": main.format_swiss_amount(item["price"]),
+            "total": main.format_swiss_amount(total),
+            "date": main.to_swiss_date(item["date"]),
+        })
+    subtotal = sum(float(item["price"]) * float(item["qty"]) for item in items)
+    return formatted, subtotal
+
+def timed(fn, repeat):
+    """Call fn() repeat times (after one warm-up call) and return the durations in ms."""
+    fn(0)
+    durations = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        fn(i + 1)
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+def summarize(durations):
+    return {
+        "runs": len(durations),
+        "median_ms": round(statistics.median(durations), 4),
+        "min_ms": round(min(durations), 4),
+        "mean_ms": round(statistics.fmean(durations), 4),
+    }
+
+def bench_size(size, count, repeat, template_id, client_id, stages):
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM clients WHERE id=?", (client_id,))
+        customer = main.row_to_dict(c, c.fetchone())
+        c.execute("SELECT * FROM bank_details LIMIT 1")
+        bank_details = main.row_to_dict(c, c.fetchone())
+    debtor = {"name": customer["name"], "street": customer["address"], "pcode": customer["cap"],
+              "city": customer["city"], "country": customer["nation"]}
+    template_dir = os.path.join(main.TEMPLATE_DIR, "bench")
+    invoice_dir = os.path.join(main.RESULTS_DIR, f"bench_{size}")
+    os.makedirs(invoice_dir, exist_ok=True)
+
+    items = make_items(count)
+    formatted, subtotal = format_items(items)
+    _, qr_svg = main.get_qr_bill_svg(main.build_qr_bill_args(subtotal, debtor, bank_details))
+    context = {
+        "customer": customer, "client": customer, "items": formatted, "invoice_number": "BENCH-1",
+        "date": "01.03.2026", "subtotal": main.format_swiss_amount(subtotal),
+        "net_total": main.format_swiss_amount(subtotal), "notes": "Payable within 30 days",
+        "qr_image": "qr_bill.svg",
+    }
+    template = main.get_compiled_template(template_id, template_dir, "invoice.html")
+    html = template.render(**context)
+    css = main.get_template_css(template_id, os.path.join(template_dir, "style.css"))
+
+    def write_pdf(i):
+        main.HTML(
+            string=html,
+            base_url=f"file://{os.path.abspath(invoice_dir)}/",
+            url_fetcher=main.InvoiceURLFetcher(invoice_dir, template_dir, "style.css", qr_svg, css),
+        ).write_pdf(os.path.join(invoice_dir, "invoice.pdf"), font_config=main.get_font_config())
+
+    invoice_id = store_invoice(template_id, client_id, items)
+    runs = {
+        "format": lambda i: format_items(items),
+        "jinja": lambda i: template.render(**context),
+        # A different amount each call, so every call misses the QR cache
+        "qr_bill": lambda i: main.get_qr_bill_svg(main.build_qr_bill_args(subtotal + i / 100, debtor, bank_details)),
+        "write_pdf": write_pdf,
+        "end_to_end": lambda i: main.render_invoice(invoice_id),
+    }
+    results = {}
+    for stage in stages:
+        results[stage] = summarize(timed(runs[stage], repeat))
+        print(f"{size:<6} {count:>5} items  {stage:<11} median {results[stage]['median_ms']:10.3f} ms"
+              f"  (min {results[stage]['min_ms']:.3f}, {results[stage]['runs']} runs)")
+    return results
+
+def compare(results, baseline, threshold):
+    """Print the change of every stage against the baseline; return the regressed (size, stage) pairs."""
+    regressions = []
+    print(f"\nAgainst baseline from {baseline.get('meta', {}).get('timestamp', '?')} (threshold {threshold:.0%}):")
+    for size, stages in results.items():
+        for stage, current in stages.items():
+            previous = baseline.get("results", {}).get(size, {}).get(stage)
+            if not previous:
+                continue
+            before, after = previous["median_ms"], current["median_ms"]
+            ratio = after / before if before else float("inf")
+            regressed = ratio > 1 + threshold and after - before > NOISE_FLOOR_MS
+            marker = "  REGRESSION" if regressed else ""
+            print(f"{size:<6} {stage:<11} {before:10.3f} -> {after:10.3f} ms  ({ratio - 1:+7.1%}){marker}")
+            if regressed:
+                regressions.append((size, stage))
+    return regressions
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default=",".join(SIZES), help="comma-separated subset of " + ", ".join(SIZES))
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated subset of " + ", ".join(STAGES))
+    parser.add_argument("--repeat", type=int, help="runs per stage (default: %s)" % REPEATS)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed median slowdown, as a fraction (default 0.2)")
+    args = parser.parse_args()
+
+    template_id, client_id = seed()
+    stages = [stage for stage in args.stages.split(",") if stage]
+    results = {}
+    for size in args.sizes.split(","):
+        results[size] = bench_size(size, SIZES[size], args.repeat or REPEATS[size], template_id, client_id, stages)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "weasyprint": getattr(sys.modules.get("weasyprint"), "__version__", None),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(os.path.join(INVOCATION_DIR, args.output), "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(os.path.join(INVOCATION_DIR, args.baseline)) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run()
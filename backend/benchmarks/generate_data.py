@@ -0,0 +1,186 @@
+"""Fill a fresh database with synthetic clients, invoices, payment events and expenses.
+
+Creates DIRECTORY/db.sqlite (migrated by main.init_db()) and a template under
+DIRECTORY/templates, so the load harness (benchmarks/load_test.py) or a uvicorn
+started in DIRECTORY can work against it. Run from the backend directory:
+
+    python benchmarks/generate_data.py DIRECTORY [--clients 5000] [--invoices 200000]
+        [--payment-events 1000000] [--expenses 100000] [--seed 1]
+
+Rows go in through executemany in large transactions. The usual triggers
+(dashboard rollup, table versions, outbox) run as they would in production;
+the outbox is emptied at the end since no webhook endpoint exists yet.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+CHUNK = 10000
+CITIES = [("8001", "Zurich"), ("3011", "Bern"), ("1201", "Geneva"), ("4051", "Basel"), ("6003", "Luzern"), ("9000", "St. Gallen")]
+CATEGORIES = ["office", "software", "travel", "hardware", "marketing", "other"]
+FREQUENCIES = ["monthly", "quarterly", "semi-annual", "yearly"]
+
+TEMPLATE_HTML = """<html>
+<head><link rel="stylesheet" href="style.css"></head>
+<body>
+  <h1>Invoice {{ invoice_number }}</h1>
+  <p>{{ customer.name }}<br>{{ customer.address }}<br>{{ customer.cap }} {{ customer.city }}</p>
+  <p>Date: {{ date }}</p>
+  <table>
+    {% for item in items %}
+    <tr><td>{{ item.desc }}</td><td>{{ item.qty }}</td><td>{{ item.price }}</td><td>{{ item.total }}</td></tr>
+    {% endfor %}
+  </table>
+  <p>Total: {{ net_total }}</p>
+  <img src="{{ qr_image }}">
+</body>
+</html>
+"""
+TEMPLATE_CSS = "body { font-family: sans-serif; font-size: 10pt; } td { padding: 2px 4px; }\n"
+
+def random_day(rng, start, days):
+    return (start + timedelta(days=rng.randrange(days))).isoformat()
+
+def insert_chunks(conn, sql, rows, total, label):
+    """executemany rows (a generator) in transactions of CHUNK rows, printing progress."""
+    started = time.perf_counter()
+    batch = []
+    done = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) == CHUNK:
+            conn.executemany(sql, batch)
+            conn.commit()
+            done += len(batch)
+            batch = []
+            print(f"\r{label}: {done}/{total}", end="", flush=True)
+    if batch:
+        conn.executemany(sql, batch)
+        conn.commit()
+        done += len(batch)
+    print(f"\r{label}: {done}/{total} in {time.perf_counter() - started:.1f}s")
+
+def generate(args):
+    os.makedirs(args.directory, exist_ok=True)
+    os.chdir(args.directory)
+    if os.path.exists("db.sqlite"):
+        sys.exit(f"{os.path.abspath('db.sqlite')} already exists; use an empty directory")
+
+    import main
+    main.init_db()
+    rng = random.Random(args.seed)
+    today = date.today()
+    history_start = today - timedelta(days=3 * 365)
+
+    template_dir = os.path.join(main.TEMPLATE_DIR, "load")
+    os.makedirs(template_dir, exist_ok=True)
+    with open(os.path.join(template_dir, "invoice.html"), "w", encoding="utf-8") as f:
+        f.write(TEMPLATE_HTML)
+    with open(os.path.join(template_dir, "style.css"), "w", encoding="utf-8") as f:
+        f.write(TEMPLATE_CSS)
+
+    with main.db() as conn:
+        conn.execute("INSERT INTO templates (name, template_dir, html_filename, css_filename, fields) VALUES (?, ?, ?, ?, ?)",
+                     ("Load test", "load", "invoice.html", "style.css", "[]"))
+        template_id = conn.execute("SELECT MAX(id) FROM templates").fetchone()[0]
+        partner_ids = [row[0] for row in conn.execute("SELECT id FROM partners ORDER BY id")] or [1, 2]
+        first_client = (conn.execute("SELECT COALESCE(MAX(id), 0) FROM clients").fetchone()[0]) + 1
+
+        def clients():
+            for i in range(args.clients):
+                cap, city = rng.choice(CITIES)
+                yield (f"Client {i} AG", f"Musterstrasse {1 + i % 200}", cap, city, "CH", f"billing{i}@example.ch")
+
+        insert_chunks(conn, "INSERT INTO clients (name, address, cap, city, nation, email) VALUES (?, ?, ?, ?, ?, ?)",
+                      clients(), args.clients, "clients")
+        client_ids = range(first_client, first_client + args.clients)
+
+        # One recurring fee for roughly every third client, so renewals have data
+        fee_rows = []
+        for client_id in client_ids:
+            if rng.random() < 0.35:
+                frequency = rng.choice(FREQUENCIES)
+                fee_rows.append((client_id, rng.choice([50, 120, 300, 900, 2400]), frequency,
+                                 random_day(rng, history_start, 3 * 365), f"{frequency.title()} hosting",
+                                 today.isoformat()))
+        conn.executemany("""INSERT INTO recurring_fees (client_id, amount, frequency, start_date, description, last_generated_until)
+                            VALUES (?, ?, ?, ?, ?, ?)""", fee_rows)
+        conn.commit()
+        fee_ids = [row[0] for row in conn.execute("SELECT id FROM recurring_fees ORDER BY id")]
+
+        def invoices():
+            for i in range(args.invoices):
+                items = [{"desc": f"Service {n}", "qty": rng.randint(1, 10), "price": rng.choice([80, 95, 120, 150, 250])}
+                         for n in range(rng.randint(1, 8))]
+                invoice_date = random_day(rng, history_start, 3 * 365)
+                total = sum(item["qty"] * item["price"] for item in items)
+                status = rng.choices(["draft", "sent", "paid"], weights=[1, 2, 7])[0]
+                sent_date = invoice_date if status != "draft" else None
+                paid_date = random_day(rng, date.fromisoformat(invoice_date), 60) if status == "paid" else None
+                share = rng.choice([50.0, 60.0, 70.0])
+                yield (f"LOAD-{i + 1:07d}", rng.choice(client_ids), template_id,
+                       json.dumps({"items": items, "date": invoice_date, "notes": ""}),
+                       share, 100 - share, status, total, sent_date, paid_date, f"Invoice {i + 1}", "")
+
+        insert_chunks(conn, """INSERT INTO invoices (invoice_number, client_id, template_id, data, partner_a_share, partner_b_share,
+                                                     status, total_amount, sent_date, paid_date, title, description)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                      invoices(), args.invoices, "invoices")
+
+        def payment_events():
+            horizon = today + timedelta(days=365)
+            span = (horizon - history_start).days
+            fee_dates = set()  # (recurring_fee_id, due_date) is unique
+            for i in range(args.payment_events):
+                due_date = random_day(rng, history_start, span)
+                past = due_date < today.isoformat()
+                status = rng.choices(["paid", "sent", "not_sent"], weights=[8, 1, 1])[0] if past else "not_sent"
+                fee_id = rng.choice(fee_ids) if fee_ids and rng.random() < 0.5 else None
+                if fee_id is not None:
+                    if (fee_id, due_date) in fee_dates:
+                        fee_id = None
+                    else:
+                        fee_dates.add((fee_id, due_date))
+                yield (rng.choice(client_ids), fee_id, rng.choice([50, 120, 300, 900]), "CHF", due_date,
+                       f"Payment {i + 1}", status, due_date if status == "paid" else None)
+
+        insert_chunks(conn, """INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status, paid_date)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                      payment_events(), args.payment_events, "payment events")
+
+        def expenses():
+            for i in range(args.expenses):
+                expense_type = rng.choices(["shared", "personal"], weights=[4, 1])[0]
+                yield (random_day(rng, history_start, 3 * 365), f"Expense {i + 1}", round(rng.uniform(5, 800), 2), "CHF",
+                       rng.choice(CATEGORIES), expense_type, rng.choice(partner_ids), 50.0, 50.0,
+                       rng.choices(["pending", "settled"], weights=[1, 3])[0])
+
+        insert_chunks(conn, """INSERT INTO expenses (date, description, amount, currency, category, expense_type, paid_by,
+                                                     split_ratio_a, split_ratio_b, status)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                      expenses(), args.expenses, "expenses")
+
+        conn.execute("DELETE FROM outbox")
+        conn.commit()
+        conn.execute("ANALYZE")
+    print(f"Database ready: {os.path.abspath('db.sqlite')}")
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory", help="empty directory to create db.sqlite and templates/ in")
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--invoices", type=int, default=200000)
+    parser.add_argument("--payment-events", type=int, default=1000000)
+    parser.add_argument("--expenses", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1)
+    generate(parser.parse_args())
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,181 @@
+"""Replay a weighted mix of API calls and report throughput and latency percentiles per route.
+
+Point it at a directory filled by benchmarks/generate_data.py. By default the
+app runs in-process (main.app through httpx's ASGI transport, with its
+lifespan, so render workers run too); with --url the requests go to a running
+server instead, e.g. one started in that directory with
+`uvicorn main:app --app-dir /path/to/backend --workers 4`. Run from the
+backend directory:
+
+    python benchmarks/load_test.py DIRECTORY [--url http://localhost:8000]
+        [--concurrency 16] [--duration 30 | --requests N] [--output result.json]
+
+The mix covers dashboard loads, list views, single reads, invoice creates and
+status changes; --mix name=weight,... overrides individual weights (0 drops a
+route). In-process numbers include the driver, which shares the event loop
+with the app.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+# --output is relative to where the script was started
+INVOCATION_DIR = os.getcwd()
+
+ITEMS_JSON = json.dumps({"items": [{"desc": "Load test service", "qty": 2, "price": 120},
+                                   {"desc": "Support", "qty": 1, "price": 80}],
+                         "date": "2026-03-01", "notes": ""})
+
+def build_mix(ids, async_render):
+    """name -> (weight, function(rng) returning (method, url, request kwargs))."""
+    client_ids, max_invoice_id, template_id = ids["client_ids"], ids["max_invoice_id"], ids["template_id"]
+    invoice_url = "/invoices?async_render=true" if async_render else "/invoices"
+    return {
+        "GET /dashboard/stats": (10, lambda rng: ("GET", "/dashboard/stats", {"params": {"period": rng.choice(["all", "year", "month"])}})),
+        "GET /dashboard/outstanding": (5, lambda rng: ("GET", "/dashboard/outstanding", {})),
+        "GET /dashboard/renewals": (4, lambda rng: ("GET", "/dashboard/renewals", {})),
+        "GET /dashboard/partner-earnings": (4, lambda rng: ("GET", "/dashboard/partner-earnings", {})),
+        "GET /invoices": (10, lambda rng: ("GET", "/invoices", {"params": {"limit": 50, "client_id": rng.choice(client_ids)}})),
+        "GET /invoices/{id}": (8, lambda rng: ("GET", f"/invoices/{rng.randint(1, max_invoice_id)}", {})),
+        "GET /payment-events": (10, lambda rng: ("GET", "/payment-events", {"params": {"limit": 50, "status": rng.choice(["not_sent", "sent", "paid"])}})),
+        "GET /expenses": (5, lambda rng: ("GET", "/expenses", {"params": {"limit": 50}})),
+        "GET /clients": (6, lambda rng: ("GET", "/clients", {"params": {"limit": 50}})),
+        "POST /invoices": (3, lambda rng: ("POST", invoice_url, {"data": {
+            "client_id": rng.choice(client_ids), "template_id": template_id, "data": ITEMS_JSON, "title": "Load test"}})),
+        "PUT /invoices/{id}/status": (5, lambda rng: ("PUT", f"/invoices/{rng.randint(1, max_invoice_id)}/status",
+                                                      {"json": {"status": rng.choice(["sent", "paid"])}})),
+    }
+
+def read_ids(directory):
+    conn = sqlite3.connect(f"file:{os.path.join(directory, 'db.sqlite')}?mode=ro", uri=True)
+    try:
+        client_ids = [row[0] for row in conn.execute("SELECT id FROM clients")]
+        max_invoice_id = conn.execute("SELECT COALESCE(MAX(id), 1) FROM invoices").fetchone()[0]
+        template_id = conn.execute("SELECT MAX(id) FROM templates").fetchone()[0]
+    finally:
+        conn.close()
+    if not client_ids or template_id is None:
+        sys.exit(f"No clients or templates in {directory}; fill it with benchmarks/generate_data.py first")
+    return {"client_ids": client_ids, "max_invoice_id": max_invoice_id, "template_id": template_id}
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+async def drive(client, mix, args):
+    names = [name for name, (weight, _) in mix.items() if weight > 0]
+    weights = [mix[name][0] for name in names]
+    samples = {name: [] for name in names}  # name -> [(seconds, status)]
+    deadline = time.perf_counter() + args.duration
+    remaining = [args.requests]
+
+    async def worker(worker_id):
+        rng = random.Random(args.seed * 1000 + worker_id)
+        while True:
+            if args.requests:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            elif time.perf_counter() >= deadline:
+                return
+            name = rng.choices(names, weights)[0]
+            method, url, kwargs = mix[name][1](rng)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 0
+            samples[name].append((time.perf_counter() - started, status))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+    return samples, time.perf_counter() - started
+
+def report(samples, elapsed):
+    routes = {}
+    for name, values in sorted(samples.items()):
+        if not values:
+            continue
+        latencies = sorted(seconds * 1000 for seconds, _ in values)
+        routes[name] = {
+            "requests": len(values),
+            "errors": sum(1 for _, status in values if not 200 <= status < 400),
+            "throughput_rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 0.50), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "max_ms": round(latencies[-1], 3),
+        }
+    total = sum(route["requests"] for route in routes.values())
+    print(f"\n{'route':<32} {'requests':>8} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, route in routes.items():
+        print(f"{name:<32} {route['requests']:>8} {route['errors']:>7} {route['throughput_rps']:>8.1f}"
+              f" {route['p50_ms']:>9.2f} {route['p95_ms']:>9.2f} {route['p99_ms']:>9.2f}")
+    print(f"{'total':<32} {total:>8} {sum(r['errors'] for r in routes.values()):>7} {total / elapsed:>8.1f}"
+          f"   ({elapsed:.1f}s)")
+    return {"elapsed_seconds": round(elapsed, 3), "requests": total,
+            "throughput_rps": round(total / elapsed, 2), "routes": routes}
+
+async def run_in_process(directory, mix, args):
+    os.chdir(directory)
+    import main
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+            return await drive(client, mix, args)
+
+async def run_over_http(mix, args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        return await drive(client, mix, args)
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory", help="directory created by benchmarks/generate_data.py")
+    parser.add_argument("--url", help="base URL of a running server (default: run the app in-process)")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run (ignored with --requests)")
+    parser.add_argument("--requests", type=int, help="stop after this many requests instead")
+    parser.add_argument("--mix", default="", help="weight overrides, e.g. 'POST /invoices=0,GET /clients=20'")
+    parser.add_argument("--async-render", action="store_true", help="create invoices with async_render=true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    directory = os.path.abspath(args.directory)
+    mix = build_mix(read_ids(directory), args.async_render)
+    for override in filter(None, args.mix.split(",")):
+        name, weight = override.rsplit("=", 1)
+        if name.strip() not in mix:
+            sys.exit(f"Unknown route {name.strip()!r}; known: {', '.join(mix)}")
+        mix[name.strip()] = (float(weight), mix[name.strip()][1])
+
+    if args.url:
+        samples, elapsed = asyncio.run(run_over_http(mix, args))
+    else:
+        samples, elapsed = asyncio.run(run_in_process(directory, mix, args))
+    result = report(samples, elapsed)
+
+    if args.output:
+        result["meta"] = {"timestamp": datetime.now().isoformat(timespec="seconds"), "target": args.url or "in-process",
+                          "concurrency": args.concurrency, "directory": directory}
+        with open(os.path.join(INVOCATION_DIR, args.output), "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    run()
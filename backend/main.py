@@ -2,236 +2,1285 @@ import os
 import re
 import json
 import sqlite3
+import queue
 import base64
+import csv
 import io
 import shutil
 import secrets
+import hashlib
+import asyncio
+import threading
+import functools
+import contextvars
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from decimal import Decimal
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Body
-from fastapi.responses import FileResponse
+from time import perf_counter
+from urllib.parse import urlparse, unquote
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Body, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateNotFound
 from weasyprint import HTML
+from weasyprint.text.fonts import FontConfiguration
+from weasyprint.urls import URLFetcher, URLFetcherResponse
 from qrbill import QRBill
 from svglib.svglib import svg2rlg
 from reportlab.graphics import renderPM
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    global render_jobs_wakeup
+    init_db()
+    requeue_stale_render_jobs()
+    # An asyncio.Event belongs to the loop that first waits on it, so each lifespan gets its own
+    render_jobs_wakeup = asyncio.Event()
+    workers = [asyncio.create_task(render_job_worker()) for _ in range(RENDER_CONCURRENCY)]
+    if PAYMENT_EVENT_SCHEDULER_SECONDS > 0:
+        workers.append(asyncio.create_task(payment_event_scheduler()))
+    workers.append(asyncio.create_task(webhook_delivery_worker()))
+    yield
+    for worker in workers:
+        worker.cancel()
+    await close_http_clients()
+    close_db_pool()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
+# Prometheus metrics, kept in process memory and served as text by GET /metrics.
+# Each uvicorn worker has its own registry, so scrape every worker (or run one).
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def metric_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def metric_labels(names, values):
+    """{name="value",...} with values escaped as the text exposition format requires."""
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{metric_label_value(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{metric_labels(self.labels, label_values)} {value:g}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=METRIC_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.series = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        index = bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += seconds
+
+    @contextmanager
+    def time(self, *label_values):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((label_values, list(values)) for label_values, values in self.series.items())
+        for label_values, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{metric_labels(self.labels + ('le',), label_values + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{metric_labels(self.labels, label_values)} {values[-1]:.6f}")
+            lines.append(f"{self.name}_count{metric_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+http_request_seconds = Histogram("http_request_duration_seconds", "HTTP request latency by route.", ("method", "route", "status"))
+render_seconds = Histogram("invoice_render_seconds", "Time to render one invoice PDF, end to end.")
+render_stage_seconds = Histogram("invoice_render_stage_seconds", "Time spent in each invoice render stage.", ("stage",))
+sqlite_query_seconds = Histogram("sqlite_query_seconds", "Time spent executing SQLite statements (execute/executemany).", ("operation",))
+telegram_messages = Counter("telegram_messages_total", "Telegram sendMessage outcomes.", ("outcome",))
+webhook_batches = Counter("webhook_batches_total", "Webhook batch delivery outcomes.", ("outcome",))
+webhook_events = Counter("webhook_events_delivered_total", "Outbox events delivered to webhook endpoints.")
+
+class MetricsMiddleware:
+    """Times each HTTP request under its route template (e.g. /invoices/{invoice_id})."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(perf_counter() - started, scope["method"],
+                                         route.path if route is not None else "unmatched", status[0])
+
+app.add_middleware(MetricsMiddleware)
+
+# On-demand profiling: a request carrying PROFILE_SECRET in an X-Profile header or a
+# ?profile= query parameter is run under cProfile, and the stats are written to
+# PROFILE_DIR (readable with pstats, snakeviz, flameprof, ...). With PROFILE_SAMPLE_RATE
+# set to N, every Nth POST /invoices is profiled as well. One request is profiled at
+# a time; the newest PROFILES_KEPT profiles are kept.
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = int(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILES_KEPT = int(os.environ.get("PROFILES_KEPT", "200"))
+
+class RequestProfile:
+    """cProfile stats of one request: the event loop thread plus the render threads it used."""
+
+    def __init__(self, trigger):
+        import cProfile
+        from datetime import datetime
+        self.trigger = trigger
+        self.name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+        self.loop_profile = cProfile.Profile()
+        self.thread_profiles = []
+
+    def call_in_thread(self, fn, *args):
+        """Run fn under a profiler of its own; used for work handed to executor threads.
+
+        On Python 3.12+ cProfile is built on sys.monitoring: loop_profile already
+        sees every thread, and enabling a second profiler raises ValueError.
+        """
+        import cProfile
+        import sys
+        if sys.version_info >= (3, 12):
+            return fn(*args)
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return fn(*args)
+        finally:
+            profile.disable()
+            self.thread_profiles.append(profile)
+
+    def save(self, method, route, status, seconds):
+        import pstats
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stats = pstats.Stats(self.loop_profile)
+        for profile in self.thread_profiles:
+            stats.add(profile)
+        stats.dump_stats(os.path.join(PROFILE_DIR, f"{self.name}.prof"))
+        top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:15]
+        meta = {
+            "name": self.name,
+            "trigger": self.trigger,
+            "method": method,
+            "route": route,
+            "status": status,
+            "duration_ms": round(seconds * 1000, 1),
+            "top_cumulative": [
+                {"function": f"{filename}:{line}({function})", "calls": calls, "cumulative_ms": round(cumulative * 1000, 2)}
+                for (filename, line, function), (_, calls, _, cumulative, _) in top
+            ],
+        }
+        with open(os.path.join(PROFILE_DIR, f"{self.name}.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        prune_profiles()
+
+def prune_profiles():
+    names = sorted(filename[:-5] for filename in os.listdir(PROFILE_DIR) if filename.endswith(".json"))
+    for name in names[:-PROFILES_KEPT] if PROFILES_KEPT > 0 else names:
+        for extension in (".prof", ".json"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name + extension))
+            except FileNotFoundError:
+                pass
+
+def profiling_authorized(value):
+    import hmac
+    return bool(PROFILE_SECRET) and bool(value) and hmac.compare_digest(value.encode("utf-8"), PROFILE_SECRET.encode("utf-8"))
+
+# The profile of the request being handled, if it is being profiled
+current_profile = contextvars.ContextVar("current_profile", default=None)
+# cProfile cannot run two profilers on one thread (nor at all in parallel on 3.12+)
+profiling_lock = threading.Lock()
+invoice_creates_seen = 0
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def trigger(self, scope):
+        global invoice_creates_seen
+        if PROFILE_SECRET and not scope["path"].startswith("/profiles"):
+            headers = dict(scope["headers"])
+            requested = headers.get(b"x-profile", b"").decode("latin-1")
+            if not requested and b"profile=" in scope["query_string"]:
+                from urllib.parse import parse_qs
+                requested = parse_qs(scope["query_string"].decode("latin-1")).get("profile", [""])[0]
+            if profiling_authorized(requested):
+                return "requested"
+        if PROFILE_SAMPLE_RATE > 0 and scope["method"] == "POST" and scope["path"] == "/invoices":
+            invoice_creates_seen += 1
+            if invoice_creates_seen % PROFILE_SAMPLE_RATE == 0:
+                return "sampled"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        trigger = self.trigger(scope) if scope["type"] == "http" else None
+        if trigger is None or not profiling_lock.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(trigger)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"x-profile-id", profile.name.encode())]}
+            await send(message)
+
+        token = current_profile.set(profile)
+        started = perf_counter()
+        profile.loop_profile.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.loop_profile.disable()
+            current_profile.reset(token)
+            try:
+                route = scope.get("route")
+                profile.save(scope["method"], route.path if route is not None else scope["path"], status[0], perf_counter() - started)
+            except Exception as e:
+                print(f"Saving profile {profile.name} failed: {e}")
+            finally:
+                profiling_lock.release()
+
+app.add_middleware(ProfilingMiddleware)
+
 DB = "db.sqlite"
 TEMPLATE_DIR = "templates"
+RESULTS_DIR = "results"
+# Content-addressed store for files shared between invoice directories (uploaded logos);
+# invoice directories hold hardlinks into it.
+BLOB_DIR = os.environ.get("BLOB_DIR", "blobs")
+# Also write results/invoice_N/rendered.html next to the PDF
+RENDER_DEBUG = os.environ.get("RENDER_DEBUG") == "1"
 os.makedirs(TEMPLATE_DIR, exist_ok=True)
 
+# PDF rendering runs on its own bounded pool so a slow WeasyPrint render
+# never blocks the event loop serving the other endpoints.
+RENDER_CONCURRENCY = int(os.environ.get("RENDER_CONCURRENCY", "2"))
+render_executor = ThreadPoolExecutor(max_workers=RENDER_CONCURRENCY, thread_name_prefix="render")
+# Each WeasyPrint render can take hundreds of MB, so requests are admitted up front:
+# at most RENDER_MAX_QUEUE synchronous renders wait for one of the RENDER_CONCURRENCY
+# slots and at most RENDER_MAX_QUEUED_JOBS background jobs wait in render_jobs; past
+# that the request is refused with 429 before anything is saved. A render that
+# outlives RENDER_TIMEOUT_SECONDS answers 504 (the PDF is still written when it ends).
+RENDER_MAX_QUEUE = int(os.environ.get("RENDER_MAX_QUEUE", "16"))
+RENDER_MAX_QUEUED_JOBS = int(os.environ.get("RENDER_MAX_QUEUED_JOBS", "500"))
+RENDER_TIMEOUT_SECONDS = float(os.environ.get("RENDER_TIMEOUT_SECONDS", "120"))
+
+# Background render jobs (POST/PUT /invoices?async_render=true) are picked up
+# from the render_jobs table; workers also poll so jobs queued by another
+# uvicorn worker or left over from a restart are not forgotten.
+RENDER_JOB_POLL_SECONDS = float(os.environ.get("RENDER_JOB_POLL_SECONDS", "5"))
+RENDER_JOB_STALE_SECONDS = int(os.environ.get("RENDER_JOB_STALE_SECONDS", "600"))
+render_jobs_wakeup = asyncio.Event()
+
+# Recurring fees get payment events up to PAYMENT_EVENT_HORIZON_DAYS ahead (plus the
+# next occurrence beyond). With PAYMENT_EVENT_SCHEDULER_SECONDS set, each worker runs
+# the generator on that interval; a lease in scheduler_locks lets only one of them run it.
+PAYMENT_EVENT_HORIZON_DAYS = int(os.environ.get("PAYMENT_EVENT_HORIZON_DAYS", "0"))
+PAYMENT_EVENT_SCHEDULER_SECONDS = float(os.environ.get("PAYMENT_EVENT_SCHEDULER_SECONDS", "0"))
+SCHEDULER_OWNER = f"{os.getpid()}-{secrets.token_hex(4)}"
+SCHEDULER_RUNS_KEPT = 500
+
+# Telegram notifications go through one pooled HTTP client. At most
+# TELEGRAM_CONCURRENCY requests are in flight, and token buckets keep below
+# Telegram's limits (about 30 messages/s per bot and 1 per second per chat).
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+TELEGRAM_CONCURRENCY = int(os.environ.get("TELEGRAM_CONCURRENCY", "8"))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_MAX_RETRIES = 3
+# Telegram rejects longer messages; digests are split at alert boundaries
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Webhooks: triggers write invoice and payment event changes to the outbox table
+# in the same transaction; a background worker posts them to each registered
+# endpoint in order, WEBHOOK_BATCH_SIZE events per request, backing off
+# exponentially (up to WEBHOOK_MAX_BACKOFF_SECONDS) while an endpoint fails.
+WEBHOOK_POLL_SECONDS = float(os.environ.get("WEBHOOK_POLL_SECONDS", "2"))
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", "100"))
+WEBHOOK_CONCURRENCY = int(os.environ.get("WEBHOOK_CONCURRENCY", "4"))
+WEBHOOK_TIMEOUT_SECONDS = float(os.environ.get("WEBHOOK_TIMEOUT_SECONDS", "10"))
+WEBHOOK_MAX_BACKOFF_SECONDS = float(os.environ.get("WEBHOOK_MAX_BACKOFF_SECONDS", "3600"))
+
+# Compiled Jinja templates are kept in an LRU keyed by template id and the
+# HTML file's mtime/size. JINJA_BYTECODE_CACHE_DIR additionally persists the
+# compiled bytecode so freshly started workers skip compilation too.
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE", "64"))
+JINJA_BYTECODE_CACHE_DIR = os.environ.get("JINJA_BYTECODE_CACHE_DIR")
+
+# QR-bill SVGs are content-addressed by the sha256 of the QRBill arguments:
+# recent ones stay in memory and QR_CACHE_DISK_SIZE files are kept on disk, so
+# a re-render or another worker process reuses them instead of regenerating.
+QR_CACHE_DIR = os.environ.get("QR_CACHE_DIR", os.path.join("cache", "qr"))
+QR_CACHE_SIZE = int(os.environ.get("QR_CACHE_SIZE", "256"))
+QR_CACHE_DISK_SIZE = int(os.environ.get("QR_CACHE_DISK_SIZE", "10000"))
+
+# Rows fetched per round trip by the /export endpoints
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", "500"))
+
+# Invoice numbers: "random" (8 characters, the historic look), "yearly" (2026-000123)
+# or "template" (per-template prefix and sequence). A block size above 1 lets each
+# worker reserve that many numbers per round trip, at the cost of gaps on restart.
+INVOICE_NUMBER_FORMAT = os.environ.get("INVOICE_NUMBER_FORMAT", "random")
+INVOICE_NUMBER_BLOCK_SIZE = int(os.environ.get("INVOICE_NUMBER_BLOCK_SIZE", "1"))
+
+# Connections are pooled and tuned once instead of opened per request.
+# WAL lets dashboard reads proceed while an invoice is being written.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "20000"))
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL")
+# Every statement run through db() is aggregated by normalized SQL (GET /debug/queries);
+# one taking longer than SLOW_QUERY_MS (execute plus fetches) is logged with its query
+# plan. Past QUERY_STATS_MAX distinct statements, new ones are counted under "(other)".
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "200"))
+QUERY_STATS_MAX = int(os.environ.get("QUERY_STATS_MAX", "1000"))
+SLOW_QUERIES_KEPT = 100
+db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+# normalized SQL -> [executions, total seconds, max seconds, rows fetched]
+query_stats = {}
+query_stats_lock = threading.Lock()
+slow_queries = deque(maxlen=SLOW_QUERIES_KEPT)
+
+class TimedCursor(sqlite3.Cursor):
+    """Times statements and their fetches for sqlite_query_seconds and query_stats.
+
+    sqlite_query_seconds covers execute/executemany (up to the first row);
+    query_stats and the slow-query log also add the time and rows of the
+    fetchone/fetchmany/fetchall calls that follow. Rows read by iterating the
+    cursor are not counted.
+    """
+
+    statement = None
+    parameters = ()
+    stats = None
+    statement_seconds = 0.0
+    logged_slow = False
+
+    def execute(self, sql, parameters=()):
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.finished_execute(sql, parameters, perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.finished_execute(sql, None, perf_counter() - started)
+
+    def finished_execute(self, sql, parameters, seconds):
+        sqlite_query_seconds.observe(seconds, sql_operation(sql))
+        self.statement = sql
+        self.parameters = parameters
+        self.stats = query_stats_entry(sql)
+        self.statement_seconds = 0.0
+        self.logged_slow = False
+        self.account(seconds, 0, 1)
+
+    def fetchone(self):
+        started = perf_counter()
+        row = super().fetchone()
+        self.account(perf_counter() - started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        started = perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.account(perf_counter() - started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = perf_counter()
+        rows = super().fetchall()
+        self.account(perf_counter() - started, len(rows))
+        return rows
+
+    def account(self, seconds, rows, executions=0):
+        entry = self.stats
+        if entry is None:
+            return
+        self.statement_seconds += seconds
+        with query_stats_lock:
+            entry[0] += executions
+            entry[1] += seconds
+            if self.statement_seconds > entry[2]:
+                entry[2] = self.statement_seconds
+            entry[3] += rows
+        if self.statement_seconds * 1000 >= SLOW_QUERY_MS and not self.logged_slow:
+            self.logged_slow = True
+            log_slow_query(self.connection, self.statement, self.parameters, self.statement_seconds)
+
+def query_stats_entry(sql):
+    """The query_stats entry of a statement, created on first use."""
+    key = normalize_sql(sql)
+    entry = query_stats.get(key)
+    if entry is None:
+        with query_stats_lock:
+            if key not in query_stats and len(query_stats) >= QUERY_STATS_MAX:
+                key = "(other)"
+            entry = query_stats.setdefault(key, [0, 0.0, 0.0, 0])
+    return entry
+
+def log_slow_query(conn, sql, parameters, seconds):
+    from datetime import datetime
+    plan = []
+    # executemany has no single set of parameters to explain with
+    if parameters is not None and sql_operation(sql) in ("select", "insert", "update", "delete", "with", "replace"):
+        try:
+            plan = [row[3] for row in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()]
+        except sqlite3.Error:
+            pass
+    print(f"Slow query ({seconds * 1000:.0f} ms): {' '.join(sql.split())}" + "".join(f"\n    {step}" for step in plan))
+    slow_queries.append({
+        "at": datetime.now().isoformat(timespec="seconds"),
+        "duration_ms": round(seconds * 1000, 2),
+        "sql": normalize_sql(sql),
+        "plan": plan,
+    })
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+SQL_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+SQL_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+SQL_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    """Collapse whitespace and replace literals and ?-lists, so one query shape is one key."""
+    sql = SQL_STRING_LITERAL.sub("?", sql)
+    sql = SQL_NUMBER_LITERAL.sub("?", sql)
+    sql = " ".join(sql.split())
+    return SQL_VALUE_LIST.sub("(?, ...)", sql)
+
+@functools.lru_cache(maxsize=1024)
+def sql_operation(sql):
+    """First keyword of a statement, lowercased: select, insert, update, ..."""
+    word = sql.lstrip().split(None, 1)
+    return word[0].lower() if word else "other"
+
+def connect_db():
+    conn = sqlite3.connect(DB, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False, factory=TimedConnection)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    return conn
+
+@contextmanager
 def db():
-    return sqlite3.connect(DB)
+    """Borrow a pooled connection; commits on success, rolls back on error, then returns it."""
+    try:
+        conn = db_pool.get_nowait()
+    except queue.Empty:
+        conn = connect_db()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def close_db_pool():
+    while True:
+        try:
+            conn = db_pool.get_nowait()
+        except queue.Empty:
+            return
+        conn.close()
+
+def migrate_base_schema(c):
+    """Tables, seed rows and columns added before schema versioning existed."""
+    c.execute('''CREATE TABLE IF NOT EXISTS clients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT, address TEXT, cap TEXT, city TEXT, nation TEXT, email TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS templates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT, template_dir TEXT, html_filename TEXT, css_filename TEXT, fields TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS invoices (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        invoice_number TEXT UNIQUE,
+        client_id INTEGER, template_id INTEGER, data TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS bank_details (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        iban TEXT, bank_name TEXT, bank_address TEXT, bic TEXT,
+        creditor_name TEXT, creditor_street TEXT, creditor_postalcode TEXT,
+        creditor_city TEXT, creditor_country TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS recurring_fees (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id INTEGER,
+        amount REAL,
+        currency TEXT DEFAULT 'CHF',
+        frequency TEXT,
+        start_date TEXT,
+        description TEXT,
+        FOREIGN KEY (client_id) REFERENCES clients(id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS payment_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id INTEGER,
+        recurring_fee_id INTEGER,
+        amount REAL,
+        currency TEXT DEFAULT 'CHF',
+        due_date TEXT,
+        description TEXT,
+        status TEXT DEFAULT 'not_sent',
+        invoice_id INTEGER,
+        paid_date TEXT,
+        FOREIGN KEY (client_id) REFERENCES clients(id),
+        FOREIGN KEY (recurring_fee_id) REFERENCES recurring_fees(id),
+        FOREIGN KEY (invoice_id) REFERENCES invoices(id)
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS partners (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        default_share REAL DEFAULT 50.0,
+        telegram_chat_id TEXT,
+        color TEXT DEFAULT '#4a90e2'
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS expenses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT NOT NULL,
+        description TEXT NOT NULL,
+        amount REAL NOT NULL,
+        currency TEXT DEFAULT 'CHF',
+        category TEXT NOT NULL,
+        expense_type TEXT NOT NULL,
+        paid_by INTEGER NOT NULL,
+        split_ratio_a REAL DEFAULT 50.0,
+        split_ratio_b REAL DEFAULT 50.0,
+        receipt_path TEXT,
+        status TEXT DEFAULT 'pending',
+        notes TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (paid_by) REFERENCES partners(id)
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS settlements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_partner_id INTEGER NOT NULL,
+        to_partner_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        currency TEXT DEFAULT 'CHF',
+        date TEXT NOT NULL,
+        description TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (from_partner_id) REFERENCES partners(id),
+        FOREIGN KEY (to_partner_id) REFERENCES partners(id)
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS telegram_config (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        bot_token TEXT,
+        enabled INTEGER DEFAULT 0,
+        notify_renewals_7d INTEGER DEFAULT 1,
+        notify_renewals_14d INTEGER DEFAULT 1,
+        notify_renewals_30d INTEGER DEFAULT 0,
+        notify_overdue INTEGER DEFAULT 1
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS notifications_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        type TEXT NOT NULL,
+        reference_id INTEGER,
+        sent_at TEXT NOT NULL,
+        chat_id TEXT NOT NULL
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS todos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        description TEXT,
+        due_date TEXT,
+        priority TEXT DEFAULT 'medium',
+        status TEXT DEFAULT 'pending',
+        client_id INTEGER,
+        invoice_id INTEGER,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        completed_at TEXT,
+        FOREIGN KEY (client_id) REFERENCES clients(id),
+        FOREIGN KEY (invoice_id) REFERENCES invoices(id)
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS calendar_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        description TEXT,
+        start_datetime TEXT NOT NULL,
+        end_datetime TEXT,
+        all_day INTEGER DEFAULT 0,
+        event_type TEXT DEFAULT 'appointment',
+        client_id INTEGER,
+        color TEXT DEFAULT '#4a90e2',
+        reminder_minutes INTEGER,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (client_id) REFERENCES clients(id)
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS render_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        invoice_id INTEGER NOT NULL,
+        status TEXT DEFAULT 'queued',
+        error TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        started_at TEXT,
+        finished_at TEXT,
+        FOREIGN KEY (invoice_id) REFERENCES invoices(id)
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS invoice_assets (
+        invoice_id INTEGER NOT NULL,
+        filename TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        PRIMARY KEY (invoice_id, filename),
+        FOREIGN KEY (sha256) REFERENCES blobs(sha256)
+    )''')
+
+    c.execute("SELECT COUNT(*) FROM bank_details")
+    if c.fetchone()[0] == 0:
+        c.execute('''INSERT INTO bank_details
+            (iban, bank_name, bank_address, bic, creditor_name, creditor_street, creditor_postalcode, creditor_city, creditor_country)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            ("CH5800791123000889012", "My Bank", "Bankstrasse 1", "POFICHBEXXX",
+             "My Company AG", "My Street 1", "8000", "Zurich", "CH"))
+
+    c.execute("SELECT COUNT(*) FROM partners")
+    if c.fetchone()[0] == 0:
+        c.execute("INSERT INTO partners (name, default_share, color) VALUES (?, ?, ?)", ("Partner A", 50.0, "#4a90e2"))
+        c.execute("INSERT INTO partners (name, default_share, color) VALUES (?, ?, ?)", ("Partner B", 50.0, "#10b981"))
+
+    c.execute("SELECT COUNT(*) FROM telegram_config")
+    if c.fetchone()[0] == 0:
+        c.execute("INSERT INTO telegram_config (id, enabled) VALUES (1, 0)")
+
+    c.execute("PRAGMA table_info(invoices)")
+    columns = [col[1] for col in c.fetchall()]
+    if "invoice_number" not in columns:
+        # Numbered from the sequence by the invoice number backfill step
+        c.execute("ALTER TABLE invoices ADD COLUMN invoice_number TEXT")
+
+    if "partner_a_share" not in columns:
+        c.execute("ALTER TABLE invoices ADD COLUMN partner_a_share REAL DEFAULT 50.0")
+    if "partner_b_share" not in columns:
+        c.execute("ALTER TABLE invoices ADD COLUMN partner_b_share REAL DEFAULT 50.0")
+    if "status" not in columns:
+        c.execute("ALTER TABLE invoices ADD COLUMN status TEXT DEFAULT 'draft'")
+    if "sent_date" not in columns:
+        c.execute("ALTER TABLE invoices ADD COLUMN sent_date TEXT")
+    if "paid_date" not in columns:
+        c.execute("ALTER TABLE invoices ADD COLUMN paid_date TEXT")
+    if "total_amount" not in columns:
+        c.execute("ALTER TABLE invoices ADD COLUMN total_amount REAL")
+    if "title" not in columns:
+        c.execute("ALTER TABLE invoices ADD COLUMN title TEXT")
+    if "description" not in columns:
+        c.execute("ALTER TABLE invoices ADD COLUMN description TEXT")
+
+    c.execute("PRAGMA table_info(recurring_fees)")
+    rf_columns = [col[1] for col in c.fetchall()]
+    if "service_type" not in rf_columns:
+        c.execute("ALTER TABLE recurring_fees ADD COLUMN service_type TEXT DEFAULT 'other'")
+
+def migrate_hot_path_indexes(c):
+    """Indexes for the lookups the endpoints run on every request."""
+    from itertools import groupby
+
+    # Recurring fees may already have produced duplicate occurrences. Extra copies
+    # that were never sent or invoiced are dropped; anything else needs a person.
+    c.execute("""
+        SELECT p.id, p.recurring_fee_id, p.due_date, p.status, p.invoice_id FROM payment_events p
+        JOIN (SELECT recurring_fee_id, due_date FROM payment_events WHERE recurring_fee_id IS NOT NULL
+              GROUP BY recurring_fee_id, due_date HAVING COUNT(*) > 1) d
+          ON d.recurring_fee_id = p.recurring_fee_id AND d.due_date = p.due_date
+        ORDER BY p.recurring_fee_id, p.due_date, p.status = 'paid' DESC, p.invoice_id IS NOT NULL DESC,
+                 p.status NOT IN ('not_sent', 'pending') DESC, p.id
+    """)
+    removed = []
+    conflicts = []
+    for _, group in groupby(c.fetchall(), key=lambda row: (row[1], row[2])):
+        keep, *extra = group
+        for event_id, _, _, status, invoice_id in extra:
+            if invoice_id is None and status in ("not_sent", "pending"):
+                removed.append(event_id)
+            else:
+                conflicts.append(f"{event_id} (duplicates {keep[0]})")
+    if conflicts:
+        raise RuntimeError(
+            "payment_events has sent, paid or invoiced duplicates of one recurring fee occurrence: "
+            + ", ".join(conflicts) + ". Merge or delete them, then restart to apply the migration."
+        )
+    if removed:
+        c.executemany("DELETE FROM payment_events WHERE id=?", [(event_id,) for event_id in removed])
+        print(f"Removed duplicate unsent payment events: {', '.join(map(str, removed))}")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_events_fee_due ON payment_events (recurring_fee_id, due_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payment_events_client_status ON payment_events (client_id, status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payment_events_due_date ON payment_events (due_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_status_paid_date ON invoices (status, paid_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_client_id ON invoices (client_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifications_log_ref ON notifications_log (type, reference_id, sent_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses (date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_expenses_status ON expenses (status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_render_jobs_status ON render_jobs (status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_render_jobs_invoice_id ON render_jobs (invoice_id)")
+
+def migrate_pagination_indexes(c):
+    """Indexes matching the sort keys of the paginated list endpoints."""
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payment_events_client_due ON payment_events (client_id, COALESCE(due_date, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payment_events_status_due ON payment_events (status, COALESCE(due_date, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_settlements_date ON settlements (date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_calendar_events_start ON calendar_events (start_datetime)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_todos_client_id ON todos (client_id)")
+
+# dashboard_rollup holds one row per (source, month, status) with the counts and
+# sums the dashboard needs. Triggers on invoices and expenses keep it current in
+# the same transaction as the write, whichever endpoint performs it.
+# Invoices are bucketed by paid_date, expenses by date; month is "YYYY-MM".
+ROLLUP_INVOICE_COLUMNS = (
+    "'invoice'", "substr(COALESCE({row}.paid_date, ''), 1, 7)", "COALESCE({row}.status, '')",
+    "1", "COALESCE({row}.total_amount, 0)",
+    "COALESCE({row}.total_amount * {row}.partner_a_share / 100.0, 0)",
+    "COALESCE({row}.total_amount * {row}.partner_b_share / 100.0, 0)",
+)
+ROLLUP_EXPENSE_COLUMNS = (
+    "'expense'", "substr(COALESCE({row}.date, ''), 1, 7)", "COALESCE({row}.status, '')",
+    "1", "COALESCE({row}.amount, 0)", "0", "0",
+)
+ROLLUP_TRACKED_COLUMNS = {
+    "invoices": (ROLLUP_INVOICE_COLUMNS, ["status", "paid_date", "total_amount", "partner_a_share", "partner_b_share"]),
+    "expenses": (ROLLUP_EXPENSE_COLUMNS, ["status", "date", "amount"]),
+}
+
+def rollup_upsert(columns, row, sign):
+    key = [expr.format(row=row) for expr in columns[:3]]
+    values = [f"{sign}({expr.format(row=row)})" for expr in columns[3:]]
+    return f"""
+        INSERT INTO dashboard_rollup (source, month, status, count, amount, partner_a, partner_b)
+        VALUES ({", ".join(key + values)})
+        ON CONFLICT (source, month, status) DO UPDATE SET
+            count = count + excluded.count,
+            amount = amount + excluded.amount,
+            partner_a = partner_a + excluded.partner_a,
+            partner_b = partner_b + excluded.partner_b;
+    """
+
+def rollup_snapshot_sql():
+    """Rollup rows computed from scratch, as (source, month, status, count, amount, partner_a, partner_b)."""
+    selects = []
+    for table, (columns, _) in ROLLUP_TRACKED_COLUMNS.items():
+        key = [expr.format(row=table) for expr in columns[:3]]
+        sums = [f"SUM({expr.format(row=table)})" for expr in columns[3:]]
+        selects.append(f"SELECT {', '.join(key + sums)} FROM {table} GROUP BY 1, 2, 3")
+    return " UNION ALL ".join(selects)
+
+def rebuild_dashboard_rollup(c):
+    c.execute("DELETE FROM dashboard_rollup")
+    c.execute(f"INSERT INTO dashboard_rollup (source, month, status, count, amount, partner_a, partner_b) {rollup_snapshot_sql()}")
+
+def migrate_dashboard_rollup(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS dashboard_rollup (
+        source TEXT NOT NULL,
+        month TEXT NOT NULL,
+        status TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        amount REAL NOT NULL DEFAULT 0,
+        partner_a REAL NOT NULL DEFAULT 0,
+        partner_b REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (source, month, status)
+    )""")
+    for table, (columns, tracked) in ROLLUP_TRACKED_COLUMNS.items():
+        changed = " OR ".join(f"OLD.{col} IS NOT NEW.{col}" for col in tracked)
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_rollup_insert AFTER INSERT ON {table}
+            BEGIN {rollup_upsert(columns, "NEW", "+")} END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_rollup_delete AFTER DELETE ON {table}
+            BEGIN {rollup_upsert(columns, "OLD", "-")} END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_rollup_update AFTER UPDATE OF {", ".join(tracked)} ON {table}
+            WHEN {changed}
+            BEGIN {rollup_upsert(columns, "OLD", "-")} {rollup_upsert(columns, "NEW", "+")} END""")
+    rebuild_dashboard_rollup(c)
+
+# Tables whose writes bump table_versions; GET endpoints derive their ETag from these.
+VERSIONED_TABLES = [
+    "clients", "templates", "partners", "bank_details",
+    "invoices", "expenses", "payment_events", "recurring_fees",
+]
+
+def migrate_table_versions(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS table_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )""")
+    for table in VERSIONED_TABLES:
+        c.execute("INSERT OR IGNORE INTO table_versions (name, version) VALUES (?, 0)", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}
+                BEGIN UPDATE table_versions SET version = version + 1 WHERE name = '{table}'; END""")
+
+def create_invoice_number_sequences(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS invoice_number_sequences (
+        scope TEXT PRIMARY KEY,
+        next_value INTEGER NOT NULL
+    )""")
+
+def migrate_invoice_numbers(c):
+    """Sequence table for the allocator, plus a UNIQUE index for databases whose
+    invoice_number column was added by ALTER TABLE (and so lacks the constraint)."""
+    create_invoice_number_sequences(c)
+    c.execute("PRAGMA table_info(templates)")
+    if "invoice_prefix" not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE templates ADD COLUMN invoice_prefix TEXT")
+    c.execute("""
+        SELECT id FROM invoices i
+        WHERE invoice_number IS NOT NULL
+          AND EXISTS (SELECT 1 FROM invoices o WHERE o.invoice_number = i.invoice_number AND o.id < i.id)
+    """)
+    duplicates = [row[0] for row in c.fetchall()]
+    if duplicates:
+        c.executemany("UPDATE invoices SET invoice_number=? WHERE id=?",
+                      zip(unused_random_invoice_numbers(c, len(duplicates)), duplicates))
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_invoice_number ON invoices (invoice_number)")
+
+def migrate_recurring_schedule(c):
+    """Columns for quarterly/semi-annual/custom intervals and end dates."""
+    c.execute("PRAGMA table_info(recurring_fees)")
+    rf_columns = [col[1] for col in c.fetchall()]
+    if "interval_months" not in rf_columns:
+        c.execute("ALTER TABLE recurring_fees ADD COLUMN interval_months INTEGER")
+    if "end_date" not in rf_columns:
+        c.execute("ALTER TABLE recurring_fees ADD COLUMN end_date TEXT")
+
+def migrate_payment_event_watermarks(c):
+    """Per-fee generation watermark, scheduler lease and run history."""
+    c.execute("PRAGMA table_info(recurring_fees)")
+    if "last_generated_until" not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE recurring_fees ADD COLUMN last_generated_until TEXT")
+        c.execute("""
+            UPDATE recurring_fees SET last_generated_until = (
+                SELECT MAX(due_date) FROM payment_events WHERE recurring_fee_id = recurring_fees.id
+            )
+        """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_recurring_fees_generated ON recurring_fees (last_generated_until)")
+    c.execute("""CREATE TABLE IF NOT EXISTS scheduler_locks (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at TEXT NOT NULL
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS scheduler_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        trigger TEXT NOT NULL,
+        started_at TEXT NOT NULL,
+        duration_ms REAL,
+        fees_scanned INTEGER,
+        rows_generated INTEGER,
+        error TEXT
+    )""")
+
+def migrate_telegram_digest(c):
+    c.execute("PRAGMA table_info(telegram_config)")
+    if "digest" not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE telegram_config ADD COLUMN digest INTEGER DEFAULT 0")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifications_log_sent_at ON notifications_log (sent_at)")
+
+# Columns copied into webhook payloads
+OUTBOX_INVOICE_COLUMNS = ["id", "invoice_number", "client_id", "template_id", "status", "total_amount",
+                          "partner_a_share", "partner_b_share", "sent_date", "paid_date", "title", "description"]
+OUTBOX_PAYMENT_EVENT_COLUMNS = ["id", "client_id", "recurring_fee_id", "amount", "currency", "due_date",
+                                "description", "status", "invoice_id", "paid_date"]
+
+def outbox_insert(event_type_sql, row, columns):
+    payload = ", ".join(f"'{col}', {row}.{col}" for col in columns)
+    return f"""
+        INSERT INTO outbox (event_type, payload, created_at)
+        VALUES ({event_type_sql}, json_object({payload}), datetime('now'));
+    """
+
+def migrate_webhook_outbox(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS webhook_endpoints (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT NOT NULL,
+        secret TEXT,
+        events TEXT DEFAULT '*',
+        enabled INTEGER DEFAULT 1,
+        last_delivered_id INTEGER NOT NULL DEFAULT 0,
+        failures INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT,
+        last_error TEXT,
+        last_success_at TEXT,
+        delivered_count INTEGER NOT NULL DEFAULT 0,
+        failed_attempts INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT
+    )""")
+
+    changed = lambda columns: " OR ".join(f"OLD.{col} IS NOT NEW.{col}" for col in columns)
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS invoices_outbox_insert AFTER INSERT ON invoices
+        BEGIN {outbox_insert("'invoice.created'", "NEW", OUTBOX_INVOICE_COLUMNS)} END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS invoices_outbox_status AFTER UPDATE ON invoices
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN {outbox_insert("'invoice.' || COALESCE(NEW.status, 'updated')", "NEW", OUTBOX_INVOICE_COLUMNS)} END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS invoices_outbox_update AFTER UPDATE ON invoices
+        WHEN OLD.status IS NEW.status AND ({changed(OUTBOX_INVOICE_COLUMNS)} OR OLD.data IS NOT NEW.data)
+        BEGIN {outbox_insert("'invoice.updated'", "NEW", OUTBOX_INVOICE_COLUMNS)} END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS invoices_outbox_delete AFTER DELETE ON invoices
+        BEGIN {outbox_insert("'invoice.deleted'", "OLD", OUTBOX_INVOICE_COLUMNS)} END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS payment_events_outbox_insert AFTER INSERT ON payment_events
+        BEGIN {outbox_insert("'payment_event.created'", "NEW", OUTBOX_PAYMENT_EVENT_COLUMNS)} END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS payment_events_outbox_update AFTER UPDATE ON payment_events
+        WHEN {changed(OUTBOX_PAYMENT_EVENT_COLUMNS)}
+        BEGIN {outbox_insert("'payment_event.updated'", "NEW", OUTBOX_PAYMENT_EVENT_COLUMNS)} END""")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS payment_events_outbox_delete AFTER DELETE ON payment_events
+        BEGIN {outbox_insert("'payment_event.deleted'", "OLD", OUTBOX_PAYMENT_EVENT_COLUMNS)} END""")
+
+def migrate_invoice_number_backfill(c):
+    """Number invoices still lacking an invoice_number from the "random" sequence."""
+    c.execute("SELECT id FROM invoices WHERE invoice_number IS NULL ORDER BY id")
+    invoice_ids = [row[0] for row in c.fetchall()]
+    if invoice_ids:
+        c.executemany("UPDATE invoices SET invoice_number=? WHERE id=?",
+                      zip(unused_random_invoice_numbers(c, len(invoice_ids)), invoice_ids))
+
+def migrate_recurring_anchors(c):
+    """Anchor fees whose generated history drifted off their start date's day of month.
+
+    Before the schedule engine each occurrence was one interval after the previous
+    one, so a fee starting on the 31st went on from the 28th after February. Such a
+    fee keeps following its last generated date instead of jumping back to the 31st
+    and billing twice in one month.
+    """
+    c.execute("PRAGMA table_info(recurring_fees)")
+    if "schedule_anchor" not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE recurring_fees ADD COLUMN schedule_anchor TEXT")
+    c.execute("""SELECT * FROM recurring_fees
+                 WHERE last_generated_until IS NOT NULL AND schedule_anchor IS NULL AND frequency != 'one-time'""")
+    anchors = []
+    for fee in rows_to_dicts(c, c.fetchall()):
+        start = parse_fee_date(fee["start_date"])
+        last = parse_fee_date(fee["last_generated_until"])
+        if start is None or last is None or last <= start:
+            continue
+        try:
+            if last not in fee_schedule(fee, last):
+                anchors.append((last.isoformat(), fee["id"]))
+        except ValueError:
+            continue
+    c.executemany("UPDATE recurring_fees SET schedule_anchor=? WHERE id=?", anchors)
+
+# Ordered schema migrations; append new steps, never edit or renumber applied ones.
+# Every step must be idempotent so a database created before versioning can run them.
+MIGRATIONS = [
+    (1, "base schema", migrate_base_schema),
+    (2, "hot-path indexes", migrate_hot_path_indexes),
+    (3, "pagination indexes", migrate_pagination_indexes),
+    (4, "dashboard rollup", migrate_dashboard_rollup),
+    (5, "table versions", migrate_table_versions),
+    (6, "invoice number sequences", migrate_invoice_numbers),
+    (7, "recurring fee schedules", migrate_recurring_schedule),
+    (8, "payment event watermarks", migrate_payment_event_watermarks),
+    (9, "telegram digest", migrate_telegram_digest),
+    (10, "webhook outbox", migrate_webhook_outbox),
+    (11, "invoice number backfill", migrate_invoice_number_backfill),
+    (12, "recurring fee anchors", migrate_recurring_anchors),
+]
 
 def init_db():
+    """Apply pending migrations; called once per process from the app lifespan."""
     with db() as conn:
         c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS clients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT, address TEXT, cap TEXT, city TEXT, nation TEXT, email TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS templates (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT, template_dir TEXT, html_filename TEXT, css_filename TEXT, fields TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS invoices (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            invoice_number TEXT UNIQUE,
-            client_id INTEGER, template_id INTEGER, data TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS bank_details (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            iban TEXT, bank_name TEXT, bank_address TEXT, bic TEXT,
-            creditor_name TEXT, creditor_street TEXT, creditor_postalcode TEXT,
-            creditor_city TEXT, creditor_country TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS recurring_fees (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            client_id INTEGER,
-            amount REAL,
-            currency TEXT DEFAULT 'CHF',
-            frequency TEXT,
-            start_date TEXT,
-            description TEXT,
-            FOREIGN KEY (client_id) REFERENCES clients(id)
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS payment_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            client_id INTEGER,
-            recurring_fee_id INTEGER,
-            amount REAL,
-            currency TEXT DEFAULT 'CHF',
-            due_date TEXT,
+        # journal_mode is persistent in the database file, so it only has to be set once
+        c.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+        c.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
             description TEXT,
-            status TEXT DEFAULT 'not_sent',
-            invoice_id INTEGER,
-            paid_date TEXT,
-            FOREIGN KEY (client_id) REFERENCES clients(id),
-            FOREIGN KEY (recurring_fee_id) REFERENCES recurring_fees(id),
-            FOREIGN KEY (invoice_id) REFERENCES invoices(id)
-        )''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS partners (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            default_share REAL DEFAULT 50.0,
-            telegram_chat_id TEXT,
-            color TEXT DEFAULT '#4a90e2'
-        )''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS expenses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT NOT NULL,
-            description TEXT NOT NULL,
-            amount REAL NOT NULL,
-            currency TEXT DEFAULT 'CHF',
-            category TEXT NOT NULL,
-            expense_type TEXT NOT NULL,
-            paid_by INTEGER NOT NULL,
-            split_ratio_a REAL DEFAULT 50.0,
-            split_ratio_b REAL DEFAULT 50.0,
-            receipt_path TEXT,
-            status TEXT DEFAULT 'pending',
-            notes TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (paid_by) REFERENCES partners(id)
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP
         )''')
+        conn.commit()
 
-        c.execute('''CREATE TABLE IF NOT EXISTS settlements (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            from_partner_id INTEGER NOT NULL,
-            to_partner_id INTEGER NOT NULL,
-            amount REAL NOT NULL,
-            currency TEXT DEFAULT 'CHF',
-            date TEXT NOT NULL,
-            description TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (from_partner_id) REFERENCES partners(id),
-            FOREIGN KEY (to_partner_id) REFERENCES partners(id)
-        )''')
+        # The write lock makes concurrently starting workers apply each step once
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        current_version = c.fetchone()[0]
+        for version, description, migrate in MIGRATIONS:
+            if version > current_version:
+                migrate(c)
+                c.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+        conn.commit()
 
-        c.execute('''CREATE TABLE IF NOT EXISTS telegram_config (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            bot_token TEXT,
-            enabled INTEGER DEFAULT 0,
-            notify_renewals_7d INTEGER DEFAULT 1,
-            notify_renewals_14d INTEGER DEFAULT 1,
-            notify_renewals_30d INTEGER DEFAULT 0,
-            notify_overdue INTEGER DEFAULT 1
-        )''')
+INVOICE_NUMBER_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+INVOICE_NUMBER_SPACE = 36 ** 8
+# Multiplier coprime with 36**8, so the mapping below is a bijection
+INVOICE_NUMBER_MULTIPLIER = 1743541808669
+INVOICE_NUMBER_OFFSET = 623145617
+
+def scramble_invoice_number(value):
+    """Map a sequence value to a random-looking 8-character code; distinct values give distinct codes."""
+    n = (value * INVOICE_NUMBER_MULTIPLIER + INVOICE_NUMBER_OFFSET) % INVOICE_NUMBER_SPACE
+    chars = []
+    for _ in range(8):
+        n, digit = divmod(n, 36)
+        chars.append(INVOICE_NUMBER_ALPHABET[digit])
+    return "".join(reversed(chars))
+
+def next_sequence_values(c, scope, count):
+    """Advance a sequence by count inside c's transaction and return the values taken."""
+    c.execute("""
+        INSERT INTO invoice_number_sequences (scope, next_value) VALUES (?, ?)
+        ON CONFLICT (scope) DO UPDATE SET next_value = next_value + ?
+        RETURNING next_value
+    """, (scope, 1 + count, count))
+    end = c.fetchone()[0]
+    return range(end - count, end)
+
+def unused_random_invoice_numbers(c, count):
+    """Take count "random" numbers for a migration, skipping ones already in the table.
+
+    Like allocate(), but checked against one read of the existing numbers, since
+    the unique index may not exist yet.
+    """
+    c.execute("SELECT invoice_number FROM invoices WHERE invoice_number IS NOT NULL")
+    taken = {row[0] for row in c.fetchall()}
+    numbers = []
+    while len(numbers) < count:
+        for value in next_sequence_values(c, "random", count - len(numbers)):
+            number = scramble_invoice_number(value)
+            if number not in taken:
+                numbers.append(number)
+    return numbers
+
+class InvoiceNumberAllocator:
+    """Issues invoice numbers from per-scope sequences in invoice_number_sequences.
+
+    Formats: "random" (8 characters, a fixed permutation of one global sequence),
+    "yearly" (2026-000123) and "template" (the template's invoice_prefix, or
+    "T<id>-", followed by a per-template sequence). With block_size 1 each value
+    is taken in the caller's transaction, so a rolled-back insert leaves no gap.
+    Larger blocks are reserved in a transaction of their own and handed out from
+    memory; in that mode allocate() must run before the caller's first write, and
+    values still unused when the process exits are skipped.
+    """
+
+    FORMATS = ("random", "yearly", "template")
+
+    def __init__(self, number_format="random", block_size=1):
+        if number_format not in self.FORMATS:
+            raise ValueError(f"Unknown invoice number format: {number_format}")
+        self.number_format = number_format
+        self.block_size = max(1, block_size)
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def allocate(self, c, template_id=None):
+        scope, prefix = self.scope(c, template_id)
+        while True:
+            value = self.next_value(c, scope)
+            if self.number_format != "random":
+                return f"{prefix}{value:06d}"
+            number = scramble_invoice_number(value)
+            # Numbers issued before the sequence existed were drawn at random
+            c.execute("SELECT 1 FROM invoices WHERE invoice_number=?", (number,))
+            if not c.fetchone():
+                return number
+
+    def scope(self, c, template_id):
+        from datetime import datetime
+        if self.number_format == "yearly":
+            year = datetime.now().strftime("%Y")
+            return f"year:{year}", f"{year}-"
+        if self.number_format == "template":
+            c.execute("SELECT invoice_prefix FROM templates WHERE id=?", (template_id,))
+            row = c.fetchone()
+            return f"template:{template_id}", (row[0] if row and row[0] else f"T{template_id}-")
+        return "random", ""
 
-        c.execute('''CREATE TABLE IF NOT EXISTS notifications_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            type TEXT NOT NULL,
-            reference_id INTEGER,
-            sent_at TEXT NOT NULL,
-            chat_id TEXT NOT NULL
-        )''')
+    def next_value(self, c, scope):
+        if self.block_size == 1:
+            return next_sequence_values(c, scope, 1)[0]
+        with self.lock:
+            block = self.blocks.get(scope)
+            if not block:
+                with db() as conn:
+                    block = list(next_sequence_values(conn.cursor(), scope, self.block_size))
+                self.blocks[scope] = block
+            return block.pop(0)
 
-        c.execute('''CREATE TABLE IF NOT EXISTS todos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            description TEXT,
-            due_date TEXT,
-            priority TEXT DEFAULT 'medium',
-            status TEXT DEFAULT 'pending',
-            client_id INTEGER,
-            invoice_id INTEGER,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            completed_at TEXT,
-            FOREIGN KEY (client_id) REFERENCES clients(id),
-            FOREIGN KEY (invoice_id) REFERENCES invoices(id)
-        )''')
+invoice_numbers = InvoiceNumberAllocator(INVOICE_NUMBER_FORMAT, INVOICE_NUMBER_BLOCK_SIZE)
 
-        c.execute('''CREATE TABLE IF NOT EXISTS calendar_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            description TEXT,
-            start_datetime TEXT NOT NULL,
-            end_datetime TEXT,
-            all_day INTEGER DEFAULT 0,
-            event_type TEXT DEFAULT 'appointment',
-            client_id INTEGER,
-            color TEXT DEFAULT '#4a90e2',
-            reminder_minutes INTEGER,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (client_id) REFERENCES clients(id)
-        )''')
+def row_to_dict(c, row):
+    """Map a row fetched from cursor c to a {column: value} dict."""
+    return dict(zip([col[0] for col in c.description], row))
 
-        c.execute("SELECT COUNT(*) FROM bank_details")
-        if c.fetchone()[0] == 0:
-            c.execute('''INSERT INTO bank_details
-                (iban, bank_name, bank_address, bic, creditor_name, creditor_street, creditor_postalcode, creditor_city, creditor_country)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                ("CH5800791123000889012", "My Bank", "Bankstrasse 1", "POFICHBEXXX",
-                 "My Company AG", "My Street 1", "8000", "Zurich", "CH"))
-
-        c.execute("SELECT COUNT(*) FROM partners")
-        if c.fetchone()[0] == 0:
-            c.execute("INSERT INTO partners (name, default_share, color) VALUES (?, ?, ?)", ("Partner A", 50.0, "#4a90e2"))
-            c.execute("INSERT INTO partners (name, default_share, color) VALUES (?, ?, ?)", ("Partner B", 50.0, "#10b981"))
-
-        c.execute("SELECT COUNT(*) FROM telegram_config")
-        if c.fetchone()[0] == 0:
-            c.execute("INSERT INTO telegram_config (id, enabled) VALUES (1, 0)")
-
-        c.execute("PRAGMA table_info(invoices)")
-        columns = [col[1] for col in c.fetchall()]
-        if "invoice_number" not in columns:
-            c.execute("ALTER TABLE invoices ADD COLUMN invoice_number TEXT")
-            c.execute("SELECT id FROM invoices WHERE invoice_number IS NULL")
-            for row in c.fetchall():
-                invoice_id = row[0]
-                while True:
-                    new_invoice_number = generate_invoice_number()
-                    c.execute("SELECT COUNT(*) FROM invoices WHERE invoice_number=?", (new_invoice_number,))
-                    if c.fetchone()[0] == 0:
-                        break
-                c.execute("UPDATE invoices SET invoice_number=? WHERE id=?", (new_invoice_number, invoice_id))
-
-        if "partner_a_share" not in columns:
-            c.execute("ALTER TABLE invoices ADD COLUMN partner_a_share REAL DEFAULT 50.0")
-        if "partner_b_share" not in columns:
-            c.execute("ALTER TABLE invoices ADD COLUMN partner_b_share REAL DEFAULT 50.0")
-        if "status" not in columns:
-            c.execute("ALTER TABLE invoices ADD COLUMN status TEXT DEFAULT 'draft'")
-        if "sent_date" not in columns:
-            c.execute("ALTER TABLE invoices ADD COLUMN sent_date TEXT")
-        if "paid_date" not in columns:
-            c.execute("ALTER TABLE invoices ADD COLUMN paid_date TEXT")
-        if "total_amount" not in columns:
-            c.execute("ALTER TABLE invoices ADD COLUMN total_amount REAL")
-        if "title" not in columns:
-            c.execute("ALTER TABLE invoices ADD COLUMN title TEXT")
-        if "description" not in columns:
-            c.execute("ALTER TABLE invoices ADD COLUMN description TEXT")
-
-        c.execute("PRAGMA table_info(recurring_fees)")
-        rf_columns = [col[1] for col in c.fetchall()]
-        if "service_type" not in rf_columns:
-            c.execute("ALTER TABLE recurring_fees ADD COLUMN service_type TEXT DEFAULT 'other'")
+def rows_to_dicts(c, rows):
+    columns = [col[0] for col in c.description]
+    return [dict(zip(columns, row)) for row in rows]
 
-        conn.commit()
+MAX_PAGE_SIZE = 1000
 
-init_db()
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
 
-def generate_invoice_number():
-    """Generate a short random invoice number (8 characters, alphanumeric uppercase)"""
-    return ''.join(secrets.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(8))
+def decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(400, "Invalid cursor")
+    return values
+
+def keyset_condition(sort_keys, values):
+    """SQL condition selecting the rows that sort after the given key values."""
+    directions = {direction for _, direction in sort_keys}
+    if len(directions) == 1:
+        op = ">" if directions == {"ASC"} else "<"
+        columns = ", ".join(expr for expr, _ in sort_keys)
+        placeholders = ", ".join("?" for _ in sort_keys)
+        return f"({columns}) {op} ({placeholders})", list(values)
+    clauses = []
+    params = []
+    for i, (expr, direction) in enumerate(sort_keys):
+        parts = [f"{prev_expr} = ?" for prev_expr, _ in sort_keys[:i]]
+        parts.append(f"{expr} {'>' if direction == 'ASC' else '<'} ?")
+        clauses.append("(" + " AND ".join(parts) + ")")
+        params.extend(values[:i + 1])
+    return "(" + " OR ".join(clauses) + ")", params
+
+def fetch_page(c, select, from_clause, conditions, params, sort_keys, limit=None, cursor=None):
+    """Run a list query ordered by sort_keys, with optional keyset pagination.
+
+    sort_keys is a list of (sql expression, "ASC"/"DESC") that must identify a
+    row uniquely (end it with the primary key). Without a limit the full list is
+    returned as before; with one, {"items": [...], "next_cursor": ...} where
+    next_cursor is passed back as ?cursor= to continue after the last item.
+    """
+    conditions = list(conditions)
+    params = list(params)
+    if cursor:
+        condition, cursor_params = keyset_condition(sort_keys, decode_cursor(cursor, len(sort_keys)))
+        conditions.append(condition)
+        params.extend(cursor_params)
+
+    key_columns = ", ".join(f"{expr} AS _sort_key{i}" for i, (expr, _) in enumerate(sort_keys))
+    query = f"SELECT {select}, {key_columns} {from_clause}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY " + ", ".join(f"{expr} {direction}" for expr, direction in sort_keys)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        query += " LIMIT ?"
+        params.append(limit + 1)
+
+    c.execute(query, params)
+    rows = rows_to_dicts(c, c.fetchall())
+    keys = [[row.pop(f"_sort_key{i}") for i in range(len(sort_keys))] for row in rows]
+    if limit is None:
+        return rows
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(keys[limit - 1])
+    return {"items": rows, "next_cursor": next_cursor}
+
+def compute_etag(c, tables, *extra):
+    placeholders = ", ".join("?" for _ in tables)
+    c.execute(f"SELECT name, version FROM table_versions WHERE name IN ({placeholders}) ORDER BY name", list(tables))
+    key = json.dumps([c.fetchall(), list(extra)], default=str)
+    return '"' + hashlib.sha1(key.encode("utf-8")).hexdigest() + '"'
+
+def not_modified(request, response, tables, *extra):
+    """Tag the response with the versions of the tables it reads (plus any extra inputs).
+
+    Returns a 304 response when the client's If-None-Match already has that tag,
+    so the caller can skip its query entirely; otherwise None.
+    """
+    with db() as conn:
+        etag = compute_etag(conn.cursor(), tables, *extra)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    response.headers.update(headers)
+    candidates = [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]
+    if etag in candidates or "*" in candidates:
+        return Response(status_code=304, headers=headers)
+    return None
 
 def extract_jinja_fields(html: str):
     return list(set(re.findall(r"\{\{\s*([a-zA-Z0-9_\.]+)\s*\}\}", html)))
 
-def generate_qr_bill_svg(amount, debtor, additional_info, bank_details, output_dir):
-    """Generate QR bill SVG file and save it to the specified directory"""
+def build_qr_bill_args(amount, debtor, bank_details):
+    """Validate the QR-bill inputs and return the QRBill constructor arguments."""
     required_bank_fields = [
         "iban", "creditor_name", "creditor_street", "creditor_postalcode", "creditor_city", "creditor_country"
     ]
@@ -246,31 +1295,95 @@ def generate_qr_bill_svg(amount, debtor, additional_info, bank_details, output_d
     if not amount or float(amount) <= 0:
         raise Exception("Amount must be greater than zero.")
 
-    bill = QRBill(
-        account=bank_details["iban"],
-        creditor={
+    return {
+        "account": bank_details["iban"],
+        "creditor": {
             "name": bank_details["creditor_name"],
             "street": bank_details["creditor_street"],
             "pcode": bank_details["creditor_postalcode"],
-            "city": bank_details["creditor_city"], 
+            "city": bank_details["creditor_city"],
             "country": bank_details["creditor_country"],
         },
-        amount=str(amount),
-        debtor=debtor,
-    )
-    
-    os.makedirs(output_dir, exist_ok=True)
-    
-    svg_path = os.path.join(output_dir, "qr_bill.svg")
-    with open(svg_path, "w", encoding="utf-8") as svg_file:
-        bill.as_svg(svg_file)
-    
-    return svg_path
-
-def copy_asset_if_exists(src_path, dest_dir):
-    """Copy a file to dest_dir if it exists."""
-    if os.path.exists(src_path):
-        shutil.copy(src_path, os.path.join(dest_dir, os.path.basename(src_path)))
+        "amount": str(amount),
+        "debtor": debtor,
+    }
+
+def get_qr_bill_svg(bill_args):
+    """Return (cache path, SVG bytes) for these QRBill arguments, generating the SVG on a miss."""
+    digest = hashlib.sha256(json.dumps(bill_args, sort_keys=True).encode("utf-8")).hexdigest()
+    cached_path = os.path.join(QR_CACHE_DIR, f"{digest}.svg")
+    svg = qr_cache.get(digest)
+    if svg is not None:
+        return cached_path, svg
+
+    if os.path.exists(cached_path):
+        with open(cached_path, "rb") as f:
+            svg = f.read()
+    else:
+        buffer = io.StringIO()
+        QRBill(**bill_args).as_svg(buffer)
+        svg = buffer.getvalue().encode("utf-8")
+        os.makedirs(QR_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cached_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(svg)
+        os.replace(tmp_path, cached_path)
+        count_qr_disk_entry()
+    qr_cache.put(digest, svg)
+    return cached_path, svg
+
+# Files in QR_CACHE_DIR as counted by this process (None until its first write);
+# other workers' writes are only seen when the directory is listed again.
+qr_disk_entries = None
+qr_disk_lock = threading.Lock()
+
+def count_qr_disk_entry():
+    """Count a newly written cache file and prune once the count passes QR_CACHE_DISK_SIZE.
+
+    The directory is listed on the first write and when pruning, not on every miss.
+    """
+    global qr_disk_entries
+    with qr_disk_lock:
+        if qr_disk_entries is None:
+            qr_disk_entries = len([name for name in os.listdir(QR_CACHE_DIR) if name.endswith(".svg")])
+        else:
+            qr_disk_entries += 1
+        if qr_disk_entries > QR_CACHE_DISK_SIZE:
+            qr_disk_entries = prune_qr_disk_cache()
+
+def prune_qr_disk_cache():
+    """Drop the least recently written files down to 90% of QR_CACHE_DISK_SIZE; returns how many are left.
+
+    Pruning below the limit leaves room for the next misses, so the directory is
+    scanned once per QR_CACHE_DISK_SIZE / 10 new files. Invoices keep their PDF,
+    so removing a cache entry only costs a regeneration.
+    """
+    entries = [os.path.join(QR_CACHE_DIR, name) for name in os.listdir(QR_CACHE_DIR) if name.endswith(".svg")]
+    keep = QR_CACHE_DISK_SIZE * 9 // 10
+    if len(entries) <= QR_CACHE_DISK_SIZE:
+        return len(entries)
+    mtimes = {}
+    for path in entries:
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+        except FileNotFoundError:
+            pass
+    entries = sorted(mtimes, key=mtimes.get)
+    for path in entries[:len(entries) - keep]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return min(len(entries), keep)
+
+def link_or_copy(src_path, dest_path):
+    """Hardlink src_path to dest_path, falling back to a copy across filesystems."""
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        shutil.copy(src_path, dest_path)
 
 def to_swiss_date(date_str):
     """Convert YYYY-MM-DD or ISO date to DD.MM.YYYY. If already Swiss, return as is."""
@@ -292,13 +1405,144 @@ def format_swiss_amount(value):
     formatted = f"{float(value):,.2f}"
     return formatted.replace(",", "'")
 
+class LRUCache:
+    """Thread-safe least-recently-used mapping with hit/miss counters."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, predicate):
+        """Drop every entry whose key matches predicate."""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+template_css_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+qr_cache = LRUCache(QR_CACHE_SIZE)
+# FontConfiguration wraps fontconfig/Pango font maps that are not thread-safe, so
+# each render thread keeps its own and discovers the installed fonts once
+font_configs = threading.local()
+jinja_bytecode_cache = None
+if JINJA_BYTECODE_CACHE_DIR:
+    os.makedirs(JINJA_BYTECODE_CACHE_DIR, exist_ok=True)
+    jinja_bytecode_cache = FileSystemBytecodeCache(JINJA_BYTECODE_CACHE_DIR)
+
+def get_compiled_template(template_id, template_dir_path, html_filename):
+    """Return the compiled Jinja template, compiling it only when the HTML file changed."""
+    html_path = os.path.join(template_dir_path, html_filename)
+    try:
+        st = os.stat(html_path)
+    except OSError:
+        raise TemplateNotFound(html_filename)
+    key = (template_id, html_path, st.st_mtime_ns, st.st_size)
+    template = template_cache.get(key)
+    if template is None:
+        env = Environment(loader=FileSystemLoader(template_dir_path), bytecode_cache=jinja_bytecode_cache)
+        template = env.get_template(html_filename)
+        template_cache.put(key, template)
+    return template
+
+def get_font_config():
+    """The calling thread's FontConfiguration."""
+    font_config = getattr(font_configs, "font_config", None)
+    if font_config is None:
+        font_config = font_configs.font_config = FontConfiguration()
+    return font_config
+
+def get_template_css(template_id, css_path):
+    """Return the template CSS file's bytes, read again only when it changed, or None if it is missing.
+
+    This saves the file read, not the parse: WeasyPrint parses the sheet again
+    on every render. A parsed CSS object could only be passed as a user
+    stylesheet (render(stylesheets=...)), which loses to the template's own
+    rules in the cascade, so the bytes are served through the <link> instead.
+    """
+    try:
+        st = os.stat(css_path)
+    except OSError:
+        return None
+    key = (template_id, css_path, st.st_mtime_ns, st.st_size)
+    css = template_css_cache.get(key)
+    if css is None:
+        with open(css_path, "rb") as f:
+            css = f.read()
+        template_css_cache.put(key, css)
+    return css
+
+def invalidate_template_caches(template_id):
+    template_cache.discard(lambda key: key[0] == template_id)
+    template_css_cache.discard(lambda key: key[0] == template_id)
+
+class InvoiceURLFetcher(URLFetcher):
+    """Resolves the resources of an invoice rendered from an in-memory HTML string.
+
+    Relative URLs are resolved against the invoice directory: the template
+    stylesheet is served from template_css_cache (through the <link>, so it keeps
+    its author-origin precedence), qr_bill.svg is served from memory, template
+    assets are read straight from the template directory and anything else
+    (the uploaded logo) from the invoice directory itself.
+    """
+
+    def __init__(self, invoice_dir, template_dir, css_filename, qr_svg=None, css=None, **kwargs):
+        super().__init__(**kwargs)
+        self.invoice_dir = os.path.abspath(invoice_dir)
+        self.template_dir = os.path.abspath(template_dir)
+        self.css_path = os.path.join(self.invoice_dir, css_filename)
+        self.qr_path = os.path.join(self.invoice_dir, "qr_bill.svg")
+        self.qr_svg = qr_svg
+        self.css = css
+
+    def fetch(self, url, headers=None):
+        parsed = urlparse(url)
+        if parsed.scheme == "file":
+            path = unquote(parsed.path)
+            if path == self.css_path and self.css is not None:
+                return URLFetcherResponse(url, self.css, {"Content-Type": "text/css"})
+            if path == self.qr_path and self.qr_svg is not None:
+                return URLFetcherResponse(url, self.qr_svg, {"Content-Type": "image/svg+xml"})
+            if path.startswith(self.invoice_dir + os.sep):
+                template_path = os.path.join(self.template_dir, path[len(self.invoice_dir) + 1:])
+                if os.path.isfile(template_path):
+                    return URLFetcherResponse(url, open(template_path, "rb"))
+        return super().fetch(url, headers)
+
+@app.get("/debug/cache")
+def get_cache_stats():
+    return {"templates": template_cache.stats(), "template_css": template_css_cache.stats(), "qr_bills": qr_cache.stats()}
+
 @app.get("/clients")
-def get_clients():
+def get_clients(request: Request, response: Response, limit: int = None, cursor: str = None):
+    cached = not_modified(request, response, ["clients"], limit, cursor)
+    if cached:
+        return cached
     with db() as conn:
         c = conn.cursor()
-        c.execute("SELECT * FROM clients")
-        rows = c.fetchall()
-        return [dict(zip([col[0] for col in c.description], row)) for row in rows]
+        return fetch_page(c, "*", "FROM clients", [], [], [("id", "ASC")], limit, cursor)
 
 @app.post("/clients")
 def add_client(client: dict):
@@ -326,6 +1570,9 @@ def update_client(client_id: int, client: dict):
 def delete_client(client_id: int):
     with db() as conn:
         c = conn.cursor()
+        # Keep the client's history, unlinked, as before foreign keys were enforced
+        for table in ["recurring_fees", "payment_events", "todos", "calendar_events"]:
+            c.execute(f"UPDATE {table} SET client_id=NULL WHERE client_id=?", (client_id,))
         c.execute("DELETE FROM clients WHERE id=?", (client_id,))
         conn.commit()
         return {"ok": True}
@@ -335,7 +1582,7 @@ def get_client_stats(client_id: int):
     with db() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM invoices WHERE client_id=?", (client_id,))
-        invoices = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+        invoices = rows_to_dicts(c, c.fetchall())
 
         total_invoiced = sum(i.get("total_amount", 0) or 0 for i in invoices)
         paid_invoices = [i for i in invoices if i.get("status") == "paid"]
@@ -344,11 +1591,15 @@ def get_client_stats(client_id: int):
         total_outstanding = sum(i.get("total_amount", 0) or 0 for i in outstanding_invoices)
 
         c.execute("SELECT * FROM recurring_fees WHERE client_id=?", (client_id,))
-        recurring_fees = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
-        annual_recurring = sum(
-            (f.get("amount", 0) or 0) * (12 if f.get("frequency") == "monthly" else 1)
-            for f in recurring_fees if f.get("frequency") != "one-time"
-        )
+        recurring_fees = rows_to_dicts(c, c.fetchall())
+        annual_recurring = 0
+        for f in recurring_fees:
+            try:
+                months = fee_interval_months(f)
+            except ValueError:
+                continue
+            if months:
+                annual_recurring += (f.get("amount", 0) or 0) * 12 / months
 
         return {
             "total_invoices": len(invoices),
@@ -361,104 +1612,159 @@ def get_client_stats(client_id: int):
             "annual_recurring": annual_recurring
         }
 
+# Months between occurrences; "custom" uses the fee's interval_months
+RECURRING_FREQUENCY_MONTHS = {"monthly": 1, "quarterly": 3, "semi-annual": 6, "yearly": 12}
+
+def parse_fee_date(value):
+    """Parse DD.MM.YYYY, DD/MM/YYYY or YYYY-MM-DD; None if empty or invalid."""
+    from datetime import date
+    if not value:
+        return None
+    try:
+        if "." in value:
+            day, month, year = value.split(".")
+            return date(int(year), int(month), int(day))
+        if "/" in value:
+            day, month, year = value.split("/")
+            return date(int(year), int(month), int(day))
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+def fee_interval_months(fee):
+    """Months between a fee's occurrences, None for one-time fees; ValueError if unknown."""
+    frequency = fee.get("frequency")
+    if frequency == "one-time":
+        return None
+    if frequency == "custom":
+        months = int(fee.get("interval_months") or 0)
+        if months < 1:
+            raise ValueError("Custom frequency needs interval_months >= 1")
+        return months
+    if frequency not in RECURRING_FREQUENCY_MONTHS:
+        raise ValueError(f"Unknown frequency: {frequency}")
+    return RECURRING_FREQUENCY_MONTHS[frequency]
+
+def add_months(start, months):
+    """start shifted by a number of months, clamped to the end of shorter months."""
+    import calendar
+    year, month = divmod(start.month - 1 + months, 12)
+    year += start.year
+    month += 1
+    return start.replace(year=year, month=month, day=min(start.day, calendar.monthrange(year, month)[1]))
+
+def fee_schedule(fee, until, after=None):
+    """Due dates of a fee, in order, through the first one after `until`.
+
+    Only dates after `after` are returned (all from the anchor when None) and none
+    past end_date. Occurrence k is the anchor + k intervals, so a fee starting on
+    the 31st stays on month ends instead of drifting to the 28th. The anchor is
+    start_date, or schedule_anchor for fees whose older history already drifted.
+    """
+    start = parse_fee_date(fee.get("schedule_anchor") or fee.get("start_date"))
+    if start is None:
+        return []
+    end = parse_fee_date(fee.get("end_date"))
+    months = fee_interval_months(fee)
+    if months is None:
+        if (end is not None and start > end) or (after is not None and start <= after):
+            return []
+        return [start]
+
+    k = 0
+    if after is not None and after >= start:
+        # Jump straight to the first occurrence after `after` instead of walking there
+        k = ((after.year - start.year) * 12 + after.month - start.month) // months
+        while add_months(start, k * months) <= after:
+            k += 1
+
+    dates = []
+    while True:
+        due = add_months(start, k * months)
+        if end is not None and due > end:
+            break
+        dates.append(due)
+        if due > until:
+            break
+        k += 1
+    return dates
+
+def fee_occurrence_rows(fee, dates, status):
+    return [
+        (fee["client_id"], fee["id"], fee["amount"], fee.get("currency") or "CHF",
+         due.strftime("%Y-%m-%d"), fee.get("description") or "", status)
+        for due in dates
+    ]
+
+def insert_fee_occurrences(c, rows):
+    """Insert payment events, skipping (recurring_fee_id, due_date) pairs that already exist.
+
+    Returns the number of events actually created.
+    """
+    if not rows:
+        return 0
+    c.executemany(
+        "INSERT OR IGNORE INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    return c.rowcount
+
+def validate_recurring_fee(fee):
+    try:
+        fee_interval_months(fee)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
 @app.get("/clients/{client_id}/recurring-fees")
 def get_recurring_fees(client_id: int):
     with db() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM recurring_fees WHERE client_id=?", (client_id,))
-        rows = c.fetchall()
-        return [dict(zip([col[0] for col in c.description], row)) for row in rows]
+        return rows_to_dicts(c, c.fetchall())
 
 @app.post("/clients/{client_id}/recurring-fees")
 def add_recurring_fee(client_id: int, fee: dict):
-    from datetime import datetime
-    from dateutil.relativedelta import relativedelta
+    from datetime import date
 
+    validate_recurring_fee(fee)
     with db() as conn:
         c = conn.cursor()
+        # Payment events from the start date through the next future occurrence
+        dates = fee_schedule(fee, date.today())
         c.execute(
-            "INSERT INTO recurring_fees (client_id, amount, currency, frequency, start_date, description) VALUES (?, ?, ?, ?, ?, ?)",
-            (client_id, fee["amount"], fee.get("currency", "CHF"), fee["frequency"], fee["start_date"], fee.get("description", ""))
+            "INSERT INTO recurring_fees (client_id, amount, currency, frequency, start_date, description, interval_months, end_date, last_generated_until) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (client_id, fee["amount"], fee.get("currency", "CHF"), fee["frequency"], fee["start_date"], fee.get("description", ""),
+             fee.get("interval_months") or None, fee.get("end_date") or None, dates[-1].isoformat() if dates else None)
         )
-        conn.commit()
         recurring_fee_id = c.lastrowid
-
-        # Auto-generate payment events from start date to next future occurrence
-        start_date_str = fee["start_date"]
-        try:
-            if "." in start_date_str:
-                parts = start_date_str.split(".")
-                start_date = datetime(int(parts[2]), int(parts[1]), int(parts[0]))
-            elif "/" in start_date_str:
-                parts = start_date_str.split("/")
-                start_date = datetime(int(parts[2]), int(parts[1]), int(parts[0]))
-            else:
-                start_date = datetime.fromisoformat(start_date_str[:10])
-        except:
-            return {"id": recurring_fee_id}
-
-        current_date = datetime.now()
-        next_date = start_date
-
-        # Generate all events from start_date until the next future occurrence
-        if fee["frequency"] == "monthly":
-            while next_date <= current_date:
-                # Create event for this date
-                due_date_str = next_date.strftime("%Y-%m-%d")
-                c.execute("SELECT COUNT(*) FROM payment_events WHERE recurring_fee_id=? AND due_date=?",
-                         (recurring_fee_id, due_date_str))
-                if c.fetchone()[0] == 0:
-                    c.execute(
-                        "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (client_id, recurring_fee_id, fee["amount"], fee.get("currency", "CHF"),
-                         due_date_str, fee.get("description", ""), "not_sent")
-                    )
-                next_date = next_date + relativedelta(months=1)
-            # Add one more future occurrence
-            due_date_str = next_date.strftime("%Y-%m-%d")
-            c.execute(
-                "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (client_id, recurring_fee_id, fee["amount"], fee.get("currency", "CHF"),
-                 due_date_str, fee.get("description", ""), "not_sent")
-            )
-        elif fee["frequency"] == "yearly":
-            while next_date <= current_date:
-                due_date_str = next_date.strftime("%Y-%m-%d")
-                c.execute("SELECT COUNT(*) FROM payment_events WHERE recurring_fee_id=? AND due_date=?",
-                         (recurring_fee_id, due_date_str))
-                if c.fetchone()[0] == 0:
-                    c.execute(
-                        "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (client_id, recurring_fee_id, fee["amount"], fee.get("currency", "CHF"),
-                         due_date_str, fee.get("description", ""), "not_sent")
-                    )
-                next_date = next_date + relativedelta(years=1)
-            # Add one more future occurrence
-            due_date_str = next_date.strftime("%Y-%m-%d")
-            c.execute(
-                "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (client_id, recurring_fee_id, fee["amount"], fee.get("currency", "CHF"),
-                 due_date_str, fee.get("description", ""), "not_sent")
-            )
-        elif fee["frequency"] == "one-time":
-            due_date_str = start_date.strftime("%Y-%m-%d")
-            c.execute(
-                "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (client_id, recurring_fee_id, fee["amount"], fee.get("currency", "CHF"),
-                 due_date_str, fee.get("description", ""), "not_sent")
-            )
+        stored = {**fee, "id": recurring_fee_id, "client_id": client_id}
+        insert_fee_occurrences(c, fee_occurrence_rows(stored, dates, "not_sent"))
 
         conn.commit()
         return {"id": recurring_fee_id}
 
 @app.put("/recurring-fees/{fee_id}")
 def update_recurring_fee(fee_id: int, fee: dict):
+    from datetime import date, timedelta
+
+    validate_recurring_fee(fee)
     with db() as conn:
         c = conn.cursor()
+        c.execute("SELECT start_date, frequency, interval_months, schedule_anchor FROM recurring_fees WHERE id=?", (fee_id,))
+        current = c.fetchone()
+        # A drifted anchor only carries over while the schedule itself is unchanged
+        schedule = (fee["start_date"], fee["frequency"], int(fee.get("interval_months") or 0))
+        anchor = current[3] if current and (current[0], current[1], current[2] or 0) == schedule else None
         c.execute(
-            "UPDATE recurring_fees SET amount=?, currency=?, frequency=?, start_date=?, description=? WHERE id=?",
-            (fee["amount"], fee.get("currency", "CHF"), fee["frequency"], fee["start_date"], fee.get("description", ""), fee_id)
+            "UPDATE recurring_fees SET amount=?, currency=?, frequency=?, start_date=?, description=?, interval_months=?, end_date=?, schedule_anchor=?, last_generated_until=NULL WHERE id=?",
+            (fee["amount"], fee.get("currency", "CHF"), fee["frequency"], fee["start_date"], fee.get("description", ""),
+             fee.get("interval_months") or None, fee.get("end_date") or None, anchor, fee_id)
         )
+        # Unbilled events still ahead follow the new terms; past ones are history and stay as they are
+        today = date.today()
+        c.execute("""DELETE FROM payment_events WHERE recurring_fee_id=? AND due_date >= ?
+                     AND status IN ('not_sent', 'pending') AND invoice_id IS NULL""", (fee_id, today.isoformat()))
+        generate_due_payment_events(c, today + timedelta(days=PAYMENT_EVENT_HORIZON_DAYS), recurring_fee_id=fee_id)
         conn.commit()
         return {"ok": True}
 
@@ -466,17 +1772,21 @@ def update_recurring_fee(fee_id: int, fee: dict):
 def delete_recurring_fee(fee_id: int):
     with db() as conn:
         c = conn.cursor()
+        c.execute("UPDATE payment_events SET recurring_fee_id=NULL WHERE recurring_fee_id=?", (fee_id,))
         c.execute("DELETE FROM recurring_fees WHERE id=?", (fee_id,))
         conn.commit()
         return {"ok": True}
 
 @app.get("/bank-details")
-def get_bank_details():
+def get_bank_details(request: Request, response: Response):
+    cached = not_modified(request, response, ["bank_details"])
+    if cached:
+        return cached
     with db() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM bank_details LIMIT 1")
         row = c.fetchone()
-        return dict(zip([col[0] for col in c.description], row)) if row else {}
+        return row_to_dict(c, row) if row else {}
 
 @app.put("/bank-details")
 def update_bank_details(details: dict = Body(...)):
@@ -489,119 +1799,154 @@ def update_bank_details(details: dict = Body(...)):
         conn.commit()
         return {"ok": True}
 
+PAYMENT_EVENT_LIST = (
+    "pe.*, COALESCE(c.name, 'Unknown') AS client_name",
+    "FROM payment_events pe LEFT JOIN clients c ON pe.client_id = c.id",
+    [("COALESCE(pe.due_date, '')", "ASC"), ("pe.id", "ASC")],
+)
+
+def payment_event_filters(client_id=None, status=None):
+    conditions = []
+    params = []
+    if client_id is not None:
+        conditions.append("pe.client_id=?")
+        params.append(client_id)
+    if status is not None:
+        conditions.append("pe.status=?")
+        params.append(status)
+    return conditions, params
+
 @app.get("/payment-events")
-def get_payment_events(client_id: int = None, status: str = None):
+def get_payment_events(client_id: int = None, status: str = None, limit: int = None, cursor: str = None):
     with db() as conn:
         c = conn.cursor()
-        query = "SELECT * FROM payment_events"
-        params = []
-        conditions = []
-
-        if client_id is not None:
-            conditions.append("client_id=?")
-            params.append(client_id)
-
-        if status is not None:
-            conditions.append("status=?")
-            params.append(status)
+        select, from_clause, sort_keys = PAYMENT_EVENT_LIST
+        conditions, params = payment_event_filters(client_id, status)
+        return fetch_page(c, select, from_clause, conditions, params, sort_keys, limit, cursor)
 
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
-
-        query += " ORDER BY due_date ASC"
-
-        c.execute(query, params)
-        rows = c.fetchall()
-        events = [dict(zip([col[0] for col in c.description], row)) for row in rows]
-
-        # Add client name to each event
-        for event in events:
-            c.execute("SELECT name FROM clients WHERE id=?", (event["client_id"],))
-            client = c.fetchone()
-            event["client_name"] = client[0] if client else "Unknown"
-
-        return events
+def payment_event_conflict(error):
+    """Translate a payment_events constraint failure into an HTTP error."""
+    if "UNIQUE" in str(error):
+        return HTTPException(409, "A payment event already exists for this recurring fee and due date")
+    return HTTPException(400, "Unknown client, recurring fee or invoice")
 
 @app.post("/payment-events")
 def create_payment_event(event: dict):
     with db() as conn:
         c = conn.cursor()
-        c.execute(
-            "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (event["client_id"], event.get("recurring_fee_id"), event["amount"], event.get("currency", "CHF"),
-             event["due_date"], event.get("description", ""), event.get("status", "not_sent"))
-        )
+        try:
+            c.execute(
+                "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (event["client_id"], event.get("recurring_fee_id"), event["amount"], event.get("currency", "CHF"),
+                 event["due_date"], event.get("description", ""), event.get("status", "not_sent"))
+            )
+        except sqlite3.IntegrityError as e:
+            raise payment_event_conflict(e)
         conn.commit()
         return {"id": c.lastrowid}
 
+def generate_due_payment_events(c, horizon, recurring_fee_id=None, client_id=None):
+    """Create the payment events each fee is missing up to horizon, plus its next one after it.
+
+    Only occurrences after a fee's last_generated_until watermark are computed,
+    and fees whose watermark is already past the horizon are not read at all.
+    Occurrences already past are not created, so a fee whose watermark fell
+    behind (or was reset) resumes from today instead of backfilling overdue
+    events. Returns (fees scanned, events created).
+    """
+    from datetime import date
+
+    today = date.today()
+    conditions = ["(last_generated_until IS NULL OR (frequency != 'one-time' AND last_generated_until <= ?))"]
+    params = [horizon.isoformat()]
+    if recurring_fee_id:
+        conditions.append("id=?")
+        params.append(recurring_fee_id)
+    elif client_id:
+        conditions.append("client_id=?")
+        params.append(client_id)
+    c.execute(f"SELECT * FROM recurring_fees WHERE {' AND '.join(conditions)}", params)
+    fees = rows_to_dicts(c, c.fetchall())
+
+    rows = []
+    watermarks = []
+    for fee in fees:
+        try:
+            dates = fee_schedule(fee, horizon, after=parse_fee_date(fee["last_generated_until"]))
+        except ValueError:
+            continue
+        if dates:
+            rows.extend(fee_occurrence_rows(fee, [due for due in dates if due >= today], "pending"))
+            watermarks.append((dates[-1].isoformat(), fee["id"]))
+    generated = insert_fee_occurrences(c, rows)
+    c.executemany("UPDATE recurring_fees SET last_generated_until=? WHERE id=?", watermarks)
+    return len(fees), generated
+
+def run_payment_event_generation(trigger, recurring_fee_id=None, client_id=None):
+    """Run generate_due_payment_events in its own transaction and record the run."""
+    import time
+    from datetime import date, datetime, timedelta
+
+    started_at = datetime.now().isoformat(timespec="seconds")
+    started = time.perf_counter()
+    horizon = date.today() + timedelta(days=PAYMENT_EVENT_HORIZON_DAYS)
+    fees_scanned = generated = None
+    error = None
+    try:
+        with db() as conn:
+            fees_scanned, generated = generate_due_payment_events(conn.cursor(), horizon, recurring_fee_id, client_id)
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        duration_ms = round((time.perf_counter() - started) * 1000, 3)
+        with db() as conn:
+            conn.execute(
+                "INSERT INTO scheduler_runs (name, trigger, started_at, duration_ms, fees_scanned, rows_generated, error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ("payment_events", trigger, started_at, duration_ms, fees_scanned, generated, error)
+            )
+            conn.execute("DELETE FROM scheduler_runs WHERE name='payment_events' AND id <= (SELECT MAX(id) FROM scheduler_runs) - ?",
+                         (SCHEDULER_RUNS_KEPT,))
+    return {"generated": generated, "fees_scanned": fees_scanned, "duration_ms": duration_ms}
+
+def acquire_scheduler_lease(name, seconds):
+    """Take or renew the named lease unless another live owner holds it."""
+    from datetime import datetime, timedelta
+    now = datetime.now()
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO scheduler_locks (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE scheduler_locks.owner = excluded.owner OR scheduler_locks.expires_at < ?
+            RETURNING owner
+        """, (name, SCHEDULER_OWNER, (now + timedelta(seconds=seconds)).isoformat(), now.isoformat()))
+        return c.fetchone() is not None
+
+async def payment_event_scheduler():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # The lease outlives one interval so a stalled owner is replaced after two
+            if await loop.run_in_executor(None, acquire_scheduler_lease, "payment_events", PAYMENT_EVENT_SCHEDULER_SECONDS * 2):
+                result = await loop.run_in_executor(None, run_payment_event_generation, "scheduler")
+                if result["generated"]:
+                    print(f"Generated {result['generated']} payment events in {result['duration_ms']} ms")
+        except Exception as e:
+            print(f"Payment event scheduler run failed: {e}")
+        await asyncio.sleep(PAYMENT_EVENT_SCHEDULER_SECONDS)
+
 @app.post("/payment-events/generate")
 def generate_payment_events(params: dict = Body(...)):
     """Generate payment events from recurring fees"""
-    from datetime import datetime, timedelta
-    from dateutil.relativedelta import relativedelta
-
-    client_id = params.get("client_id")
-    recurring_fee_id = params.get("recurring_fee_id")
+    return run_payment_event_generation("manual", params.get("recurring_fee_id"), params.get("client_id"))
 
+@app.get("/payment-events/generate/runs")
+def get_payment_event_generation_runs(limit: int = 20):
     with db() as conn:
         c = conn.cursor()
-
-        # Get recurring fees to process
-        if recurring_fee_id:
-            c.execute("SELECT * FROM recurring_fees WHERE id=?", (recurring_fee_id,))
-        elif client_id:
-            c.execute("SELECT * FROM recurring_fees WHERE client_id=?", (client_id,))
-        else:
-            c.execute("SELECT * FROM recurring_fees")
-
-        fees = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
-
-        generated_count = 0
-        for fee in fees:
-            # Parse start date (DD.MM.YYYY, DD/MM/YYYY or YYYY-MM-DD)
-            start_date_str = fee["start_date"]
-            try:
-                if "." in start_date_str:
-                    parts = start_date_str.split(".")
-                    start_date = datetime(int(parts[2]), int(parts[1]), int(parts[0]))
-                elif "/" in start_date_str:
-                    parts = start_date_str.split("/")
-                    start_date = datetime(int(parts[2]), int(parts[1]), int(parts[0]))
-                else:
-                    start_date = datetime.fromisoformat(start_date_str[:10])
-            except:
-                continue
-
-            # Calculate next occurrences
-            current_date = datetime.now()
-            next_date = start_date
-
-            # Find the next occurrence after today
-            if fee["frequency"] == "monthly":
-                while next_date < current_date:
-                    next_date = next_date + relativedelta(months=1)
-            elif fee["frequency"] == "yearly":
-                while next_date < current_date:
-                    next_date = next_date + relativedelta(years=1)
-            elif fee["frequency"] == "one-time":
-                next_date = start_date
-
-            # Check if event already exists for this date
-            due_date_str = next_date.strftime("%Y-%m-%d")
-            c.execute("SELECT COUNT(*) FROM payment_events WHERE recurring_fee_id=? AND due_date=?",
-                     (fee["id"], due_date_str))
-
-            if c.fetchone()[0] == 0:
-                # Create the event
-                c.execute(
-                    "INSERT INTO payment_events (client_id, recurring_fee_id, amount, currency, due_date, description, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (fee["client_id"], fee["id"], fee["amount"], fee["currency"],
-                     due_date_str, fee["description"], "pending")
-                )
-                generated_count += 1
-
-        conn.commit()
-        return {"generated": generated_count}
+        c.execute("SELECT * FROM scheduler_runs WHERE name='payment_events' ORDER BY id DESC LIMIT ?", (max(1, min(limit, MAX_PAGE_SIZE)),))
+        return rows_to_dicts(c, c.fetchall())
 
 @app.put("/payment-events/{event_id}")
 def update_payment_event(event_id: int, event: dict):
@@ -656,7 +2001,10 @@ def update_payment_event(event_id: int, event: dict):
         params.append(event_id)
         query = f"UPDATE payment_events SET {', '.join(updates)} WHERE id=?"
 
-        c.execute(query, params)
+        try:
+            c.execute(query, params)
+        except sqlite3.IntegrityError as e:
+            raise payment_event_conflict(e)
         conn.commit()
         return {"ok": True}
 
@@ -669,18 +2017,21 @@ def delete_payment_event(event_id: int):
         return {"ok": True}
 
 @app.get("/templates")
-def get_templates():
+def get_templates(request: Request, response: Response):
+    cached = not_modified(request, response, ["templates"])
+    if cached:
+        return cached
     with db() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM templates")
-        rows = c.fetchall()
-        return [dict(zip([col[0] for col in c.description], row)) for row in rows]
+        return rows_to_dicts(c, c.fetchall())
 
 @app.post("/templates")
 def upload_template(
     name: str = Form(...),
     html_file: UploadFile = File(...),
-    css_file: UploadFile = File(...)
+    css_file: UploadFile = File(...),
+    invoice_prefix: str = Form(None)
 ):
     template_dir_path = os.path.join(TEMPLATE_DIR, name)
     os.makedirs(template_dir_path, exist_ok=True)
@@ -697,8 +2048,8 @@ def upload_template(
     fields = extract_jinja_fields(html_content)
     with db() as conn:
         c = conn.cursor()
-        c.execute("INSERT INTO templates (name, template_dir, html_filename, css_filename, fields) VALUES (?, ?, ?, ?, ?)",
-                  (name, name, html_filename, css_filename, json.dumps(fields)))
+        c.execute("INSERT INTO templates (name, template_dir, html_filename, css_filename, fields, invoice_prefix) VALUES (?, ?, ?, ?, ?, ?)",
+                  (name, name, html_filename, css_filename, json.dumps(fields), invoice_prefix))
         conn.commit()
         return {"id": c.lastrowid, "fields": fields}
 
@@ -707,7 +2058,8 @@ def update_template(
     template_id: int,
     name: str = Form(...),
     html_file: UploadFile = File(None),
-    css_file: UploadFile = File(None)
+    css_file: UploadFile = File(None),
+    invoice_prefix: str = Form(None)
 ):
     with db() as conn:
         c = conn.cursor()
@@ -778,8 +2130,12 @@ def update_template(
                             
             c.execute("UPDATE templates SET name=?, template_dir=? WHERE id=?", 
                      (name, name, template_id))
+
+        if invoice_prefix is not None:
+            c.execute("UPDATE templates SET invoice_prefix=? WHERE id=?", (invoice_prefix or None, template_id))
                      
         conn.commit()
+        invalidate_template_caches(template_id)
         return {"ok": True}
 
 @app.delete("/templates/{template_id}")
@@ -788,6 +2144,7 @@ def delete_template(template_id: int):
         c = conn.cursor()
         c.execute("DELETE FROM templates WHERE id=?", (template_id,))
         conn.commit()
+        invalidate_template_caches(template_id)
         return {"ok": True}
 
 @app.get("/templates/{template_id}/content")
@@ -840,11 +2197,12 @@ def update_template_content(template_id: int, content: dict):
                 f.write(content["css"])
 
         conn.commit()
+        invalidate_template_caches(template_id)
         return {"ok": True}
 
 @app.post("/templates/{template_id}/preview")
 def preview_template(template_id: int, preview_data: dict = None):
-    from jinja2 import Environment, FileSystemLoader, UndefinedError
+    from jinja2 import UndefinedError
 
     with db() as conn:
         c = conn.cursor()
@@ -895,8 +2253,7 @@ def preview_template(template_id: int, preview_data: dict = None):
         }
 
         try:
-            env = Environment(loader=FileSystemLoader(template_path))
-            template = env.get_template(html_filename)
+            template = get_compiled_template(template_id, template_path, html_filename)
             rendered_html = template.render(**sample_data)
 
             full_html = f"""<!DOCTYPE html>
@@ -923,16 +2280,24 @@ def get_template_fields(template_id: int):
             raise HTTPException(404, "Template not found")
         return {"fields": json.loads(row[0])}
 
+# (select, from clause, sort keys) shared by GET /invoices and /export/invoices
+INVOICE_LIST = ("*", "FROM invoices", [("id", "ASC")])
+
+def invoice_filters(client_id=None):
+    conditions = []
+    params = []
+    if client_id:
+        conditions.append("client_id=?")
+        params.append(client_id)
+    return conditions, params
+
 @app.get("/invoices")
-def get_invoices(client_id: int = None):
+def get_invoices(client_id: int = None, limit: int = None, cursor: str = None):
     with db() as conn:
         c = conn.cursor()
-        if client_id:
-            c.execute("SELECT * FROM invoices WHERE client_id=?", (client_id,))
-        else:
-            c.execute("SELECT * FROM invoices")
-        rows = c.fetchall()
-        return [dict(zip([col[0] for col in c.description], row)) for row in rows]
+        select, from_clause, sort_keys = INVOICE_LIST
+        conditions, params = invoice_filters(client_id)
+        return fetch_page(c, select, from_clause, conditions, params, sort_keys, limit, cursor)
 
 @app.get("/invoices/{invoice_id}")
 def get_invoice(invoice_id: int):
@@ -942,7 +2307,538 @@ def get_invoice(invoice_id: int):
         row = c.fetchone()
         if not row:
             raise HTTPException(404, "Invoice not found")
-        return dict(zip([col[0] for col in c.description], row))
+        invoice = row_to_dict(c, row)
+
+        c.execute("SELECT status FROM render_jobs WHERE invoice_id=? ORDER BY id DESC LIMIT 1", (invoice_id,))
+        job = c.fetchone()
+        if job:
+            invoice["pdf_status"] = job[0]
+        elif os.path.exists(os.path.join(RESULTS_DIR, f"invoice_{invoice_id}", "invoice.pdf")):
+            invoice["pdf_status"] = "done"
+        else:
+            invoice["pdf_status"] = None
+        return invoice
+
+@app.get("/jobs/{job_id}")
+def get_render_job(job_id: int):
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM render_jobs WHERE id=?", (job_id,))
+        row = c.fetchone()
+        if not row:
+            raise HTTPException(404, "Job not found")
+        return row_to_dict(c, row)
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def store_blob(c, fileobj):
+    """Write fileobj into the blob store and return its sha256; identical content is kept once.
+
+    Attach the blob in the same transaction: the row is registered before the
+    file is checked, which takes the database write lock, so a concurrent
+    collect_unreferenced_blobs() cannot remove the file before the commit.
+    """
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    sha = hashlib.sha256()
+    size = 0
+    tmp_path = os.path.join(BLOB_DIR, f".upload-{secrets.token_hex(8)}")
+    with open(tmp_path, "wb") as tmp:
+        for chunk in iter(lambda: fileobj.read(65536), b""):
+            sha.update(chunk)
+            size += len(chunk)
+            tmp.write(chunk)
+    digest = sha.hexdigest()
+    c.execute("INSERT OR IGNORE INTO blobs (sha256, size, refcount) VALUES (?, ?, 0)", (digest, size))
+    path = blob_path(digest)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    return digest
+
+def attach_invoice_asset(c, invoice_id, invoice_dir, filename, digest):
+    """Link a stored blob into the invoice directory as filename and count the reference."""
+    detach_invoice_asset(c, invoice_id, invoice_dir, filename)
+    link_or_copy(blob_path(digest), os.path.join(invoice_dir, filename))
+    c.execute("INSERT INTO invoice_assets (invoice_id, filename, sha256) VALUES (?, ?, ?)", (invoice_id, filename, digest))
+    c.execute("UPDATE blobs SET refcount=refcount+1 WHERE sha256=?", (digest,))
+
+def detach_invoice_asset(c, invoice_id, invoice_dir, filename):
+    """Remove filename from the invoice directory and drop its blob reference, if any."""
+    c.execute("SELECT sha256 FROM invoice_assets WHERE invoice_id=? AND filename=?", (invoice_id, filename))
+    row = c.fetchone()
+    if row:
+        c.execute("DELETE FROM invoice_assets WHERE invoice_id=? AND filename=?", (invoice_id, filename))
+        c.execute("UPDATE blobs SET refcount=refcount-1 WHERE sha256=?", (row[0],))
+    path = os.path.join(invoice_dir, filename)
+    if os.path.exists(path):
+        os.remove(path)
+
+def collect_unreferenced_blobs(c):
+    """Delete blobs no invoice refers to any more; returns the number of blobs removed.
+
+    The files are removed before the caller commits, while this transaction
+    still holds the write lock, so store_blob() cannot re-register one in between.
+    """
+    c.execute("DELETE FROM blobs WHERE refcount<=0 RETURNING sha256")
+    digests = [row[0] for row in c.fetchall()]
+    for digest in digests:
+        try:
+            os.remove(blob_path(digest))
+        except FileNotFoundError:
+            pass
+    return len(digests)
+
+def save_uploaded_logo(invoice_id, logo_file, invoice_dir):
+    """Store an uploaded logo as uploaded_logo.<ext>, replacing any previous upload."""
+    original_filename = logo_file.filename
+    extension = os.path.splitext(original_filename)[1] if '.' in original_filename else '.png'
+    saved_logo_filename = f"uploaded_logo{extension}"
+    with db() as conn:
+        c = conn.cursor()
+        previous_logo = find_uploaded_logo(invoice_dir)
+        if previous_logo:
+            detach_invoice_asset(c, invoice_id, invoice_dir, previous_logo)
+        digest = store_blob(c, logo_file.file)
+        attach_invoice_asset(c, invoice_id, invoice_dir, saved_logo_filename, digest)
+        collect_unreferenced_blobs(c)
+        conn.commit()
+    return saved_logo_filename
+
+def find_uploaded_logo(invoice_dir):
+    """Return the filename of the logo uploaded for an invoice, if any."""
+    if not os.path.isdir(invoice_dir):
+        return None
+    for filename in sorted(os.listdir(invoice_dir)):
+        if os.path.splitext(filename)[0] == "uploaded_logo":
+            return filename
+    return None
+
+def render_invoice(invoice_id):
+    """Render the stored invoice to results/invoice_{id}/invoice.pdf.
+
+    This is blocking (sqlite, Jinja, QR-bill, WeasyPrint); async endpoints must
+    call it through run_render() so the event loop keeps serving other requests.
+    """
+    with render_seconds.time():
+        return render_invoice_stages(invoice_id)
+
+def render_invoice_stages(invoice_id):
+    stage = render_stage_seconds.time
+    with stage("db_read"), db() as conn:
+        c = conn.cursor()
+
+        c.execute("SELECT invoice_number, client_id, template_id, data FROM invoices WHERE id=?", (invoice_id,))
+        invoice_row = c.fetchone()
+        if not invoice_row:
+            raise HTTPException(404, "Invoice not found")
+        invoice_number, client_id, template_id, data = invoice_row
+
+        # Get template info
+        c.execute("SELECT template_dir, html_filename, css_filename FROM templates WHERE id=?", (template_id,))
+        tpl = c.fetchone()
+        if not tpl:
+            raise HTTPException(404, "Template not found")
+        template_dir_name, html_filename, css_filename = tpl
+        template_dir_path = os.path.join(TEMPLATE_DIR, template_dir_name)
+        css_path = os.path.join(template_dir_path, css_filename)
+
+        # Get client info
+        c.execute("SELECT * FROM clients WHERE id=?", (client_id,))
+        client_row = c.fetchone()
+        client_dict = row_to_dict(c, client_row)
+
+        client_dict["zip"] = client_dict["cap"]
+        client_dict["formatted_city"] = f"{client_dict['city']}, {client_dict['cap']}"
+        client_dict["country"] = client_dict.get("nation") or "CH"
+
+        # Get bank details
+        c.execute("SELECT * FROM bank_details LIMIT 1")
+        bank_row = c.fetchone()
+        bank_details = row_to_dict(c, bank_row)
+
+    # Parse invoice data
+    invoice_data = json.loads(data)
+    items = invoice_data.get("items", [])
+
+    # Calculate totals
+    for item in items:
+        item["total"] = float(item["price"]) * float(item["qty"])
+        item["price"] = format_swiss_amount(item['price'])
+        item["total"] = format_swiss_amount(item['total'])
+
+    subtotal_raw = sum(float(str(item["total"]).replace("'", "")) for item in items)
+    net_total_raw = subtotal_raw
+    subtotal = format_swiss_amount(subtotal_raw)
+    net_total = format_swiss_amount(net_total_raw)
+
+    # Prepare QR bill data
+    debtor = {
+        "name": client_dict["name"],
+        "street": client_dict["address"],
+        "pcode": client_dict["cap"],
+        "city": client_dict["city"],
+        "country": client_dict["country"]
+    }
+    additional_info = invoice_data.get("notes", "")
+
+    invoice_dir = os.path.join(RESULTS_DIR, f"invoice_{invoice_id}")
+    os.makedirs(invoice_dir, exist_ok=True)
+
+    # QR bill SVG comes from the QR cache and is served to WeasyPrint from memory
+    qr_svg = None
+    qr_svg_rel_path = ""
+    try:
+        with stage("qr_bill"):
+            _, qr_svg = get_qr_bill_svg(build_qr_bill_args(net_total_raw, debtor, bank_details))
+        qr_svg_rel_path = "qr_bill.svg"
+    except Exception as e:
+        print(f"QR-bill generation failed for invoice {invoice_id}: {e}")
+
+    # Logo uploaded with this or a previous save of the invoice
+    with stage("assets"):
+        logo_rel_path = find_uploaded_logo(invoice_dir)
+
+    customer_dict = client_dict.copy()
+
+    # Format dates
+    invoice_date_raw = invoice_data.get("date") or ""
+    invoice_date = to_swiss_date(invoice_date_raw)
+
+    invoice_data_copy = invoice_data.copy()
+    for k in ["date", "invoice_date"]:
+        if k in invoice_data_copy:
+            del invoice_data_copy[k]
+
+    # Prepare context
+    context = {
+        "client": client_dict,
+        "customer": customer_dict,
+        "qr_image": qr_svg_rel_path,
+        "items": items,
+        "subtotal": subtotal,
+        "net_total": net_total,
+        "total": net_total,
+        "invoice_number": invoice_number,
+        "invoice_date": invoice_date,
+        "date": invoice_date,
+        "logo": logo_rel_path,
+        **invoice_data_copy
+    }
+
+    # Render HTML
+    with stage("jinja"):
+        template = get_compiled_template(template_id, template_dir_path, html_filename)
+        html_content_rendered = template.render(**context)
+
+    # Replace image tags left literally in the output (e.g. inside user-provided fields)
+    if "{{" in html_content_rendered:
+        if qr_svg_rel_path:
+            html_content_rendered = re.sub(r'\{\{\s*qr_image\s*\}\}',
+                                          f'<img src="{qr_svg_rel_path}" alt="QR Bill" />',
+                                          html_content_rendered)
+        if logo_rel_path:
+            html_content_rendered = re.sub(r'\{\{\s*logo\s*\}\}',
+                                          f'<img src="{logo_rel_path}" alt="Company Logo" style="max-height:100px; width:auto;" />',
+                                          html_content_rendered)
+
+    # Keep the rendered HTML only when debugging templates
+    rendered_html_path = None
+    if RENDER_DEBUG:
+        rendered_html_path = os.path.join(invoice_dir, "rendered.html")
+        with open(rendered_html_path, "w", encoding="utf-8") as f:
+            f.write(html_content_rendered)
+
+    # Generate PDF; the fetcher answers the template's <link> to its CSS from the cache
+    css = get_template_css(template_id, css_path)
+    pdf_path = os.path.join(invoice_dir, "invoice.pdf")
+    with stage("weasyprint_layout"):
+        document = HTML(
+            string=html_content_rendered,
+            base_url=f"file://{os.path.abspath(invoice_dir)}/",
+            url_fetcher=InvoiceURLFetcher(invoice_dir, template_dir_path, css_filename, qr_svg, css),
+        ).render(font_config=get_font_config())
+    with stage("pdf_write"):
+        document.write_pdf(pdf_path)
+
+    return {
+        "id": invoice_id,
+        "html": rendered_html_path,
+        "pdf": pdf_path
+    }
+
+class RenderAdmission:
+    """Counts render slots in use and the renders waiting for one (per process).
+
+    Only touched from the event loop, so plain counters are enough. A slot is
+    released when the render thread finishes, not when the request gives up on
+    it, so timed-out renders keep counting against RENDER_CONCURRENCY.
+    """
+
+    def __init__(self, slots, max_queue):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiters = deque()
+        self.average_seconds = 1.0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def queue_depth(self):
+        return len(self.waiters)
+
+    def retry_after(self):
+        """Seconds until the queue has likely drained by one slot's worth."""
+        import math
+        return max(1, math.ceil(self.average_seconds * (self.queue_depth + 1) / self.slots))
+
+    def reject(self, detail):
+        self.rejected += 1
+        raise HTTPException(429, detail, headers={"Retry-After": str(self.retry_after())})
+
+    def check(self, background=False):
+        """Refuse a new render request (before its invoice is saved) when saturated."""
+        if background:
+            with db() as conn:
+                queued = conn.execute("SELECT COUNT(*) FROM render_jobs WHERE status='queued'").fetchone()[0]
+            if queued >= RENDER_MAX_QUEUED_JOBS:
+                self.reject("Too many invoices waiting to be rendered")
+        elif self.running >= self.slots and self.queue_depth >= self.max_queue:
+            self.reject("Too many invoices being rendered")
+
+    async def acquire(self):
+        if self.running < self.slots and not self.waiters:
+            self.running += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the request went away
+                self.release()
+            raise
+
+    def release(self, seconds=None):
+        if seconds is not None:
+            self.average_seconds = 0.8 * self.average_seconds + 0.2 * seconds
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # the slot passes straight to the next waiter
+                return
+        self.running -= 1
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queue_depth": self.queue_depth,
+            "max_concurrent": self.slots,
+            "max_queue": self.max_queue,
+            "average_seconds": round(self.average_seconds, 3),
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+render_admission = RenderAdmission(RENDER_CONCURRENCY, RENDER_MAX_QUEUE)
+
+async def run_render(invoice_id, timeout=RENDER_TIMEOUT_SECONDS):
+    """Render an invoice on the bounded render pool without blocking the event loop.
+
+    Waits for a render slot; callers that may be refused should call
+    render_admission.check() before saving anything.
+    """
+    import time
+    await render_admission.acquire()
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    profile = current_profile.get()
+    if profile is not None:
+        future = loop.run_in_executor(render_executor, profile.call_in_thread, render_invoice, invoice_id)
+    else:
+        future = loop.run_in_executor(render_executor, render_invoice, invoice_id)
+
+    def finished(f):
+        if not f.cancelled():
+            f.exception()  # retrieved here in case the request already timed out
+        render_admission.release(time.perf_counter() - started)
+
+    future.add_done_callback(finished)
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        render_admission.timed_out += 1
+        raise HTTPException(504, f"Rendering took longer than {RENDER_TIMEOUT_SECONDS:g}s; the PDF is saved when it finishes")
+
+@app.get("/debug/queries")
+def get_query_stats(sort: str = "total_ms", limit: int = 50):
+    if sort not in ("total_ms", "count", "max_ms", "avg_ms", "rows"):
+        raise HTTPException(400, "sort must be one of total_ms, count, max_ms, avg_ms, rows")
+    with query_stats_lock:
+        entries = [(sql, list(values)) for sql, values in query_stats.items()]
+    queries = [
+        {
+            "sql": sql,
+            "count": count,
+            "total_ms": round(total * 1000, 3),
+            "avg_ms": round(total * 1000 / count, 3) if count else 0.0,
+            "max_ms": round(longest * 1000, 3),
+            "rows": rows,
+        }
+        for sql, (count, total, longest, rows) in entries
+    ]
+    queries.sort(key=lambda query: query[sort], reverse=True)
+    return {
+        "slow_query_ms": SLOW_QUERY_MS,
+        "distinct_queries": len(queries),
+        "queries": queries[:limit],
+        "slow": list(reversed(slow_queries)),
+    }
+
+@app.delete("/debug/queries")
+def reset_query_stats():
+    with query_stats_lock:
+        query_stats.clear()
+    slow_queries.clear()
+    return {"ok": True}
+
+@app.get("/metrics")
+def get_metrics():
+    with db() as conn:
+        queued_jobs = conn.execute("SELECT COUNT(*) FROM render_jobs WHERE status='queued'").fetchone()[0]
+        webhook_backlog = conn.execute("""
+            SELECT COALESCE(SUM((SELECT COUNT(*) FROM outbox WHERE outbox.id > e.last_delivered_id)), 0)
+            FROM webhook_endpoints e WHERE enabled = 1
+        """).fetchone()[0]
+    gauges = [
+        ("render_running", "Invoice renders in progress in this worker.", render_admission.running),
+        ("render_queue_depth", "Synchronous renders waiting for a render slot in this worker.", render_admission.queue_depth),
+        ("render_jobs_queued", "Background render jobs waiting in render_jobs.", queued_jobs),
+        ("webhook_backlog_events", "Outbox events not yet delivered, summed over enabled endpoints.", webhook_backlog),
+    ]
+    lines = []
+    for name, help, value in gauges:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+    for name, help, value in [
+        ("render_rejected_total", "Render requests refused with 429.", render_admission.rejected),
+        ("render_timeouts_total", "Synchronous renders that exceeded RENDER_TIMEOUT_SECONDS.", render_admission.timed_out),
+    ]:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} counter", f"{name} {value}"]
+    for metric in (http_request_seconds, render_seconds, render_stage_seconds, sqlite_query_seconds,
+                   telegram_messages, webhook_batches, webhook_events):
+        lines += metric.render()
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+def require_profile_secret(request):
+    if not profiling_authorized(request.headers.get("x-profile") or request.query_params.get("profile")):
+        raise HTTPException(403, "Profiling is not enabled or the secret is wrong")
+
+@app.get("/profiles")
+def get_profiles(request: Request):
+    require_profile_secret(request)
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for filename in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if filename.endswith(".json"):
+            with open(os.path.join(PROFILE_DIR, filename), encoding="utf-8") as f:
+                profiles.append(json.load(f))
+    return profiles
+
+@app.get("/profiles/{name}")
+def download_profile(name: str, request: Request):
+    require_profile_secret(request)
+    path = os.path.join(PROFILE_DIR, f"{os.path.basename(name)}.prof")
+    if not os.path.exists(path):
+        raise HTTPException(404, "Profile not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{os.path.basename(name)}.prof")
+
+@app.get("/render/status")
+def get_render_status():
+    with db() as conn:
+        queued_jobs = conn.execute("SELECT COUNT(*) FROM render_jobs WHERE status='queued'").fetchone()[0]
+    return {**render_admission.stats(), "queued_jobs": queued_jobs, "max_queued_jobs": RENDER_MAX_QUEUED_JOBS}
+
+def enqueue_render_job(invoice_id):
+    """Queue a background render of an invoice, reusing a job that has not started yet."""
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id FROM render_jobs WHERE invoice_id=? AND status='queued' ORDER BY id DESC LIMIT 1", (invoice_id,))
+        row = c.fetchone()
+        if row:
+            return row[0]
+        c.execute("INSERT INTO render_jobs (invoice_id, status) VALUES (?, ?)", (invoice_id, "queued"))
+        conn.commit()
+        job_id = c.lastrowid
+    render_jobs_wakeup.set()
+    return job_id
+
+def claim_render_job():
+    """Atomically move the oldest queued job to 'rendering' and return (job_id, invoice_id)."""
+    from datetime import datetime
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("""UPDATE render_jobs SET status='rendering', started_at=?
+                     WHERE id = (SELECT id FROM render_jobs WHERE status='queued' ORDER BY id LIMIT 1)
+                     RETURNING id, invoice_id""",
+                  (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+        row = c.fetchone()
+        conn.commit()
+        return row
+
+def finish_render_job(job_id, status, error=None):
+    from datetime import datetime
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE render_jobs SET status=?, error=?, finished_at=? WHERE id=?",
+                  (status, error, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id))
+        conn.commit()
+
+def requeue_stale_render_jobs():
+    """Put back jobs whose worker died mid-render (e.g. the process was restarted)."""
+    from datetime import datetime, timedelta
+    cutoff = (datetime.now() - timedelta(seconds=RENDER_JOB_STALE_SECONDS)).strftime("%Y-%m-%d %H:%M:%S")
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE render_jobs SET status='queued', started_at=NULL WHERE status='rendering' AND started_at < ?", (cutoff,))
+        conn.commit()
+
+async def render_job_worker():
+    # The job table is read and written on the default pool so polling never blocks the loop
+    loop = asyncio.get_running_loop()
+    while True:
+        render_jobs_wakeup.clear()
+        job = await loop.run_in_executor(None, claim_render_job)
+        if not job:
+            try:
+                await asyncio.wait_for(render_jobs_wakeup.wait(), RENDER_JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        job_id, invoice_id = job
+        try:
+            await run_render(invoice_id, timeout=None)
+        except HTTPException as e:
+            await loop.run_in_executor(None, finish_render_job, job_id, "failed", str(e.detail))
+        except Exception as e:
+            print(f"Background render failed for invoice {invoice_id}: {e}")
+            await loop.run_in_executor(None, finish_render_job, job_id, "failed", str(e))
+        else:
+            await loop.run_in_executor(None, finish_render_job, job_id, "done")
 
 @app.post("/invoices")
 async def create_invoice(
@@ -953,18 +2849,15 @@ async def create_invoice(
     partner_a_share: float = Form(50.0),
     partner_b_share: float = Form(50.0),
     title: str = Form(""),
-    description: str = Form("")
+    description: str = Form(""),
+    async_render: bool = False
 ):
-    RESULTS_DIR = "results"
+    render_admission.check(async_render)
     os.makedirs(RESULTS_DIR, exist_ok=True)
 
     with db() as conn:
         c = conn.cursor()
-        while True:
-            invoice_number = generate_invoice_number()
-            c.execute("SELECT COUNT(*) FROM invoices WHERE invoice_number=?", (invoice_number,))
-            if c.fetchone()[0] == 0:
-                break
+        invoice_number = invoice_numbers.allocate(c, template_id)
 
         invoice_data = json.loads(data)
         items = invoice_data.get("items", [])
@@ -976,7 +2869,6 @@ async def create_invoice(
         conn.commit()
         invoice_id = c.lastrowid
 
-        from datetime import datetime
         c.execute(
             "SELECT id FROM payment_events WHERE client_id=? AND status IN ('not_sent', 'sent') ORDER BY due_date ASC LIMIT 1",
             (client_id,)
@@ -988,125 +2880,18 @@ async def create_invoice(
                      (invoice_id, "sent", payment_event_id))
             conn.commit()
 
-        c.execute("SELECT template_dir, html_filename, css_filename FROM templates WHERE id=?", (template_id,))
-        tpl = c.fetchone()
-        if not tpl:
-            raise HTTPException(404, "Template not found")
-        template_dir_name, html_filename, css_filename = tpl
-        template_dir_path = os.path.join(TEMPLATE_DIR, template_dir_name)
-        css_path = os.path.join(template_dir_path, css_filename)
-
-        c.execute("SELECT * FROM clients WHERE id=?", (client_id,))
-        client_row = c.fetchone()
-        client_dict = dict(zip([col[0] for col in c.description], client_row))
-
-        client_dict["zip"] = client_dict["cap"]
-        client_dict["formatted_city"] = f"{client_dict['city']}, {client_dict['cap']}"
-        client_dict["country"] = client_dict.get("nation") or "CH"
-
-        c.execute("SELECT * FROM bank_details LIMIT 1")
-        bank_row = c.fetchone()
-        bank_details = dict(zip([col[0] for col in c.description], bank_row))
-
-        for item in items:
-            item["total"] = float(item["price"]) * float(item["qty"])
-            item["price"] = format_swiss_amount(item['price'])
-            item["total"] = format_swiss_amount(item['total'])
-
-        subtotal_raw = sum(float(str(item["total"]).replace("'", "")) for item in items)
-        net_total_raw = subtotal_raw
-        subtotal = format_swiss_amount(subtotal_raw)
-        net_total = format_swiss_amount(net_total_raw)
-
-        debtor = {
-            "name": client_dict["name"],
-            "street": client_dict["address"],
-            "pcode": client_dict["cap"],
-            "city": client_dict["city"],
-            "country": client_dict["country"]
-        }
-        additional_info = invoice_data.get("notes", "")
-
+    if logo_file:
         invoice_dir = os.path.join(RESULTS_DIR, f"invoice_{invoice_id}")
         os.makedirs(invoice_dir, exist_ok=True)
+        with render_stage_seconds.time("logo_upload"):
+            save_uploaded_logo(invoice_id, logo_file, invoice_dir)
+        await logo_file.close()
 
-        qr_svg_path = None
-        qr_svg_rel_path = ""
-        try:
-            qr_svg_path = generate_qr_bill_svg(net_total_raw, debtor, additional_info, bank_details, invoice_dir)
-            qr_svg_rel_path = os.path.basename(qr_svg_path)  
-        except Exception as e:
-            print(f"QR-bill generation failed for invoice {invoice_id}: {e}")
-            qr_svg_rel_path = ""
-
-        logo_rel_path = None
-        if logo_file:
-            original_filename = logo_file.filename
-            extension = os.path.splitext(original_filename)[1] if '.' in original_filename else '.png'
-            saved_logo_filename = f"uploaded_logo{extension}"
-            logo_save_path = os.path.join(invoice_dir, saved_logo_filename)
-            with open(logo_save_path, "wb") as buffer:
-                shutil.copyfileobj(logo_file.file, buffer)
-            logo_rel_path = saved_logo_filename
-            await logo_file.close()  
-
-        customer_dict = client_dict.copy()
-        
-        invoice_date_raw = invoice_data.get("date") or ""
-        invoice_date = to_swiss_date(invoice_date_raw)
-        
-        invoice_data_copy = invoice_data.copy()
-        for k in ["date", "invoice_date"]:
-            if k in invoice_data_copy:
-                del invoice_data_copy[k]
-
-        context = {
-            "client": client_dict,
-            "customer": customer_dict,
-            "qr_image": qr_svg_rel_path,
-            "items": items,
-            "subtotal": subtotal,
-            "net_total": net_total,
-            "total": net_total,
-            "invoice_number": invoice_number,
-            "invoice_date": invoice_date,
-            "date": invoice_date,
-            "logo": logo_rel_path,
-            **invoice_data_copy
-        }
-
-        shutil.copy(css_path, os.path.join(invoice_dir, css_filename))
-        
-        for asset in ["logo.png", "qr.png"]:
-            asset_path = os.path.join(template_dir_path, asset)
-            copy_asset_if_exists(asset_path, invoice_dir)
-
-        env = Environment(loader=FileSystemLoader(template_dir_path))
-        template = env.get_template(html_filename)
-        html_content_rendered = template.render(**context)
-        
-        if qr_svg_rel_path and os.path.exists(os.path.join(invoice_dir, qr_svg_rel_path)):
-            html_content_rendered = re.sub(r'\{\{\s*qr_image\s*\}\}', 
-                                          f'<img src="{qr_svg_rel_path}" alt="QR Bill" />', 
-                                          html_content_rendered)
-
-        if logo_rel_path and os.path.exists(os.path.join(invoice_dir, logo_rel_path)):
-            html_content_rendered = re.sub(r'\{\{\s*logo\s*\}\}',
-                                          f'<img src="{logo_rel_path}" alt="Company Logo" style="max-height:100px; width:auto;" />',
-                                          html_content_rendered)
-        
-        rendered_html_path = os.path.join(invoice_dir, "rendered.html")
-        with open(rendered_html_path, "w", encoding="utf-8") as f:
-            f.write(html_content_rendered)
-
-        pdf_path = os.path.join(invoice_dir, "invoice.pdf")
-        HTML(filename=rendered_html_path, base_url=f"file://{os.path.abspath(invoice_dir)}/").write_pdf(pdf_path)
+    if async_render:
+        job_id = enqueue_render_job(invoice_id)
+        return {"id": invoice_id, "job_id": job_id, "pdf_status": "queued"}
 
-        return {
-            "id": invoice_id,
-            "html": rendered_html_path,
-            "pdf": pdf_path
-        }
+    return await run_render(invoice_id)
 
 @app.put("/invoices/{invoice_id}")
 async def update_invoice(
@@ -1118,9 +2903,10 @@ async def update_invoice(
     partner_a_share: float = Form(50.0),
     partner_b_share: float = Form(50.0),
     title: str = Form(""),
-    description: str = Form("")
+    description: str = Form(""),
+    async_render: bool = False
 ):
-    RESULTS_DIR = "results"
+    render_admission.check(async_render)
     os.makedirs(RESULTS_DIR, exist_ok=True)
 
     with db() as conn:
@@ -1130,7 +2916,6 @@ async def update_invoice(
         existing = c.fetchone()
         if not existing:
             raise HTTPException(404, "Invoice not found")
-        invoice_number = existing[0]
 
         invoice_data_parsed = json.loads(data)
         items = invoice_data_parsed.get("items", [])
@@ -1140,163 +2925,120 @@ async def update_invoice(
                   (client_id, template_id, data, partner_a_share, partner_b_share, total_amount, title, description, invoice_id))
         conn.commit()
 
-        # Get template info
-        c.execute("SELECT template_dir, html_filename, css_filename FROM templates WHERE id=?", (template_id,))
-        tpl = c.fetchone()
-        if not tpl:
-            raise HTTPException(404, "Template not found")
-        template_dir_name, html_filename, css_filename = tpl
-        template_dir_path = os.path.join(TEMPLATE_DIR, template_dir_name)
-        css_path = os.path.join(template_dir_path, css_filename)
-
-        # Get client info
-        c.execute("SELECT * FROM clients WHERE id=?", (client_id,))
-        client_row = c.fetchone()
-        client_dict = dict(zip([col[0] for col in c.description], client_row))
-        
-        client_dict["zip"] = client_dict["cap"]  
-        client_dict["formatted_city"] = f"{client_dict['city']}, {client_dict['cap']}"
-        client_dict["country"] = client_dict.get("nation") or "CH"
+    # Handle logo; without a new upload the existing one is preserved
+    if logo_file:
+        invoice_dir = os.path.join(RESULTS_DIR, f"invoice_{invoice_id}")
+        os.makedirs(invoice_dir, exist_ok=True)
+        with render_stage_seconds.time("logo_upload"):
+            save_uploaded_logo(invoice_id, logo_file, invoice_dir)
+        await logo_file.close()
 
-        # Get bank details
-        c.execute("SELECT * FROM bank_details LIMIT 1")
-        bank_row = c.fetchone()
-        bank_details = dict(zip([col[0] for col in c.description], bank_row))
+    if async_render:
+        job_id = enqueue_render_job(invoice_id)
+        return {"id": invoice_id, "job_id": job_id, "pdf_status": "queued"}
 
-        # Parse invoice data
-        invoice_data = json.loads(data)
-        items = invoice_data.get("items", [])
+    return await run_render(invoice_id)
 
-        # Calculate totals
-        for item in items:
-            item["total"] = float(item["price"]) * float(item["qty"])
-            item["price"] = format_swiss_amount(item['price'])
-            item["total"] = format_swiss_amount(item['total'])
-
-        subtotal_raw = sum(float(str(item["total"]).replace("'", "")) for item in items)
-        net_total_raw = subtotal_raw
-        subtotal = format_swiss_amount(subtotal_raw)
-        net_total = format_swiss_amount(net_total_raw)
-
-        # Prepare QR bill data
-        debtor = {
-            "name": client_dict["name"],
-            "street": client_dict["address"],
-            "pcode": client_dict["cap"],
-            "city": client_dict["city"],
-            "country": client_dict["country"]
-        }
-        additional_info = invoice_data.get("notes", "")
+@app.delete("/invoices/{invoice_id}")
+def delete_invoice(invoice_id: int):
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE payment_events SET invoice_id=NULL WHERE invoice_id=?", (invoice_id,))
+        c.execute("UPDATE todos SET invoice_id=NULL WHERE invoice_id=?", (invoice_id,))
+        c.execute("DELETE FROM render_jobs WHERE invoice_id=?", (invoice_id,))
+        c.execute("DELETE FROM invoices WHERE id=?", (invoice_id,))
 
         invoice_dir = os.path.join(RESULTS_DIR, f"invoice_{invoice_id}")
-        os.makedirs(invoice_dir, exist_ok=True)
+        c.execute("SELECT filename FROM invoice_assets WHERE invoice_id=?", (invoice_id,))
+        for (filename,) in c.fetchall():
+            detach_invoice_asset(c, invoice_id, invoice_dir, filename)
+        conn.commit()
+        collect_unreferenced_blobs(c)
+        conn.commit()
+        return {"ok": True}
 
-        # Generate QR bill
-        qr_svg_path = None
-        qr_svg_rel_path = ""
-        try:
-            qr_svg_path = generate_qr_bill_svg(net_total_raw, debtor, additional_info, bank_details, invoice_dir)
-            qr_svg_rel_path = os.path.basename(qr_svg_path)  
-        except Exception as e:
-            print(f"QR-bill generation failed for invoice {invoice_id}: {e}")
-            qr_svg_rel_path = ""
-
-        # Handle logo
-        logo_rel_path = None
-        if logo_file:
-            original_filename = logo_file.filename
-            extension = os.path.splitext(original_filename)[1] if '.' in original_filename else '.png'
-            saved_logo_filename = f"uploaded_logo{extension}"
-            logo_save_path = os.path.join(invoice_dir, saved_logo_filename)
-            with open(logo_save_path, "wb") as buffer:
-                shutil.copyfileobj(logo_file.file, buffer)
-            logo_rel_path = saved_logo_filename
-            await logo_file.close()
-        else:
-            # Check if existing logo exists and preserve it
-            for ext in ['.png', '.jpg', '.jpeg', '.gif', '.svg']:
-                existing_logo = os.path.join(invoice_dir, f"uploaded_logo{ext}")
-                if os.path.exists(existing_logo):
-                    logo_rel_path = f"uploaded_logo{ext}"
-                    break  
-
-        customer_dict = client_dict.copy()
-        
-        # Format dates
-        invoice_date_raw = invoice_data.get("date") or ""
-        invoice_date = to_swiss_date(invoice_date_raw)
-        
-        invoice_data_copy = invoice_data.copy()
-        for k in ["date", "invoice_date"]:
-            if k in invoice_data_copy:
-                del invoice_data_copy[k]
-
-        # Prepare context
-        context = {
-            "client": client_dict,
-            "customer": customer_dict,
-            "qr_image": qr_svg_rel_path,
-            "items": items,
-            "subtotal": subtotal,
-            "net_total": net_total,
-            "total": net_total,
-            "invoice_number": invoice_number,
-            "invoice_date": invoice_date,
-            "date": invoice_date,
-            "logo": logo_rel_path,
-            **invoice_data_copy
-        }
+# Files that are unique to each invoice and never worth deduplicating
+UNSHARED_RESULT_FILES = ("invoice.pdf", "rendered.html")
 
-        # Copy CSS file
-        shutil.copy(css_path, os.path.join(invoice_dir, css_filename))
-        
-        # Copy assets
-        for asset in ["logo.png", "qr.png"]:
-            asset_path = os.path.join(template_dir_path, asset)
-            copy_asset_if_exists(asset_path, invoice_dir)
+def dedupe_results():
+    """Move the files of existing results/invoice_N directories into the blob store.
 
-        # Render HTML
-        env = Environment(loader=FileSystemLoader(template_dir_path))
-        template = env.get_template(html_filename)
-        html_content_rendered = template.render(**context)
-        
-        # Replace template tags for images
-        if qr_svg_rel_path and os.path.exists(os.path.join(invoice_dir, qr_svg_rel_path)):
-            html_content_rendered = re.sub(r'\{\{\s*qr_image\s*\}\}', 
-                                          f'<img src="{qr_svg_rel_path}" alt="QR Bill" />', 
-                                          html_content_rendered)
+    Each file is hashed; the first copy of a given content becomes the blob
+    (by hardlink, without copying) and every other copy is replaced by a
+    hardlink to it. Files already tracked in invoice_assets are skipped, so
+    the migration can be re-run safely.
+    """
+    report = {"invoices": 0, "files": 0, "bytes_saved": 0}
+    if not os.path.isdir(RESULTS_DIR):
+        return report
 
-        if logo_rel_path and os.path.exists(os.path.join(invoice_dir, logo_rel_path)):
-            html_content_rendered = re.sub(r'\{\{\s*logo\s*\}\}',
-                                          f'<img src="{logo_rel_path}" alt="Company Logo" style="max-height:100px; width:auto;" />',
-                                          html_content_rendered)
-        
-        # Save rendered HTML
-        rendered_html_path = os.path.join(invoice_dir, "rendered.html")
-        with open(rendered_html_path, "w", encoding="utf-8") as f:
-            f.write(html_content_rendered)
+    with db() as conn:
+        c = conn.cursor()
+        for dirname in sorted(os.listdir(RESULTS_DIR)):
+            invoice_dir = os.path.join(RESULTS_DIR, dirname)
+            if not dirname.startswith("invoice_") or not dirname[8:].isdigit() or not os.path.isdir(invoice_dir):
+                continue
+            invoice_id = int(dirname[8:])
+            c.execute("SELECT filename FROM invoice_assets WHERE invoice_id=?", (invoice_id,))
+            tracked = {row[0] for row in c.fetchall()}
+
+            for filename in sorted(os.listdir(invoice_dir)):
+                path = os.path.join(invoice_dir, filename)
+                if filename in UNSHARED_RESULT_FILES or filename in tracked or not os.path.isfile(path):
+                    continue
+                size = os.path.getsize(path)
+                digest = file_sha256(path)
+                # Registered before the file is checked, as in store_blob()
+                c.execute("INSERT OR IGNORE INTO blobs (sha256, size, refcount) VALUES (?, ?, 0)", (digest, size))
+                stored_path = blob_path(digest)
+                if not os.path.exists(stored_path):
+                    os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+                    link_or_copy(path, stored_path)
+                elif not os.path.samefile(stored_path, path):
+                    tmp_path = f"{path}.dedupe"
+                    link_or_copy(stored_path, tmp_path)
+                    os.replace(tmp_path, path)
+                    report["bytes_saved"] += size
+                c.execute("INSERT INTO invoice_assets (invoice_id, filename, sha256) VALUES (?, ?, ?)", (invoice_id, filename, digest))
+                c.execute("UPDATE blobs SET refcount=refcount+1 WHERE sha256=?", (digest,))
+                report["files"] += 1
 
-        # Generate PDF
-        pdf_path = os.path.join(invoice_dir, "invoice.pdf")
-        HTML(filename=rendered_html_path, base_url=f"file://{os.path.abspath(invoice_dir)}/").write_pdf(pdf_path)
+            conn.commit()
+            report["invoices"] += 1
+    return report
 
-        return {
-            "id": invoice_id,
-            "html": rendered_html_path,
-            "pdf": pdf_path
-        }
+@app.post("/maintenance/dedupe-results")
+def dedupe_results_endpoint():
+    return dedupe_results()
 
-@app.delete("/invoices/{invoice_id}")
-def delete_invoice(invoice_id: int):
+@app.post("/maintenance/check-dashboard-rollup")
+def check_dashboard_rollup(repair: bool = False):
+    """Recompute dashboard_rollup from invoices and expenses and report rows that drifted."""
     with db() as conn:
         c = conn.cursor()
-        c.execute("DELETE FROM invoices WHERE id=?", (invoice_id,))
-        conn.commit()
-        return {"ok": True}
+        c.execute(rollup_snapshot_sql())
+        expected = {tuple(row[:3]): row[3:] for row in c.fetchall()}
+        c.execute("SELECT source, month, status, count, amount, partner_a, partner_b FROM dashboard_rollup")
+        actual = {tuple(row[:3]): row[3:] for row in c.fetchall()}
+
+        mismatches = []
+        for key in sorted(expected.keys() | actual.keys()):
+            want = expected.get(key, (0, 0, 0, 0))
+            have = actual.get(key, (0, 0, 0, 0))
+            if want[0] != have[0] or any(abs(w - h) > 0.005 for w, h in zip(want[1:], have[1:])):
+                mismatches.append({
+                    "source": key[0], "month": key[1], "status": key[2],
+                    "expected": dict(zip(["count", "amount", "partner_a", "partner_b"], want)),
+                    "actual": dict(zip(["count", "amount", "partner_a", "partner_b"], have)),
+                })
+
+        if repair and mismatches:
+            rebuild_dashboard_rollup(c)
+        return {"ok": not mismatches, "mismatches": mismatches, "repaired": bool(repair and mismatches)}
 
 @app.get("/invoices/{invoice_id}/pdf")
 def get_invoice_pdf(invoice_id: int):
-    pdf_path = os.path.join("results", f"invoice_{invoice_id}", "invoice.pdf")
+    pdf_path = os.path.join(RESULTS_DIR, f"invoice_{invoice_id}", "invoice.pdf")
     if not os.path.exists(pdf_path):
         raise HTTPException(404, "PDF not found")
     return FileResponse(pdf_path, media_type="application/pdf")
@@ -1326,12 +3068,14 @@ def update_invoice_status(invoice_id: int, data: dict = Body(...)):
         return {"ok": True}
 
 @app.get("/partners")
-def get_partners():
+def get_partners(request: Request, response: Response):
+    cached = not_modified(request, response, ["partners"])
+    if cached:
+        return cached
     with db() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM partners")
-        rows = c.fetchall()
-        return [dict(zip([col[0] for col in c.description], row)) for row in rows]
+        return rows_to_dicts(c, c.fetchall())
 
 @app.put("/partners/{partner_id}")
 def update_partner(partner_id: int, partner: dict = Body(...)):
@@ -1358,39 +3102,40 @@ def update_partner(partner_id: int, partner: dict = Body(...)):
         conn.commit()
         return {"ok": True}
 
+EXPENSE_LIST = (
+    "e.*, COALESCE(p.name, 'Unknown') AS paid_by_name",
+    "FROM expenses e LEFT JOIN partners p ON e.paid_by = p.id",
+    [("e.date", "DESC"), ("e.id", "DESC")],
+)
+
+def expense_filters(category=None, expense_type=None, status=None, date_from=None, date_to=None):
+    conditions = []
+    params = []
+    if category:
+        conditions.append("e.category=?")
+        params.append(category)
+    if expense_type:
+        conditions.append("e.expense_type=?")
+        params.append(expense_type)
+    if status:
+        conditions.append("e.status=?")
+        params.append(status)
+    if date_from:
+        conditions.append("e.date>=?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("e.date<=?")
+        params.append(date_to)
+    return conditions, params
+
 @app.get("/expenses")
-def get_expenses(category: str = None, expense_type: str = None, status: str = None, date_from: str = None, date_to: str = None):
+def get_expenses(category: str = None, expense_type: str = None, status: str = None, date_from: str = None, date_to: str = None,
+                 limit: int = None, cursor: str = None):
     with db() as conn:
         c = conn.cursor()
-        query = "SELECT * FROM expenses"
-        conditions = []
-        params = []
-        if category:
-            conditions.append("category=?")
-            params.append(category)
-        if expense_type:
-            conditions.append("expense_type=?")
-            params.append(expense_type)
-        if status:
-            conditions.append("status=?")
-            params.append(status)
-        if date_from:
-            conditions.append("date>=?")
-            params.append(date_from)
-        if date_to:
-            conditions.append("date<=?")
-            params.append(date_to)
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
-        query += " ORDER BY date DESC"
-        c.execute(query, params)
-        rows = c.fetchall()
-        expenses = [dict(zip([col[0] for col in c.description], row)) for row in rows]
-        for exp in expenses:
-            c.execute("SELECT name FROM partners WHERE id=?", (exp["paid_by"],))
-            partner = c.fetchone()
-            exp["paid_by_name"] = partner[0] if partner else "Unknown"
-        return expenses
+        select, from_clause, sort_keys = EXPENSE_LIST
+        conditions, params = expense_filters(category, expense_type, status, date_from, date_to)
+        return fetch_page(c, select, from_clause, conditions, params, sort_keys, limit, cursor)
 
 @app.post("/expenses")
 def create_expense(expense: dict = Body(...)):
@@ -1436,39 +3181,23 @@ def delete_expense(expense_id: int):
 def get_expense_balance():
     with db() as conn:
         c = conn.cursor()
-        c.execute("SELECT id FROM partners ORDER BY id")
-        partners = [row[0] for row in c.fetchall()]
+        c.execute("SELECT id, name FROM partners ORDER BY id LIMIT 2")
+        partners = c.fetchall()
         if len(partners) < 2:
             return {"balance": 0, "owes_to": None, "owes_from": None}
-        partner_a, partner_b = partners[0], partners[1]
-
-        c.execute("SELECT * FROM expenses WHERE status='pending'")
-        expenses = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+        (partner_a, name_a), (partner_b, name_b) = partners
 
-        a_owes_b = 0.0
-        b_owes_a = 0.0
-
-        for exp in expenses:
-            amount = exp["amount"]
-            split_a = exp["split_ratio_a"] / 100.0
-            split_b = exp["split_ratio_b"] / 100.0
-            paid_by = exp["paid_by"]
-
-            a_share = amount * split_a
-            b_share = amount * split_b
-
-            if paid_by == partner_a:
-                b_owes_a += b_share
-            else:
-                a_owes_b += a_share
+        # Expenses paid by A are owed by B for B's share, everything else by A for A's share
+        c.execute("""
+            SELECT
+                COALESCE(SUM(CASE WHEN paid_by = ? THEN amount * split_ratio_b / 100.0 ELSE 0 END), 0),
+                COALESCE(SUM(CASE WHEN paid_by != ? THEN amount * split_ratio_a / 100.0 ELSE 0 END), 0)
+            FROM expenses WHERE status='pending'
+        """, (partner_a, partner_a))
+        b_owes_a, a_owes_b = c.fetchone()
 
         net_balance = b_owes_a - a_owes_b
 
-        c.execute("SELECT name FROM partners WHERE id=?", (partner_a,))
-        name_a = c.fetchone()[0]
-        c.execute("SELECT name FROM partners WHERE id=?", (partner_b,))
-        name_b = c.fetchone()[0]
-
         if net_balance > 0:
             return {"balance": abs(net_balance), "owes_from": name_b, "owes_to": name_a, "owes_from_id": partner_b, "owes_to_id": partner_a}
         elif net_balance < 0:
@@ -1477,18 +3206,17 @@ def get_expense_balance():
             return {"balance": 0, "owes_from": None, "owes_to": None}
 
 @app.get("/settlements")
-def get_settlements():
+def get_settlements(limit: int = None, cursor: str = None):
     with db() as conn:
         c = conn.cursor()
-        c.execute("SELECT * FROM settlements ORDER BY date DESC")
-        rows = c.fetchall()
-        settlements = [dict(zip([col[0] for col in c.description], row)) for row in rows]
-        for s in settlements:
-            c.execute("SELECT name FROM partners WHERE id=?", (s["from_partner_id"],))
-            s["from_partner_name"] = c.fetchone()[0]
-            c.execute("SELECT name FROM partners WHERE id=?", (s["to_partner_id"],))
-            s["to_partner_name"] = c.fetchone()[0]
-        return settlements
+        return fetch_page(
+            c,
+            "s.*, pf.name AS from_partner_name, pt.name AS to_partner_name",
+            """FROM settlements s
+               LEFT JOIN partners pf ON s.from_partner_id = pf.id
+               LEFT JOIN partners pt ON s.to_partner_id = pt.id""",
+            [], [], [("s.date", "DESC"), ("s.id", "DESC")], limit, cursor
+        )
 
 @app.post("/settlements")
 def create_settlement(settlement: dict = Body(...)):
@@ -1506,65 +3234,133 @@ def create_settlement(settlement: dict = Body(...)):
         conn.commit()
         return {"id": c.lastrowid}
 
-@app.get("/dashboard/stats")
-def get_dashboard_stats(period: str = "all"):
-    from datetime import datetime, timedelta
+def export_response(entity, listing, conditions, params, format, columns):
+    """Stream a list query as CSV or NDJSON, EXPORT_CHUNK_SIZE rows at a time.
+
+    columns is an optional comma-separated subset of the list endpoint's fields.
+    """
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(400, "format must be csv or ndjson")
+    select, from_clause, sort_keys = listing
+    query = f"SELECT {select} {from_clause}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY " + ", ".join(f"{expr} {direction}" for expr, direction in sort_keys)
+
+    # Resolve the column selection up front so a bad name is a 400, not a broken stream
     with db() as conn:
         c = conn.cursor()
+        c.execute(f"SELECT {select} {from_clause} LIMIT 0")
+        available = [col[0] for col in c.description]
+    fields = [name.strip() for name in columns.split(",") if name.strip()] if columns else available
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        raise HTTPException(400, f"Unknown columns: {', '.join(unknown)}")
+    indexes = [available.index(name) for name in fields]
+
+    def generate():
+        with db() as conn:
+            c = conn.cursor()
+            c.execute(query, params)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            if format == "csv":
+                writer.writerow(fields)
+            while True:
+                rows = c.fetchmany(EXPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    values = [row[i] for i in indexes]
+                    if format == "csv":
+                        writer.writerow(values)
+                    else:
+                        buffer.write(json.dumps(dict(zip(fields, values)), default=str) + "\n")
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue()
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(generate(), media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{entity}.{format}"'
+    })
+
+@app.get("/export/invoices")
+def export_invoices(client_id: int = None, format: str = "csv", columns: str = None):
+    conditions, params = invoice_filters(client_id)
+    return export_response("invoices", INVOICE_LIST, conditions, params, format, columns)
+
+@app.get("/export/payment-events")
+def export_payment_events(client_id: int = None, status: str = None, format: str = "csv", columns: str = None):
+    conditions, params = payment_event_filters(client_id, status)
+    return export_response("payment-events", PAYMENT_EVENT_LIST, conditions, params, format, columns)
+
+@app.get("/export/expenses")
+def export_expenses(category: str = None, expense_type: str = None, status: str = None, date_from: str = None, date_to: str = None,
+                    format: str = "csv", columns: str = None):
+    conditions, params = expense_filters(category, expense_type, status, date_from, date_to)
+    return export_response("expenses", EXPENSE_LIST, conditions, params, format, columns)
+
+def period_start_month(period):
+    """First rollup month included in a dashboard period ("all", "month" or "year")."""
+    from datetime import datetime
+    if period == "month":
+        return datetime.now().strftime("%Y-%m")
+    if period == "year":
+        return datetime.now().strftime("%Y-01")
+    return None
 
-        date_filter = ""
-        if period == "month":
-            start = datetime.now().replace(day=1).strftime("%Y-%m-%d")
-            date_filter = f" AND i.paid_date >= '{start}'"
-        elif period == "year":
-            start = datetime.now().replace(month=1, day=1).strftime("%Y-%m-%d")
-            date_filter = f" AND i.paid_date >= '{start}'"
+@app.get("/dashboard/stats")
+def get_dashboard_stats(request: Request, response: Response, period: str = "all"):
+    start_month = period_start_month(period)
+    cached = not_modified(request, response, ["invoices", "expenses"], period, start_month)
+    if cached:
+        return cached
+    with db() as conn:
+        c = conn.cursor()
 
-        c.execute(f"""
-            SELECT COALESCE(SUM(total_amount), 0) as total_revenue,
-                   COALESCE(SUM(total_amount * partner_a_share / 100.0), 0) as partner_a_revenue,
-                   COALESCE(SUM(total_amount * partner_b_share / 100.0), 0) as partner_b_revenue
-            FROM invoices i WHERE status = 'paid' {date_filter}
+        c.execute("""
+            SELECT source, status, month, count, amount, partner_a, partner_b
+            FROM dashboard_rollup WHERE count != 0
         """)
-        revenue = c.fetchone()
-
-        c.execute("SELECT COALESCE(SUM(total_amount), 0) FROM invoices WHERE status IN ('draft', 'sent')")
-        outstanding = c.fetchone()[0]
-
-        expense_date_filter = ""
-        if period == "month":
-            expense_date_filter = f" AND date >= '{start}'"
-        elif period == "year":
-            expense_date_filter = f" AND date >= '{start}'"
-
-        c.execute(f"SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE 1=1 {expense_date_filter}")
-        total_expenses = c.fetchone()[0]
-
-        c.execute("SELECT COUNT(*) FROM invoices WHERE status='draft'")
-        draft_count = c.fetchone()[0]
-
-        c.execute("SELECT COUNT(*) FROM invoices WHERE status='sent'")
-        sent_count = c.fetchone()[0]
-
-        c.execute("SELECT COUNT(*) FROM invoices WHERE status='paid'")
-        paid_count = c.fetchone()[0]
+        total_revenue = partner_a_revenue = partner_b_revenue = 0
+        outstanding = total_expenses = 0
+        invoice_counts = {"draft": 0, "sent": 0, "paid": 0}
+        for source, status, month, count, amount, partner_a, partner_b in c.fetchall():
+            in_period = start_month is None or month >= start_month
+            if source == "invoice":
+                if status in invoice_counts:
+                    invoice_counts[status] += count
+                if status == "paid" and in_period:
+                    total_revenue += amount
+                    partner_a_revenue += partner_a
+                    partner_b_revenue += partner_b
+                elif status in ("draft", "sent"):
+                    outstanding += amount
+            elif in_period:
+                total_expenses += amount
 
         return {
-            "total_revenue": revenue[0] or 0,
-            "partner_a_revenue": revenue[1] or 0,
-            "partner_b_revenue": revenue[2] or 0,
-            "outstanding": outstanding or 0,
-            "total_expenses": total_expenses or 0,
-            "net_profit": (revenue[0] or 0) - (total_expenses or 0),
-            "invoice_counts": {"draft": draft_count, "sent": sent_count, "paid": paid_count}
+            "total_revenue": total_revenue,
+            "partner_a_revenue": partner_a_revenue,
+            "partner_b_revenue": partner_b_revenue,
+            "outstanding": outstanding,
+            "total_expenses": total_expenses,
+            "net_profit": total_revenue - total_expenses,
+            "invoice_counts": invoice_counts
         }
 
 @app.get("/dashboard/renewals")
-def get_dashboard_renewals(days: int = 30):
+def get_dashboard_renewals(request: Request, response: Response, days: int = 30):
     from datetime import datetime, timedelta
+    today = datetime.now().date()
+    cached = not_modified(request, response, ["payment_events", "clients", "recurring_fees"], days, today)
+    if cached:
+        return cached
     with db() as conn:
         c = conn.cursor()
-        today = datetime.now().date()
         end_date = today + timedelta(days=days)
 
         c.execute("""
@@ -1577,7 +3373,7 @@ def get_dashboard_renewals(days: int = 30):
             ORDER BY pe.due_date ASC
         """, (today.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")))
         rows = c.fetchall()
-        renewals = [dict(zip([col[0] for col in c.description], row)) for row in rows]
+        renewals = rows_to_dicts(c, rows)
 
         for r in renewals:
             due = datetime.strptime(r["due_date"], "%Y-%m-%d").date()
@@ -1591,7 +3387,10 @@ def get_dashboard_renewals(days: int = 30):
         return renewals
 
 @app.get("/dashboard/outstanding")
-def get_dashboard_outstanding():
+def get_dashboard_outstanding(request: Request, response: Response):
+    cached = not_modified(request, response, ["invoices", "clients"])
+    if cached:
+        return cached
     with db() as conn:
         c = conn.cursor()
         c.execute("""
@@ -1601,29 +3400,21 @@ def get_dashboard_outstanding():
             WHERE i.status IN ('draft', 'sent')
             ORDER BY i.status DESC, i.id DESC
         """)
-        rows = c.fetchall()
-        return [dict(zip([col[0] for col in c.description], row)) for row in rows]
+        return rows_to_dicts(c, c.fetchall())
 
 @app.get("/dashboard/partner-earnings")
-def get_partner_earnings(period: str = "all"):
-    from datetime import datetime
+def get_partner_earnings(request: Request, response: Response, period: str = "all"):
+    start_month = period_start_month(period)
+    cached = not_modified(request, response, ["invoices", "partners"], period, start_month)
+    if cached:
+        return cached
     with db() as conn:
         c = conn.cursor()
-
-        date_filter = ""
-        if period == "month":
-            start = datetime.now().replace(day=1).strftime("%Y-%m-%d")
-            date_filter = f" AND paid_date >= '{start}'"
-        elif period == "year":
-            start = datetime.now().replace(month=1, day=1).strftime("%Y-%m-%d")
-            date_filter = f" AND paid_date >= '{start}'"
-
-        c.execute(f"""
-            SELECT
-                COALESCE(SUM(total_amount * partner_a_share / 100.0), 0) as partner_a,
-                COALESCE(SUM(total_amount * partner_b_share / 100.0), 0) as partner_b
-            FROM invoices WHERE status = 'paid' {date_filter}
-        """)
+        c.execute("""
+            SELECT COALESCE(SUM(partner_a), 0), COALESCE(SUM(partner_b), 0)
+            FROM dashboard_rollup
+            WHERE source = 'invoice' AND status = 'paid' AND month >= ?
+        """, (start_month or "",))
         earnings = c.fetchone()
 
         c.execute("SELECT id, name, color FROM partners ORDER BY id")
@@ -1642,7 +3433,7 @@ def get_telegram_config():
         c.execute("SELECT * FROM telegram_config WHERE id=1")
         row = c.fetchone()
         if row:
-            return dict(zip([col[0] for col in c.description], row))
+            return row_to_dict(c, row)
         return {}
 
 @app.put("/telegram/config")
@@ -1651,7 +3442,7 @@ def update_telegram_config(config: dict = Body(...)):
         c = conn.cursor()
         updates = []
         params = []
-        for field in ["bot_token", "enabled", "notify_renewals_7d", "notify_renewals_14d", "notify_renewals_30d", "notify_overdue"]:
+        for field in ["bot_token", "enabled", "notify_renewals_7d", "notify_renewals_14d", "notify_renewals_30d", "notify_overdue", "digest"]:
             if field in config:
                 updates.append(f"{field}=?")
                 params.append(config[field])
@@ -1661,9 +3452,104 @@ def update_telegram_config(config: dict = Body(...)):
         conn.commit()
         return {"ok": True}
 
+class TokenBucket:
+    """Async token bucket: acquire() waits until a token is available."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            while True:
+                now = loop.time()
+                if self.updated is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# name -> (event loop, httpx.AsyncClient); one keep-alive pool per outbound service
+http_clients = {}
+
+def get_http_client(name, max_connections, timeout=10):
+    """The shared client for name, recreated if the event loop it was opened on is gone."""
+    import httpx
+    loop = asyncio.get_running_loop()
+    entry = http_clients.get(name)
+    if entry is None or entry[0] is not loop:
+        client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        http_clients[name] = entry = (loop, client)
+    return entry[1]
+
+async def close_http_clients():
+    for _, client in http_clients.values():
+        await client.aclose()
+    http_clients.clear()
+
+async def dispatch_telegram_messages(bot_token, messages):
+    """Send (chat_id, text) pairs concurrently within the rate limits.
+
+    Returns one bool per message, True when Telegram accepted it. A 429 is
+    retried after the retry_after Telegram asks for.
+    """
+    client = get_http_client("telegram", TELEGRAM_CONCURRENCY)
+    url = f"{TELEGRAM_API_URL}/bot{bot_token}/sendMessage"
+    semaphore = asyncio.Semaphore(TELEGRAM_CONCURRENCY)
+    global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, capacity=max(1, int(TELEGRAM_GLOBAL_RATE)))
+    chat_buckets = {}
+
+    async def send(chat_id, text):
+        bucket = chat_buckets.setdefault(chat_id, TokenBucket(TELEGRAM_CHAT_RATE))
+        for _ in range(TELEGRAM_MAX_RETRIES):
+            await bucket.acquire()
+            await global_bucket.acquire()
+            async with semaphore:
+                try:
+                    response = await client.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"})
+                except Exception as e:
+                    print(f"Telegram send to {chat_id} failed: {e}")
+                    telegram_messages.inc("error")
+                    return False
+            if response.status_code == 429:
+                telegram_messages.inc("rate_limited")
+                try:
+                    retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+                except ValueError:
+                    retry_after = 1
+                await asyncio.sleep(retry_after)
+                continue
+            if response.status_code != 200:
+                print(f"Telegram send to {chat_id} failed: HTTP {response.status_code}")
+            telegram_messages.inc("sent" if response.status_code == 200 else "failed")
+            return response.status_code == 200
+        telegram_messages.inc("gave_up")
+        return False
+
+    return await asyncio.gather(*(send(chat_id, text) for chat_id, text in messages))
+
+def telegram_digests(alerts):
+    """Group (text, ref_type, ref_id) alerts into as few messages as the length limit allows."""
+    digests = []
+    for text, ref_type, ref_id in alerts:
+        if digests and len(digests[-1][0]) + 2 + len(text) <= TELEGRAM_MESSAGE_LIMIT:
+            digests[-1][0] += "\n\n" + text
+            digests[-1][1].append((ref_type, ref_id))
+        else:
+            digests.append([text, [(ref_type, ref_id)]])
+    return digests
+
 @app.post("/telegram/test")
 async def test_telegram():
-    import httpx
     with db() as conn:
         c = conn.cursor()
         c.execute("SELECT bot_token FROM telegram_config WHERE id=1")
@@ -1677,17 +3563,11 @@ async def test_telegram():
         if not chat_ids:
             raise HTTPException(400, "No Telegram chat IDs configured for partners")
 
-        async with httpx.AsyncClient() as client:
-            for chat_id in chat_ids:
-                await client.post(
-                    f"https://api.telegram.org/bot{bot_token}/sendMessage",
-                    json={"chat_id": chat_id, "text": "Test notification from Invoice Manager", "parse_mode": "HTML"}
-                )
-        return {"ok": True, "sent_to": len(chat_ids)}
+    await dispatch_telegram_messages(bot_token, [(chat_id, "Test notification from Invoice Manager") for chat_id in chat_ids])
+    return {"ok": True, "sent_to": len(chat_ids)}
 
 @app.post("/telegram/check")
 async def check_and_send_notifications():
-    import httpx
     from datetime import datetime, timedelta
 
     with db() as conn:
@@ -1696,7 +3576,7 @@ async def check_and_send_notifications():
         config_row = c.fetchone()
         if not config_row:
             return {"sent": 0}
-        config = dict(zip([col[0] for col in c.description], config_row))
+        config = row_to_dict(c, config_row)
 
         if not config.get("enabled") or not config.get("bot_token"):
             return {"sent": 0}
@@ -1708,23 +3588,13 @@ async def check_and_send_notifications():
             return {"sent": 0}
 
         today = datetime.now().date()
-        sent_count = 0
 
-        async def send_message(chat_id, text, ref_type, ref_id):
-            nonlocal sent_count
-            c.execute("SELECT COUNT(*) FROM notifications_log WHERE type=? AND reference_id=? AND DATE(sent_at)=?",
-                     (ref_type, ref_id, today.strftime("%Y-%m-%d")))
-            if c.fetchone()[0] > 0:
-                return
-            async with httpx.AsyncClient() as client:
-                await client.post(
-                    f"https://api.telegram.org/bot{bot_token}/sendMessage",
-                    json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
-                )
-            c.execute("INSERT INTO notifications_log (type, reference_id, sent_at, chat_id) VALUES (?, ?, ?, ?)",
-                     (ref_type, ref_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), chat_id))
-            sent_count += 1
+        # Everything already sent today, loaded once instead of checked per message
+        c.execute("SELECT type, reference_id, chat_id FROM notifications_log WHERE sent_at >= ? AND sent_at < ?",
+                  (today.strftime("%Y-%m-%d"), (today + timedelta(days=1)).strftime("%Y-%m-%d")))
+        already_sent = set(c.fetchall())
 
+        alerts = []
         for days, config_key in [(7, "notify_renewals_7d"), (14, "notify_renewals_14d"), (30, "notify_renewals_30d")]:
             if config.get(config_key):
                 target_date = today + timedelta(days=days)
@@ -1737,8 +3607,7 @@ async def check_and_send_notifications():
                 for row in c.fetchall():
                     pe = dict(zip(["id", "description", "amount", "currency", "due_date", "client_name"], row))
                     msg = f"Renewal in {days} days:\n{pe['client_name']} - {pe['description']}\n{pe['amount']} {pe['currency']} (due: {pe['due_date']})"
-                    for chat_id in chat_ids:
-                        await send_message(chat_id, msg, f"renewal_{days}d", pe["id"])
+                    alerts.append((msg, f"renewal_{days}d", pe["id"]))
 
         if config.get("notify_overdue"):
             c.execute("""
@@ -1750,11 +3619,215 @@ async def check_and_send_notifications():
             for row in c.fetchall():
                 pe = dict(zip(["id", "description", "amount", "currency", "due_date", "client_name"], row))
                 msg = f"OVERDUE: {pe['client_name']} - {pe['description']}\n{pe['amount']} {pe['currency']} (was due: {pe['due_date']})"
-                for chat_id in chat_ids:
-                    await send_message(chat_id, msg, "overdue", pe["id"])
+                alerts.append((msg, "overdue", pe["id"]))
+
+    # (chat_id, text, [(ref_type, ref_id), ...]) per outgoing message
+    outgoing = []
+    for chat_id in chat_ids:
+        pending = [alert for alert in alerts if (alert[1], alert[2], chat_id) not in already_sent]
+        if config.get("digest"):
+            outgoing.extend((chat_id, text, refs) for text, refs in telegram_digests(pending))
+        else:
+            outgoing.extend((chat_id, text, [(ref_type, ref_id)]) for text, ref_type, ref_id in pending)
 
-        conn.commit()
-        return {"sent": sent_count}
+    results = await dispatch_telegram_messages(bot_token, [(chat_id, text) for chat_id, text, _ in outgoing])
+
+    sent_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log_rows = [
+        (ref_type, ref_id, sent_at, chat_id)
+        for (chat_id, _, refs), ok in zip(outgoing, results) if ok
+        for ref_type, ref_id in refs
+    ]
+    with db() as conn:
+        conn.executemany("INSERT INTO notifications_log (type, reference_id, sent_at, chat_id) VALUES (?, ?, ?, ?)", log_rows)
+    return {"sent": sum(results), "failed": len(results) - sum(results)}
+
+def webhook_wants(endpoint_events, event_type):
+    """Whether a comma-separated subscription ("*", "invoice.*", "invoice.paid", ...) covers event_type."""
+    for pattern in (endpoint_events or "*").split(","):
+        pattern = pattern.strip()
+        if pattern == "*" or pattern == event_type or (pattern.endswith(".*") and event_type.startswith(pattern[:-1])):
+            return True
+    return False
+
+def webhook_backoff(failures):
+    return min(WEBHOOK_MAX_BACKOFF_SECONDS, 2 ** min(failures, 20)) * (0.5 + secrets.randbelow(1000) / 1000)
+
+def fetch_outbox_batch(after_id):
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, event_type, payload, created_at FROM outbox WHERE id > ? ORDER BY id LIMIT ?",
+                  (after_id, WEBHOOK_BATCH_SIZE))
+        return c.fetchall()
+
+def record_webhook_result(endpoint, last_id, delivered, error):
+    """Store a batch outcome: back off on error, otherwise advance the endpoint's cursor."""
+    from datetime import datetime, timedelta
+    now = datetime.now()
+    with db() as conn:
+        if error:
+            failures = endpoint["failures"] + 1
+            conn.execute(
+                "UPDATE webhook_endpoints SET failures=?, failed_attempts=failed_attempts+1, last_error=?, next_attempt_at=? WHERE id=?",
+                (failures, error, (now + timedelta(seconds=webhook_backoff(failures))).isoformat(), endpoint["id"])
+            )
+            return
+        conn.execute("""
+            UPDATE webhook_endpoints SET last_delivered_id=?, failures=0, next_attempt_at=NULL,
+                delivered_count=delivered_count+?, last_success_at=? WHERE id=?
+        """, (last_id, delivered, now.isoformat(), endpoint["id"]))
+
+async def deliver_webhook_batch(endpoint):
+    """Post the next batch of outbox events to one endpoint and advance its cursor.
+
+    Returns True when a full batch was delivered and more may be waiting.
+    """
+    import hmac
+
+    loop = asyncio.get_running_loop()
+    rows = await loop.run_in_executor(None, fetch_outbox_batch, endpoint["last_delivered_id"])
+    if not rows:
+        return False
+    last_id = rows[-1][0]
+    events = [
+        {"id": event_id, "type": event_type, "created_at": created_at, "data": json.loads(payload)}
+        for event_id, event_type, payload, created_at in rows
+        if webhook_wants(endpoint["events"], event_type)
+    ]
+
+    error = None
+    if events:
+        body = json.dumps({"events": events}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if endpoint["secret"]:
+            signature = hmac.new(endpoint["secret"].encode("utf-8"), body, hashlib.sha256).hexdigest()
+            headers["X-Webhook-Signature"] = f"sha256={signature}"
+        try:
+            client = get_http_client("webhooks", WEBHOOK_CONCURRENCY, timeout=WEBHOOK_TIMEOUT_SECONDS)
+            response = await client.post(endpoint["url"], content=body, headers=headers)
+            if not 200 <= response.status_code < 300:
+                error = f"HTTP {response.status_code}"
+        except Exception as e:
+            error = str(e) or type(e).__name__
+
+    await loop.run_in_executor(None, record_webhook_result, endpoint, last_id, len(events), error)
+    if error:
+        print(f"Webhook delivery to {endpoint['url']} failed: {error}")
+        webhook_batches.inc("failed")
+        return False
+    endpoint["last_delivered_id"] = last_id
+    endpoint["failures"] = 0
+    if events:
+        webhook_batches.inc("delivered")
+        webhook_events.inc(amount=len(events))
+    return len(rows) == WEBHOOK_BATCH_SIZE
+
+def due_webhook_endpoints():
+    """Enabled endpoints with pending events that are not backing off."""
+    from datetime import datetime
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT * FROM webhook_endpoints
+            WHERE enabled = 1 AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+              AND last_delivered_id < (SELECT COALESCE(MAX(id), 0) FROM outbox)
+        """, (datetime.now().isoformat(),))
+        return rows_to_dicts(c, c.fetchall())
+
+async def deliver_webhooks():
+    """One delivery round over every endpoint with pending events that is not backing off."""
+    loop = asyncio.get_running_loop()
+    endpoints = await loop.run_in_executor(None, due_webhook_endpoints)
+    semaphore = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+
+    async def drain(endpoint):
+        # One batch in flight per endpoint keeps its events in order; the lease
+        # stops other uvicorn workers from delivering the same batch.
+        async with semaphore:
+            lease = f"webhook:{endpoint['id']}"
+            while (await loop.run_in_executor(None, acquire_scheduler_lease, lease, WEBHOOK_TIMEOUT_SECONDS * 3)
+                   and await deliver_webhook_batch(endpoint)):
+                pass
+
+    await asyncio.gather(*(drain(endpoint) for endpoint in endpoints))
+    await loop.run_in_executor(None, prune_outbox)
+
+def prune_outbox():
+    """Drop events every endpoint has received (all of them when there are none).
+
+    Disabled endpoints count too, so re-enabling one resumes from its cursor
+    instead of silently skipping what happened meanwhile; delete an endpoint
+    that is not coming back to release its backlog.
+    """
+    with db() as conn:
+        conn.execute("""
+            DELETE FROM outbox WHERE id <= COALESCE(
+                (SELECT MIN(last_delivered_id) FROM webhook_endpoints),
+                (SELECT MAX(id) FROM outbox)
+            )
+        """)
+
+async def webhook_delivery_worker():
+    while True:
+        try:
+            await deliver_webhooks()
+        except Exception as e:
+            print(f"Webhook delivery round failed: {e}")
+        await asyncio.sleep(WEBHOOK_POLL_SECONDS)
+
+def webhook_endpoint_stats(c, endpoint):
+    c.execute("SELECT COUNT(*) FROM outbox WHERE id > ?", (endpoint["last_delivered_id"],))
+    endpoint["backlog"] = c.fetchone()[0]
+    endpoint.pop("secret", None)
+    return endpoint
+
+@app.get("/webhooks")
+def get_webhooks():
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM webhook_endpoints ORDER BY id")
+        return [webhook_endpoint_stats(c, endpoint) for endpoint in rows_to_dicts(c, c.fetchall())]
+
+@app.post("/webhooks")
+def create_webhook(endpoint: dict = Body(...)):
+    from datetime import datetime
+    if not urlparse(endpoint.get("url") or "").scheme in ("http", "https"):
+        raise HTTPException(400, "url must be an http(s) URL")
+    with db() as conn:
+        c = conn.cursor()
+        # New endpoints receive events from now on, not the retained backlog
+        c.execute("""
+            INSERT INTO webhook_endpoints (url, secret, events, enabled, last_delivered_id, created_at)
+            VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(id), 0) FROM outbox), ?)
+        """, (endpoint["url"], endpoint.get("secret"), endpoint.get("events") or "*",
+              1 if endpoint.get("enabled", True) else 0, datetime.now().isoformat(timespec="seconds")))
+        return {"id": c.lastrowid}
+
+@app.put("/webhooks/{webhook_id}")
+def update_webhook(webhook_id: int, endpoint: dict = Body(...)):
+    with db() as conn:
+        c = conn.cursor()
+        updates = []
+        params = []
+        for field in ["url", "secret", "events", "enabled"]:
+            if field in endpoint:
+                updates.append(f"{field}=?")
+                params.append(endpoint[field])
+        if endpoint.get("enabled"):
+            # Re-enabling retries right away
+            updates.append("next_attempt_at=NULL")
+        if not updates:
+            return {"ok": True}
+        c.execute(f"UPDATE webhook_endpoints SET {', '.join(updates)} WHERE id=?", params + [webhook_id])
+        if c.rowcount == 0:
+            raise HTTPException(404, "Webhook not found")
+        return {"ok": True}
+
+@app.delete("/webhooks/{webhook_id}")
+def delete_webhook(webhook_id: int):
+    with db() as conn:
+        conn.execute("DELETE FROM webhook_endpoints WHERE id=?", (webhook_id,))
+        return {"ok": True}
 
 @app.post("/recurring-fees/{fee_id}/generate-invoice")
 def generate_invoice_from_recurring(fee_id: int):
@@ -1764,7 +3837,7 @@ def generate_invoice_from_recurring(fee_id: int):
         fee_row = c.fetchone()
         if not fee_row:
             raise HTTPException(404, "Recurring fee not found")
-        fee = dict(zip([col[0] for col in c.description], fee_row))
+        fee = row_to_dict(c, fee_row)
 
         c.execute("SELECT id FROM templates LIMIT 1")
         template_row = c.fetchone()
@@ -1772,13 +3845,12 @@ def generate_invoice_from_recurring(fee_id: int):
             raise HTTPException(400, "No templates available")
         template_id = template_row[0]
 
-        c.execute("SELECT id FROM partners ORDER BY id LIMIT 2")
+        c.execute("SELECT id, default_share FROM partners ORDER BY id LIMIT 2")
         partners = c.fetchall()
         partner_a_share = 50.0
         partner_b_share = 50.0
         if len(partners) >= 2:
-            c.execute("SELECT default_share FROM partners WHERE id=?", (partners[0][0],))
-            partner_a_share = c.fetchone()[0]
+            partner_a_share = partners[0][1]
             partner_b_share = 100.0 - partner_a_share
 
         from datetime import datetime
@@ -1788,11 +3860,7 @@ def generate_invoice_from_recurring(fee_id: int):
             "notes": ""
         })
 
-        while True:
-            invoice_number = generate_invoice_number()
-            c.execute("SELECT COUNT(*) FROM invoices WHERE invoice_number=?", (invoice_number,))
-            if c.fetchone()[0] == 0:
-                break
+        invoice_number = invoice_numbers.allocate(c, template_id)
 
         total = fee["amount"]
         c.execute(
@@ -1815,30 +3883,32 @@ def generate_invoice_from_recurring(fee_id: int):
         return {"invoice_id": invoice_id, "invoice_number": invoice_number}
 
 @app.get("/todos")
-def get_todos(status: str = None, priority: str = None, client_id: int = None):
+def get_todos(status: str = None, priority: str = None, client_id: int = None, limit: int = None, cursor: str = None):
     with db() as conn:
         c = conn.cursor()
-        query = """
-            SELECT t.*, c.name as client_name
-            FROM todos t
-            LEFT JOIN clients c ON t.client_id = c.id
-            WHERE 1=1
-        """
+        conditions = []
         params = []
         if status:
-            query += " AND t.status = ?"
+            conditions.append("t.status = ?")
             params.append(status)
         if priority:
-            query += " AND t.priority = ?"
+            conditions.append("t.priority = ?")
             params.append(priority)
         if client_id:
-            query += " AND t.client_id = ?"
+            conditions.append("t.client_id = ?")
             params.append(client_id)
-        query += " ORDER BY CASE t.priority WHEN 'high' THEN 1 WHEN 'medium' THEN 2 ELSE 3 END, t.due_date ASC NULLS LAST, t.created_at DESC"
-        c.execute(query, params)
-        rows = c.fetchall()
-        cols = [desc[0] for desc in c.description]
-        return [dict(zip(cols, row)) for row in rows]
+        sort_keys = [
+            ("CASE t.priority WHEN 'high' THEN 1 WHEN 'medium' THEN 2 ELSE 3 END", "ASC"),
+            ("COALESCE(t.due_date, '9999-12-31')", "ASC"),
+            ("COALESCE(t.created_at, '')", "DESC"),
+            ("t.id", "ASC"),
+        ]
+        return fetch_page(
+            c,
+            "t.*, c.name as client_name",
+            "FROM todos t LEFT JOIN clients c ON t.client_id = c.id",
+            conditions, params, sort_keys, limit, cursor
+        )
 
 @app.post("/todos")
 def create_todo(todo: dict = Body(...)):
@@ -1898,30 +3968,26 @@ def delete_todo(todo_id: int):
         return {"ok": True}
 
 @app.get("/calendar/events")
-def get_calendar_events(start: str = None, end: str = None, client_id: int = None):
+def get_calendar_events(start: str = None, end: str = None, client_id: int = None, limit: int = None, cursor: str = None):
     with db() as conn:
         c = conn.cursor()
-        query = """
-            SELECT e.*, c.name as client_name
-            FROM calendar_events e
-            LEFT JOIN clients c ON e.client_id = c.id
-            WHERE 1=1
-        """
+        conditions = []
         params = []
         if start:
-            query += " AND e.start_datetime >= ?"
+            conditions.append("e.start_datetime >= ?")
             params.append(start)
         if end:
-            query += " AND e.start_datetime <= ?"
+            conditions.append("e.start_datetime <= ?")
             params.append(end)
         if client_id:
-            query += " AND e.client_id = ?"
+            conditions.append("e.client_id = ?")
             params.append(client_id)
-        query += " ORDER BY e.start_datetime ASC"
-        c.execute(query, params)
-        rows = c.fetchall()
-        cols = [desc[0] for desc in c.description]
-        return [dict(zip(cols, row)) for row in rows]
+        return fetch_page(
+            c,
+            "e.*, c.name as client_name",
+            "FROM calendar_events e LEFT JOIN clients c ON e.client_id = c.id",
+            conditions, params, [("e.start_datetime", "ASC"), ("e.id", "ASC")], limit, cursor
+        )
 
 @app.post("/calendar/events")
 def create_calendar_event(event: dict = Body(...)):
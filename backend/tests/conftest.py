@@ -0,0 +1,102 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main creates its working directories relative to the cwd on import
+os.chdir(tempfile.mkdtemp(prefix="invoice-tests-"))
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+TEMPLATE_HTML = b"""<html><head><link rel="stylesheet" href="style.css"></head><body>
+<h1>{{ invoice_number }}</h1>
+{% for item in items %}<p>{{ item.desc }} {{ item.total }}</p>{% endfor %}
+<img src="{{ qr_image }}">
+</body></html>"""
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run every test in its own directory with a freshly migrated db.sqlite."""
+    main.close_db_pool()
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(main.TEMPLATE_DIR, exist_ok=True)
+    for cache in (main.template_cache, main.template_css_cache, main.qr_cache):
+        cache.discard(lambda key: True)
+    monkeypatch.setattr(main, "qr_disk_entries", None)
+    with main.query_stats_lock:
+        main.query_stats.clear()
+    main.slow_queries.clear()
+    main.init_db()
+    yield tmp_path
+    main.close_db_pool()
+
+@pytest.fixture
+def client():
+    """TestClient with the app lifespan (render workers, webhook worker) running."""
+    with TestClient(main.app) as client:
+        yield client
+
+@pytest.fixture
+def seed(client):
+    """Upload a template and add a client; returns (template_id, client_id)."""
+    response = client.post("/templates", data={"name": "Basic"},
+                           files={"html_file": ("invoice.html", TEMPLATE_HTML), "css_file": ("style.css", b"h1 { color: red; }")})
+    template_id = response.json()["id"]
+    response = client.post("/clients", json={"name": "ACME AG", "address": "Bahnhofstrasse 1", "cap": "8001",
+                                             "city": "Zurich", "nation": "CH", "email": "billing@acme.ch"})
+    return template_id, response.json()["id"]
+
+def invoice_form(template_id, client_id, items=3, **extra):
+    data = {"items": [{"desc": f"Item {i}", "price": 10 + i, "qty": 1} for i in range(items)],
+            "date": "2026-01-05", "notes": ""}
+    return {"client_id": client_id, "template_id": template_id, "data": json.dumps(data), **extra}
+
+StubRequest = namedtuple("StubRequest", "at path headers body")
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = StubRequest(time.monotonic(), self.path, dict(self.headers), self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.requests.append(request)
+        status, payload = self.server.respond(request)
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    """Local HTTP server that records every POST and answers it with respond(request) -> (status, json)."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.requests = []
+        self.lock = threading.Lock()
+        self.respond = lambda request: (200, {"ok": True})
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,36 @@
+import hashlib
+import os
+
+import main
+from conftest import invoice_form
+
+def blob_rows():
+    with main.db() as conn:
+        return dict(conn.execute("SELECT sha256, refcount FROM blobs").fetchall())
+
+def test_replacing_a_logo_collects_the_old_blob(client, seed):
+    template_id, client_id = seed
+    old, new = b"old logo", b"new logo"
+    old_digest, new_digest = hashlib.sha256(old).hexdigest(), hashlib.sha256(new).hexdigest()
+
+    response = client.post("/invoices", data=invoice_form(template_id, client_id), files={"logo_file": ("logo.png", old)})
+    invoice_id = response.json()["id"]
+    assert blob_rows() == {old_digest: 1}
+    assert os.path.exists(main.blob_path(old_digest))
+
+    response = client.put(f"/invoices/{invoice_id}", data=invoice_form(template_id, client_id),
+                          files={"logo_file": ("logo.png", new)})
+    assert response.status_code == 200
+    assert blob_rows() == {new_digest: 1}
+    assert not os.path.exists(main.blob_path(old_digest))
+    with open(os.path.join(main.RESULTS_DIR, f"invoice_{invoice_id}", "uploaded_logo.png"), "rb") as f:
+        assert f.read() == new
+
+def test_reuploading_the_same_logo_keeps_its_blob(client, seed):
+    template_id, client_id = seed
+    response = client.post("/invoices", data=invoice_form(template_id, client_id), files={"logo_file": ("logo.png", b"logo")})
+    invoice_id = response.json()["id"]
+    client.put(f"/invoices/{invoice_id}", data=invoice_form(template_id, client_id), files={"logo_file": ("logo.png", b"logo")})
+    digest = hashlib.sha256(b"logo").hexdigest()
+    assert blob_rows() == {digest: 1}
+    assert os.path.exists(main.blob_path(digest))
@@ -0,0 +1,64 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.fixture
+def api():
+    return TestClient(main.app)
+
+def add_invoice(total, status="draft"):
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO clients (name, address, cap, city, nation, email) VALUES ('ACME AG', 'Street 1', '8000', 'Zurich', 'CH', 'a@b.ch')")
+        c.execute("""INSERT INTO invoices (invoice_number, client_id, template_id, data, status, total_amount, partner_a_share, partner_b_share)
+                     VALUES (?, ?, 1, '{}', ?, ?, 60, 40)""", (f"D-{c.lastrowid}", c.lastrowid, status, total))
+        return c.lastrowid
+
+def test_rollup_follows_invoice_and_expense_changes(api):
+    paid = add_invoice(1000)
+    sent = add_invoice(300)
+    deleted = add_invoice(50, "sent")
+    assert api.put(f"/invoices/{paid}/status", json={"status": "paid"}).status_code == 200
+    assert api.put(f"/invoices/{sent}/status", json={"status": "sent"}).status_code == 200
+    assert api.delete(f"/invoices/{deleted}").status_code == 200
+    expense = api.post("/expenses", json={"date": "2026-02-01", "description": "Laptop", "amount": 200,
+                                          "category": "hardware", "expense_type": "shared", "paid_by": 1}).json()["id"]
+    api.put(f"/expenses/{expense}", json={"date": "2026-02-01", "description": "Laptop", "amount": 250,
+                                          "category": "hardware", "expense_type": "shared", "paid_by": 1})
+    dropped = api.post("/expenses", json={"date": "2026-02-02", "description": "Lunch", "amount": 40,
+                                          "category": "other", "expense_type": "shared", "paid_by": 1}).json()["id"]
+    api.delete(f"/expenses/{dropped}")
+
+    assert api.post("/maintenance/check-dashboard-rollup").json() == {"ok": True, "mismatches": [], "repaired": False}
+    stats = api.get("/dashboard/stats").json()
+    assert stats["total_revenue"] == 1000
+    assert stats["partner_a_revenue"] == 600 and stats["partner_b_revenue"] == 400
+    assert stats["outstanding"] == 300
+    assert stats["total_expenses"] == 250
+    assert stats["invoice_counts"] == {"draft": 0, "sent": 1, "paid": 1}
+
+def test_check_repairs_a_drifted_rollup(api):
+    add_invoice(120, "sent")
+    with main.db() as conn:
+        conn.execute("UPDATE dashboard_rollup SET amount = amount + 5")
+    report = api.post("/maintenance/check-dashboard-rollup", params={"repair": True}).json()
+    assert not report["ok"] and report["repaired"]
+    assert api.post("/maintenance/check-dashboard-rollup").json()["ok"]
+    assert api.get("/dashboard/stats").json()["outstanding"] == 120
+
+def test_unchanged_dashboard_answers_304_until_a_write(api):
+    add_invoice(80, "sent")
+    first = api.get("/dashboard/outstanding")
+    etag = first.headers["etag"]
+    repeat = api.get("/dashboard/outstanding", headers={"If-None-Match": etag})
+    assert repeat.status_code == 304
+    assert repeat.headers["etag"] == etag
+
+    other_period = api.get("/dashboard/stats", params={"period": "year"}, headers={"If-None-Match": etag})
+    assert other_period.status_code == 200
+
+    add_invoice(20, "sent")
+    changed = api.get("/dashboard/outstanding", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
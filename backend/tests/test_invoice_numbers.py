@@ -0,0 +1,80 @@
+import threading
+from datetime import date
+
+import pytest
+
+import main
+
+def allocate(allocator, template_id=None):
+    with main.db() as conn:
+        return allocator.allocate(conn.cursor(), template_id)
+
+def test_random_numbers_are_unique_across_threads():
+    allocator = main.InvoiceNumberAllocator("random")
+    numbers = []
+
+    def worker():
+        for _ in range(50):
+            numbers.append(allocate(allocator))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(numbers)) == 200
+    assert all(len(number) == 8 and number.isalnum() for number in numbers)
+
+def test_yearly_and_template_formats():
+    year = date.today().year
+    yearly = main.InvoiceNumberAllocator("yearly")
+    assert [allocate(yearly) for _ in range(2)] == [f"{year}-000001", f"{year}-000002"]
+
+    with main.db() as conn:
+        conn.execute("INSERT INTO templates (name, template_dir, html_filename, invoice_prefix) VALUES ('A', 'a', 'a.html', 'ACME-')")
+        conn.execute("INSERT INTO templates (name, template_dir, html_filename) VALUES ('B', 'b', 'b.html')")
+    per_template = main.InvoiceNumberAllocator("template", block_size=10)
+    assert [allocate(per_template, 1), allocate(per_template, 2), allocate(per_template, 1)] == \
+        ["ACME-000001", "T2-000001", "ACME-000002"]
+
+def test_backfill_step_numbers_invoices_without_one():
+    with main.db() as conn:
+        conn.execute("INSERT INTO invoices (client_id, template_id, data) VALUES (1, 1, '{}')")
+        conn.execute("DELETE FROM schema_version WHERE version >= 11")
+    main.init_db()
+    with main.db() as conn:
+        number = conn.execute("SELECT invoice_number FROM invoices").fetchone()[0]
+        assert conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] == len(main.MIGRATIONS)
+    assert number is not None and len(number) == 8
+    assert allocate(main.InvoiceNumberAllocator("random")) != number
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    """An unversioned database whose invoices table predates invoice numbers."""
+    main.close_db_pool()
+    (tmp_path / "legacy").mkdir()
+    monkeypatch.chdir(tmp_path / "legacy")
+    with main.db() as conn:
+        conn.execute("CREATE TABLE invoices (id INTEGER PRIMARY KEY AUTOINCREMENT, client_id INTEGER, template_id INTEGER, data TEXT, created_at TEXT)")
+    return main.db
+
+def test_legacy_invoices_are_numbered_from_the_sequence(legacy_db):
+    with legacy_db() as conn:
+        conn.executemany("INSERT INTO invoices (client_id, template_id, data) VALUES (1, 1, '{}')", [()] * 3)
+    main.init_db()
+    with main.db() as conn:
+        numbers = [row[0] for row in conn.execute("SELECT invoice_number FROM invoices ORDER BY id")]
+    assert numbers == [main.scramble_invoice_number(value) for value in range(1, 4)]
+
+def test_migrations_skip_numbers_already_taken(legacy_db):
+    # Random numbers drawn before the sequence: one equal to its first value, one duplicated
+    taken = main.scramble_invoice_number(1)
+    with legacy_db() as conn:
+        conn.execute("ALTER TABLE invoices ADD COLUMN invoice_number TEXT")
+        conn.executemany("INSERT INTO invoices (invoice_number, client_id, template_id, data) VALUES (?, 1, 1, '{}')",
+                         [(taken,), ("LEGACY01",), ("LEGACY01",), (None,)])
+    main.init_db()
+    with main.db() as conn:
+        numbers = [row[0] for row in conn.execute("SELECT invoice_number FROM invoices ORDER BY id")]
+    assert numbers[:2] == [taken, "LEGACY01"]
+    assert None not in numbers and len(set(numbers)) == 4
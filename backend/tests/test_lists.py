@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.fixture
+def api():
+    return TestClient(main.app)
+
+def add_expenses(count):
+    """count expenses over a handful of dates, so many share a sort key."""
+    with main.db() as conn:
+        conn.executemany("""INSERT INTO expenses (date, description, amount, category, expense_type, paid_by, status)
+                            VALUES (?, ?, ?, 'office', 'shared', 1, 'pending')""",
+                         [(f"2026-0{1 + i % 4}-01", f"Expense {i}", 10 + i) for i in range(count)])
+
+def test_pages_cover_the_full_list_once(api):
+    add_expenses(25)
+    full = api.get("/expenses").json()
+    paged = []
+    cursor = None
+    while True:
+        params = {"limit": 7, **({"cursor": cursor} if cursor else {})}
+        page = api.get("/expenses", params=params).json()
+        assert len(page["items"]) <= 7
+        paged.extend(page["items"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert len(full) == 25
+    assert [expense["id"] for expense in paged] == [expense["id"] for expense in full]
+
+def test_rows_inserted_mid_walk_do_not_shift_pages(api):
+    add_expenses(10)
+    first = api.get("/expenses", params={"limit": 5}).json()
+    add_expenses(3)  # newer ids sort before the cursor on equal dates
+    second = api.get("/expenses", params={"limit": 5, "cursor": first["next_cursor"]}).json()
+    seen = {expense["id"] for expense in first["items"]}
+    assert not seen & {expense["id"] for expense in second["items"]}
+
+def test_bad_cursor_is_rejected(api):
+    assert api.get("/expenses", params={"limit": 5, "cursor": "not-a-cursor"}).status_code == 400
+
+def test_export_streams_every_row_in_list_order(api, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_CHUNK_SIZE", 4)
+    add_expenses(11)
+    listed = api.get("/expenses").json()
+
+    response = api.get("/export/expenses", params={"columns": "id,description,amount"})
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == ["id", "description", "amount"]
+    assert [int(row[0]) for row in rows[1:]] == [expense["id"] for expense in listed]
+
+    response = api.get("/export/expenses", params={"format": "ndjson"})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["id"] for line in lines] == [expense["id"] for expense in listed]
+    assert lines[0]["paid_by_name"] == listed[0]["paid_by_name"]
+
+def test_export_rejects_unknown_columns(api):
+    assert api.get("/export/expenses", params={"columns": "id,password"}).status_code == 400
@@ -0,0 +1,29 @@
+import re
+
+import main
+from conftest import invoice_form
+
+def samples(text):
+    """Parse Prometheus text into {'name{labels}': value}."""
+    return {key: float(value) for key, value in re.findall(r"^(\S+) (\S+)$", text, re.MULTILINE) if not key.startswith("#")}
+
+def test_metrics_cover_requests_and_render_stages(client, seed):
+    template_id, client_id = seed
+    invoice_id = client.post("/invoices", data=invoice_form(template_id, client_id)).json()["id"]
+    before = samples(client.get("/metrics").text)
+    client.get(f"/invoices/{invoice_id}")
+    client.get(f"/invoices/{invoice_id + 1000}")
+
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    after = samples(response.text)
+    found = 'http_request_duration_seconds_count{method="GET",route="/invoices/{invoice_id}",status="200"}'
+    missing = 'http_request_duration_seconds_count{method="GET",route="/invoices/{invoice_id}",status="404"}'
+    assert after[found] == before.get(found, 0) + 1
+    assert after[missing] == before.get(missing, 0) + 1
+    assert not any(f"/invoices/{invoice_id}\"" in key for key in after)
+    for stage in ("db_read", "qr_bill", "assets", "jinja", "weasyprint_layout", "pdf_write"):
+        assert after[f'invoice_render_stage_seconds_count{{stage="{stage}"}}'] >= 1
+    assert after["invoice_render_seconds_count"] >= 1
+    assert after['invoice_render_seconds_bucket{le="+Inf"}'] == after["invoice_render_seconds_count"]
+    assert after["render_running"] == 0
@@ -0,0 +1,39 @@
+import pytest
+
+import main
+
+def add_occurrences(*rows):
+    """Insert (status, invoice_id) copies of one recurring fee occurrence, bypassing the unique index."""
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("DROP INDEX idx_payment_events_fee_due")
+        c.execute("INSERT INTO clients (name, address, cap, city, nation, email) VALUES ('ACME AG', 'Street 1', '8000', 'Zurich', 'CH', 'a@b.ch')")
+        c.execute("INSERT INTO invoices (id, invoice_number, client_id, template_id, data) VALUES (7, 'A0000007', 1, 1, '{}')")
+        c.execute("INSERT INTO recurring_fees (client_id, amount, frequency, start_date) VALUES (1, 100, 'monthly', '2026-01-01')")
+        fee_id = c.lastrowid
+        ids = []
+        for status, invoice_id in rows:
+            c.execute("INSERT INTO payment_events (client_id, recurring_fee_id, amount, due_date, status, invoice_id) VALUES (1, ?, 100, '2026-01-01', ?, ?)",
+                      (fee_id, status, invoice_id))
+            ids.append(c.lastrowid)
+        c.execute("DELETE FROM schema_version WHERE version >= 2")
+    return ids
+
+def remaining_events():
+    with main.db() as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM payment_events ORDER BY id")]
+
+def test_unsent_duplicates_are_removed_and_logged(capsys):
+    first, invoiced, extra = add_occurrences(("not_sent", None), ("sent", 7), ("not_sent", None))
+    main.init_db()
+    assert remaining_events() == [invoiced]
+    assert f"{first}, {extra}" in capsys.readouterr().out
+
+def test_sent_or_invoiced_duplicates_stop_the_migration():
+    paid, invoiced, unsent = add_occurrences(("paid", None), ("sent", 7), ("not_sent", None))
+    with pytest.raises(RuntimeError, match=f"{invoiced} \\(duplicates {paid}\\)"):
+        main.init_db()
+    # Nothing was deleted and the step stays pending
+    assert remaining_events() == [paid, invoiced, unsent]
+    with main.db() as conn:
+        assert conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] == 1
@@ -0,0 +1,29 @@
+import pytest
+
+import main
+from conftest import invoice_form
+
+@pytest.fixture
+def profiling(monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_SECRET", "let-me-in")
+    monkeypatch.setattr(main, "PROFILE_SAMPLE_RATE", 1)
+
+def test_sampled_invoice_create_is_profiled_with_its_render(client, seed, profiling):
+    template_id, client_id = seed
+    response = client.post("/invoices", data=invoice_form(template_id, client_id))
+    assert response.status_code == 200, response.text
+    name = response.headers["x-profile-id"]
+
+    profiles = client.get("/profiles", headers={"X-Profile": "let-me-in"}).json()
+    profile = next(profile for profile in profiles if profile["name"] == name)
+    assert profile["trigger"] == "sampled"
+    assert profile["route"] == "/invoices" and profile["status"] == 200
+    assert any("render_invoice_stages" in entry["function"] for entry in profile["top_cumulative"])
+    assert client.get(f"/profiles/{name}", headers={"X-Profile": "let-me-in"}).status_code == 200
+
+def test_requested_profile_needs_the_secret(client, seed, profiling):
+    template_id, client_id = seed
+    invoice_id = client.post("/invoices", data=invoice_form(template_id, client_id)).json()["id"]
+    assert "x-profile-id" in client.get(f"/invoices/{invoice_id}", headers={"X-Profile": "let-me-in"}).headers
+    assert "x-profile-id" not in client.get(f"/invoices/{invoice_id}", headers={"X-Profile": "wrong"}).headers
+    assert client.get("/profiles", headers={"X-Profile": "wrong"}).status_code == 403
@@ -0,0 +1,42 @@
+import os
+
+import main
+
+BANK_DETAILS = {"iban": "CH5800791123000889012", "creditor_name": "My Company AG", "creditor_street": "My Street 1",
+                "creditor_postalcode": "8000", "creditor_city": "Zurich", "creditor_country": "CH"}
+DEBTOR = {"name": "ACME AG", "street": "Bahnhofstrasse 1", "pcode": "8001", "city": "Zurich", "country": "CH"}
+
+def qr_svg(amount):
+    return main.get_qr_bill_svg(main.build_qr_bill_args(amount, DEBTOR, BANK_DETAILS))
+
+def test_svg_is_reused_from_memory_and_disk(monkeypatch):
+    path, svg = qr_svg(100)
+    assert b"<svg" in svg
+    with open(path, "rb") as f:
+        assert f.read() == svg
+
+    def no_generation(**kwargs):
+        raise AssertionError("QR bill regenerated")
+
+    monkeypatch.setattr(main, "QRBill", no_generation)
+    assert qr_svg(100) == (path, svg)
+    main.qr_cache.discard(lambda key: True)
+    assert qr_svg(100) == (path, svg)
+
+def test_disk_cache_is_pruned_without_listing_it_on_every_miss(monkeypatch):
+    monkeypatch.setattr(main, "QR_CACHE_DISK_SIZE", 10)
+    listings = []
+    listdir = os.listdir
+
+    def counting_listdir(path):
+        listings.append(path)
+        return listdir(path)
+
+    monkeypatch.setattr(os, "listdir", counting_listdir)
+    for i in range(40):
+        qr_svg(100 + i)
+    files = [name for name in listdir(main.QR_CACHE_DIR) if name.endswith(".svg")]
+    assert 9 <= len(files) <= 10
+    assert len(listings) <= 40 // 2
+    # The newest bill survives pruning
+    assert os.path.basename(qr_svg(139)[0]) in files
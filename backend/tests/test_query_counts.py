@@ -0,0 +1,57 @@
+from datetime import date, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+# Statements each endpoint issues, whatever the number of rows it returns
+ENDPOINT_QUERIES = {
+    "/clients": 2,
+    "/invoices": 1,
+    "/payment-events": 1,
+    "/expenses": 1,
+    "/expenses/balance": 2,
+    "/settlements": 1,
+    "/dashboard/stats": 2,
+    "/dashboard/outstanding": 2,
+    "/dashboard/renewals": 2,
+    "/dashboard/partner-earnings": 3,
+}
+
+def add_rows(count):
+    """Add count clients, each with an invoice, a recurring fee, a payment event, an expense and a settlement."""
+    today = date.today()
+    with main.db() as conn:
+        c = conn.cursor()
+        partner_ids = [row[0] for row in c.execute("SELECT id FROM partners ORDER BY id").fetchall()]
+        for i in range(count):
+            c.execute("INSERT INTO clients (name, address, cap, city, nation, email) VALUES (?, ?, ?, ?, ?, ?)",
+                      (f"Client {i}", "Street 1", "8000", "Zurich", "CH", f"c{i}@example.ch"))
+            client_id = c.lastrowid
+            c.execute("""INSERT INTO invoices (invoice_number, client_id, template_id, data, status, total_amount, sent_date)
+                         VALUES (?, ?, 1, '{}', 'sent', 100, ?)""", (f"Q-{client_id}", client_id, today.isoformat()))
+            c.execute("INSERT INTO recurring_fees (client_id, amount, frequency, start_date, description) VALUES (?, 50, 'monthly', ?, 'Hosting')",
+                      (client_id, today.isoformat()))
+            c.execute("INSERT INTO payment_events (client_id, amount, due_date, description, status) VALUES (?, 50, ?, 'Hosting', 'not_sent')",
+                      (client_id, (today + timedelta(days=i % 20)).isoformat()))
+            c.execute("""INSERT INTO expenses (date, description, amount, category, expense_type, paid_by, status)
+                         VALUES (?, 'Office', 20, 'office', 'shared', ?, 'pending')""", (today.isoformat(), partner_ids[i % 2]))
+            c.execute("INSERT INTO settlements (from_partner_id, to_partner_id, amount, date) VALUES (?, ?, 10, ?)",
+                      (partner_ids[0], partner_ids[1], today.isoformat()))
+
+def queries_issued(client, path):
+    client.delete("/debug/queries")
+    assert client.get(path).status_code == 200
+    with main.query_stats_lock:
+        return sum(count for count, _, _, _ in main.query_stats.values())
+
+@pytest.mark.parametrize("path", sorted(ENDPOINT_QUERIES))
+def test_query_count_does_not_grow_with_rows(path):
+    # No lifespan, so no background worker queries while counting
+    client = TestClient(main.app)
+    add_rows(3)
+    few = queries_issued(client, path)
+    add_rows(30)
+    many = queries_issued(client, path)
+    assert few == many == ENDPOINT_QUERIES[path]
@@ -0,0 +1,38 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.fixture
+def api():
+    return TestClient(main.app)
+
+def run(sql, parameters=()):
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute(sql, parameters)
+        return c.fetchall()
+
+def test_statements_are_aggregated_by_shape(api):
+    api.delete("/debug/queries")
+    for expense_id in (1, 2, 3):
+        run(f"SELECT id FROM expenses WHERE id = {expense_id} AND description != 'x{expense_id}'")
+    run("SELECT id FROM expenses WHERE id IN (?, ?, ?)", (1, 2, 3))
+    run("SELECT id FROM expenses WHERE id IN (?, ?)", (1, 2))
+
+    stats = api.get("/debug/queries", params={"sort": "count"}).json()
+    by_sql = {query["sql"]: query for query in stats["queries"]}
+    assert by_sql["SELECT id FROM expenses WHERE id = ? AND description != ?"]["count"] == 3
+    assert by_sql["SELECT id FROM expenses WHERE id IN (?, ...)"]["count"] == 2
+    assert stats["slow"] == []
+    assert api.get("/debug/queries", params={"sort": "bogus"}).status_code == 400
+
+def test_slow_queries_are_logged_with_their_plan(api, monkeypatch):
+    monkeypatch.setattr(main, "SLOW_QUERY_MS", 0)
+    api.delete("/debug/queries")
+    run("SELECT id FROM expenses WHERE date >= ? ORDER BY date", ("2026-01-01",))
+
+    slow = api.get("/debug/queries").json()["slow"]
+    entry = next(entry for entry in slow if entry["sql"].startswith("SELECT id FROM expenses WHERE date >= ?"))
+    assert entry["plan"] and any("expenses" in step for step in entry["plan"])
+    assert entry["duration_ms"] >= 0
@@ -0,0 +1,106 @@
+from datetime import date, timedelta
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.fixture
+def api():
+    return TestClient(main.app)
+
+@pytest.fixture
+def client_id():
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO clients (name, address, cap, city, nation, email) VALUES ('ACME AG', 'Street 1', '8000', 'Zurich', 'CH', 'a@b.ch')")
+        return c.lastrowid
+
+def fee_events(fee_id):
+    with main.db() as conn:
+        rows = conn.execute("SELECT due_date, status FROM payment_events WHERE recurring_fee_id=? ORDER BY due_date", (fee_id,))
+        return [tuple(row) for row in rows.fetchall()]
+
+def generate(horizon):
+    with main.db() as conn:
+        return main.generate_due_payment_events(conn.cursor(), horizon)
+
+def rerun_migration(version):
+    with main.db() as conn:
+        conn.execute("DELETE FROM schema_version WHERE version >= ?", (version,))
+    main.init_db()
+
+def test_legacy_month_end_fee_is_not_billed_twice_a_month(client_id):
+    # History as the old generator wrote it: each date one month after the previous one
+    start = date(date.today().year - 1, 1, 31)
+    dates = [start]
+    while dates[-1] <= date.today():
+        dates.append(dates[-1] + relativedelta(months=1))
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO recurring_fees (client_id, amount, frequency, start_date, description, last_generated_until)
+                     VALUES (?, 100, 'monthly', ?, 'Hosting', ?)""", (client_id, start.isoformat(), dates[-1].isoformat()))
+        fee_id = c.lastrowid
+        c.executemany("INSERT INTO payment_events (client_id, recurring_fee_id, amount, due_date, status) VALUES (?, ?, 100, ?, 'paid')",
+                      [(client_id, fee_id, due.isoformat()) for due in dates])
+    rerun_migration(12)
+
+    generate(date.today() + timedelta(days=120))
+    due_dates = [date.fromisoformat(due) for due, _ in fee_events(fee_id)]
+    months = [(due.year, due.month) for due in due_dates]
+    assert len(months) == len(set(months))
+    assert len(due_dates) > len(dates)
+    assert all(due.day == 28 for due in due_dates[1:])
+
+def test_month_end_fee_stays_on_month_ends(api, client_id):
+    start = date(date.today().year - 1, 1, 31)
+    fee_id = api.post(f"/clients/{client_id}/recurring-fees",
+                      json={"amount": 100, "frequency": "monthly", "start_date": start.isoformat()}).json()["id"]
+    rerun_migration(12)
+    generate(date.today() + timedelta(days=120))
+    due_dates = [date.fromisoformat(due) for due, _ in fee_events(fee_id)]
+    assert all((due + timedelta(days=1)).day == 1 for due in due_dates)
+    assert len({(due.year, due.month) for due in due_dates}) == len(due_dates)
+
+def test_changing_the_start_date_drops_the_anchor(api, client_id):
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO recurring_fees (client_id, amount, frequency, start_date, schedule_anchor)
+                     VALUES (?, 100, 'monthly', '2025-01-31', '2025-03-28')""", (client_id,))
+        fee_id = c.lastrowid
+    fee = {"amount": 120, "frequency": "monthly", "start_date": "2025-01-31"}
+    api.put(f"/recurring-fees/{fee_id}", json=fee)
+    assert api.get(f"/clients/{client_id}/recurring-fees").json()[0]["schedule_anchor"] == "2025-03-28"
+    api.put(f"/recurring-fees/{fee_id}", json={**fee, "start_date": "2025-02-15"})
+    assert api.get(f"/clients/{client_id}/recurring-fees").json()[0]["schedule_anchor"] is None
+
+def test_editing_a_fee_only_reschedules_future_unpaid_events(api, client_id):
+    fee = {"amount": 900, "frequency": "yearly", "start_date": "2020-03-14", "description": "Domain"}
+    fee_id = api.post(f"/clients/{client_id}/recurring-fees", json=fee).json()["id"]
+    history = fee_events(fee_id)
+    past = [event for event in history if event[0] < date.today().isoformat()]
+    assert len(history) == len(past) + 1
+
+    api.put(f"/recurring-fees/{fee_id}", json={**fee, "start_date": "2020-03-15", "amount": 950})
+    events = fee_events(fee_id)
+    assert [event for event in events if event[0] < date.today().isoformat()] == past
+    upcoming = [due for due, _ in events if due >= date.today().isoformat()]
+    assert len(upcoming) == 1 and upcoming[0].endswith("-03-15")
+    with main.db() as conn:
+        assert conn.execute("SELECT amount FROM payment_events WHERE due_date=?", (upcoming[0],)).fetchone()[0] == 950
+
+def test_generation_does_not_backfill_missed_occurrences(client_id):
+    start = date.today() - timedelta(days=200)
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO recurring_fees (client_id, amount, frequency, start_date, last_generated_until)
+                     VALUES (?, 100, 'monthly', ?, ?)""", (client_id, start.isoformat(), start.isoformat()))
+        fee_id = c.lastrowid
+    scanned, generated = generate(date.today())
+    assert (scanned, generated) == (1, len(fee_events(fee_id)))
+    assert 1 <= generated <= 2
+    assert all(due >= date.today().isoformat() for due, _ in fee_events(fee_id))
+    with main.db() as conn:
+        watermark = conn.execute("SELECT last_generated_until FROM recurring_fees WHERE id=?", (fee_id,)).fetchone()[0]
+    assert watermark == fee_events(fee_id)[-1][0]
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from fastapi.testclient import TestClient
+
+import main
+from conftest import invoice_form
+
+def test_clients_respond_during_slow_render(seed, monkeypatch):
+    template_id, client_id = seed
+    rendering = threading.Event()
+    release = threading.Event()
+
+    def slow_render(invoice_id):
+        rendering.set()
+        release.wait(10)
+        return {"id": invoice_id}
+
+    monkeypatch.setattr(main, "render_invoice", slow_render)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            create = asyncio.create_task(http.post("/invoices", data=invoice_form(template_id, client_id)))
+            assert await asyncio.to_thread(rendering.wait, 5)
+            started = time.perf_counter()
+            clients = await http.get("/clients")
+            elapsed = time.perf_counter() - started
+            still_rendering = not create.done()
+            release.set()
+            return clients, elapsed, still_rendering, await create
+
+    clients, elapsed, still_rendering, created = asyncio.run(scenario())
+    assert clients.status_code == 200
+    assert [client["name"] for client in clients.json()] == ["ACME AG"]
+    assert still_rendering
+    assert elapsed < 1
+    assert created.status_code == 200
+
+def test_background_render_job_finishes(client, seed):
+    template_id, client_id = seed
+    response = client.post("/invoices?async_render=true", data=invoice_form(template_id, client_id))
+    assert response.json()["pdf_status"] == "queued"
+    job_id = response.json()["job_id"]
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "rendering"):
+            break
+        time.sleep(0.05)
+    assert job["status"] == "done", job
+    assert client.get(f"/invoices/{response.json()['id']}/pdf").status_code == 200
+
+def test_template_css_is_served_through_its_link(seed, workdir):
+    template_id, _ = seed
+    template_dir = os.path.join(main.TEMPLATE_DIR, os.listdir(main.TEMPLATE_DIR)[0])
+    css = main.get_template_css(template_id, os.path.join(template_dir, "style.css"))
+    assert css == b"h1 { color: red; }"
+    invoice_dir = workdir / "results" / "invoice_1"
+    fetcher = main.InvoiceURLFetcher(str(invoice_dir), template_dir, "style.css", None, css)
+    response = fetcher.fetch(f"file://{invoice_dir}/style.css")
+    assert response.read() == css
+
+def test_font_config_is_per_thread():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        barrier = threading.Barrier(2)
+
+        def font_configs(_):
+            first = main.get_font_config()
+            barrier.wait(5)
+            return first, main.get_font_config()
+
+        (a, a_again), (b, b_again) = executor.map(font_configs, range(2))
+    assert a is a_again and b is b_again
+    assert a is not b
+
+def test_saturated_renders_are_refused_with_retry_after(seed, monkeypatch):
+    template_id, client_id = seed
+    rendering = threading.Event()
+    release = threading.Event()
+
+    def slow_render(invoice_id):
+        rendering.set()
+        release.wait(10)
+        return {"id": invoice_id}
+
+    monkeypatch.setattr(main, "render_invoice", slow_render)
+    monkeypatch.setattr(main, "render_admission", main.RenderAdmission(1, 0))
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            create = asyncio.create_task(http.post("/invoices", data=invoice_form(template_id, client_id)))
+            assert await asyncio.to_thread(rendering.wait, 5)
+            refused = await http.post("/invoices", data=invoice_form(template_id, client_id))
+            release.set()
+            return refused, await create
+
+    refused, created = asyncio.run(scenario())
+    assert created.status_code == 200
+    assert refused.status_code == 429
+    assert int(refused.headers["retry-after"]) >= 1
+    assert main.render_admission.rejected == 1
+    with main.db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0] == 1
+
+def test_full_render_job_queue_is_refused(seed, monkeypatch):
+    template_id, client_id = seed
+    monkeypatch.setattr(main, "RENDER_MAX_QUEUED_JOBS", 0)
+    response = TestClient(main.app).post("/invoices?async_render=true", data=invoice_form(template_id, client_id))
+    assert response.status_code == 429
+    assert "retry-after" in response.headers
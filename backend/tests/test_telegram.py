@@ -0,0 +1,92 @@
+import asyncio
+import json
+from datetime import date, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.fixture
+def telegram(stub_server, monkeypatch):
+    """Point the dispatcher at the stub server and make the per-chat limit fast enough for tests."""
+    monkeypatch.setattr(main, "TELEGRAM_API_URL", stub_server.url)
+    monkeypatch.setattr(main, "TELEGRAM_CHAT_RATE", 50)
+    return stub_server
+
+@pytest.fixture
+def api():
+    return TestClient(main.app)
+
+def configure(api, **config):
+    api.put("/telegram/config", json={"bot_token": "TOKEN", "enabled": 1, "notify_overdue": 1, **config})
+    api.put("/partners/1", json={"telegram_chat_id": "111"})
+    api.put("/partners/2", json={"telegram_chat_id": "222"})
+
+def add_overdue_events(api, count):
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO clients (name, address, cap, city, nation, email) VALUES ('ACME AG', 'Street 1', '8000', 'Zurich', 'CH', 'a@b.ch')")
+        client_id = c.lastrowid
+    for i in range(count):
+        due = (date.today() - timedelta(days=1 + i)).isoformat()
+        api.post("/payment-events", json={"client_id": client_id, "amount": 10, "due_date": due, "description": f"Event {i}"})
+
+def sent_messages(server):
+    return [json.loads(request.body) for request in server.requests]
+
+def test_rate_limited_message_is_retried_after_retry_after(telegram):
+    calls = []
+
+    def respond(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return 429, {"ok": False, "parameters": {"retry_after": 0.3}}
+        return 200, {"ok": True}
+
+    telegram.respond = respond
+
+    async def dispatch():
+        try:
+            return await main.dispatch_telegram_messages("TOKEN", [("111", "hello")])
+        finally:
+            await main.close_http_clients()
+
+    assert asyncio.run(dispatch()) == [True]
+    assert len(calls) == 2
+    assert calls[0].path == "/botTOKEN/sendMessage"
+    assert calls[1].at - calls[0].at >= 0.3
+
+def test_each_chat_gets_each_alert_once_per_day(api, telegram):
+    configure(api)
+    add_overdue_events(api, 3)
+    failing_once = {"222"}
+
+    def respond(request):
+        chat_id = json.loads(request.body)["chat_id"]
+        if chat_id in failing_once:
+            failing_once.discard(chat_id)
+            return 500, {"ok": False}
+        return 200, {"ok": True}
+
+    telegram.respond = respond
+    assert api.post("/telegram/check").json() == {"sent": 5, "failed": 1}
+    # Only the message that failed for chat 222 is sent again
+    assert api.post("/telegram/check").json() == {"sent": 1, "failed": 0}
+    assert api.post("/telegram/check").json() == {"sent": 0, "failed": 0}
+    per_chat = {}
+    for message in sent_messages(telegram):
+        per_chat.setdefault(message["chat_id"], []).append(message["text"])
+    assert len(per_chat["111"]) == 3
+    assert len(per_chat["222"]) == 4 and len(set(per_chat["222"])) == 3
+
+def test_digest_sends_one_message_per_chat(api, telegram):
+    configure(api, digest=1)
+    add_overdue_events(api, 4)
+    assert api.post("/telegram/check").json() == {"sent": 2, "failed": 0}
+    messages = sent_messages(telegram)
+    assert sorted(message["chat_id"] for message in messages) == ["111", "222"]
+    assert all(message["text"].count("OVERDUE") == 4 for message in messages)
+    with main.db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM notifications_log").fetchone()[0] == 8
+    assert api.post("/telegram/check").json() == {"sent": 0, "failed": 0}
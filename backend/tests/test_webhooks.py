@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+import hmac
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.fixture
+def api():
+    return TestClient(main.app)
+
+@pytest.fixture
+def client_id():
+    with main.db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO clients (name, address, cap, city, nation, email) VALUES ('ACME AG', 'Street 1', '8000', 'Zurich', 'CH', 'a@b.ch')")
+        return c.lastrowid
+
+def add_events(api, client_id, count):
+    for i in range(count):
+        api.post("/payment-events", json={"client_id": client_id, "amount": 10 + i, "due_date": "2026-03-01", "description": f"Event {i}"})
+
+def deliver():
+    async def run():
+        try:
+            await main.deliver_webhooks()
+        finally:
+            await main.close_http_clients()
+    asyncio.run(run())
+
+def endpoint(api, webhook_id):
+    return next(webhook for webhook in api.get("/webhooks").json() if webhook["id"] == webhook_id)
+
+def outbox_ids():
+    with main.db() as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM outbox ORDER BY id")]
+
+def test_batches_are_signed_and_advance_the_cursor_in_order(api, client_id, stub_server, monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_BATCH_SIZE", 2)
+    webhook_id = api.post("/webhooks", json={"url": stub_server.url, "secret": "s3cret"}).json()["id"]
+    add_events(api, client_id, 5)
+    expected = outbox_ids()
+    deliver()
+
+    delivered = []
+    for request in stub_server.requests:
+        signature = hmac.new(b"s3cret", request.body, hashlib.sha256).hexdigest()
+        assert request.headers["X-Webhook-Signature"] == f"sha256={signature}"
+        events = json.loads(request.body)["events"]
+        assert len(events) <= 2
+        delivered.extend(event["id"] for event in events)
+    assert delivered == expected
+    assert all(event["type"] == "payment_event.created" for event in json.loads(stub_server.requests[0].body)["events"])
+    stats = endpoint(api, webhook_id)
+    assert stats["last_delivered_id"] == expected[-1]
+    assert stats["backlog"] == 0 and stats["delivered_count"] == 5
+    assert outbox_ids() == []
+
+def test_failed_batch_backs_off_and_is_retried(api, client_id, stub_server):
+    webhook_id = api.post("/webhooks", json={"url": stub_server.url}).json()["id"]
+    add_events(api, client_id, 2)
+    stub_server.respond = lambda request: (503, {"ok": False})
+    deliver()
+
+    stats = endpoint(api, webhook_id)
+    assert stats["failures"] == 1 and stats["last_error"] == "HTTP 503"
+    assert stats["next_attempt_at"] is not None
+    assert stats["last_delivered_id"] == 0 and stats["backlog"] == 2
+    # Still backing off: the next round does not post
+    deliver()
+    assert len(stub_server.requests) == 1
+
+    api.put(f"/webhooks/{webhook_id}", json={"enabled": 1})
+    stub_server.respond = lambda request: (200, {"ok": True})
+    deliver()
+    stats = endpoint(api, webhook_id)
+    assert stats["failures"] == 0 and stats["backlog"] == 0
+    assert stub_server.requests[1].body == stub_server.requests[0].body
+
+def test_backoff_grows_with_failures():
+    assert 1 <= main.webhook_backoff(1) <= 3
+    assert 16 <= main.webhook_backoff(5) <= 48
+    assert main.webhook_backoff(40) <= main.WEBHOOK_MAX_BACKOFF_SECONDS * 1.5
+
+def test_disabled_endpoint_keeps_its_backlog(api, client_id, stub_server):
+    api.post("/webhooks", json={"url": stub_server.url})
+    paused = api.post("/webhooks", json={"url": stub_server.url, "enabled": False}).json()["id"]
+    add_events(api, client_id, 3)
+    deliver()
+    assert len(outbox_ids()) == 3
+    assert endpoint(api, paused)["backlog"] == 3
+
+    api.delete(f"/webhooks/{paused}")
+    deliver()
+    assert outbox_ids() == []